@@ -1,9 +1,12 @@
 import os
+import tempfile
 import unittest
 
 import anndata
+import h5py
 import numpy as np
 import pandas as pd
+import scipy.sparse
 
 import wot.io
 
@@ -11,28 +14,29 @@ import wot.io
 class TestIO(unittest.TestCase):
 
     def test_read_grp(self):
-        gs = wot.io.read_sets(os.path.abspath('inputs/io/test.grp'))
+        gs = wot.io.read_sets(os.path.abspath('inputs/io/test.grp'), cache=False)
         self.assertTrue(np.sum(gs.X) == 4)
 
     def test_read_grp_subset(self):
-        gs = wot.io.read_sets(os.path.abspath('inputs/io/test.grp'), ['a', 'e', 'c', 'f'])
+        gs = wot.io.read_sets(os.path.abspath('inputs/io/test.grp'), ['a', 'e', 'c', 'f'], cache=False)
         self.assertTrue(gs.X[0, 0] == 1 and gs.X[2, 0] == 1)
 
     def test_read_gmx(self):
         gs = wot.io.read_sets(os.path.abspath(
-            'inputs/io/test_gene_sets.gmx'))
-        np.testing.assert_array_equal(gs.X,
+            'inputs/io/test_gene_sets.gmx'), cache=False)
+        self.assertTrue(scipy.sparse.issparse(gs.X))
+        np.testing.assert_array_equal(gs.X.toarray(),
                                       np.array([[1, 0], [0, 1], [1, 0], [0,
                                                                          1],
                                                 [1, 0]]))
 
     def test_read_gmt(self):
         gs = wot.io.read_sets(
-            os.path.abspath('inputs/io/msigdb.v6.1.symbols.gmt'))
+            os.path.abspath('inputs/io/msigdb.v6.1.symbols.gmt'), cache=False)
 
         set_id_filter = gs.var.index.values == \
                         'GO_NUCLEOTIDE_TRANSMEMBRANE_TRANSPORT'
-        d = gs.X[:, set_id_filter]
+        d = gs.X[:, set_id_filter].toarray()
         gene_id_filter = np.where(d == 1)
         ids = gs.obs.index.values[gene_id_filter[0]]
         expected_ids = (
@@ -46,11 +50,11 @@ class TestIO(unittest.TestCase):
 
     def test_read_gmt_write_gmx(self):
         gs = wot.io.read_sets(
-            os.path.abspath('inputs/io/msigdb.v6.1.symbols.gmt'))
+            os.path.abspath('inputs/io/msigdb.v6.1.symbols.gmt'), cache=False)
 
         set_id_filter = gs.var.index.values == \
                         'GO_NUCLEOTIDE_TRANSMEMBRANE_TRANSPORT'
-        d = gs.X[:, set_id_filter]
+        d = gs.X[:, set_id_filter].toarray()
         gene_id_filter = np.where(d == 1)
         ids = gs.obs.index.values[gene_id_filter[0]]
         expected_ids = (
@@ -69,13 +73,37 @@ class TestIO(unittest.TestCase):
 
             for j in range(len(expected_ids_array)):
                 gs = wot.io.read_sets(
-                    os.path.abspath(input), feature_ids=expected_ids_array[j])
+                    os.path.abspath(input), feature_ids=expected_ids_array[j], cache=False)
                 gs_ids = gs.obs.index.values
                 expected_ids = expected_ids_array[j]
 
                 for i in range(len(expected_ids)):
                     self.assertTrue(expected_ids[i] == gs_ids[i])
 
+    def test_convert_binary_dataset_to_dict(self):
+        gs = wot.io.read_sets(os.path.abspath('inputs/io/test_gene_sets.gmx'), cache=False)
+        sets = wot.io.convert_binary_dataset_to_dict(gs)
+        self.assertEqual(sets, wot.io.convert_binary_dataset_to_dict(
+            anndata.AnnData(gs.X.toarray(), gs.obs, gs.var)))
+        self.assertEqual(len(sets[gs.var.index[0]]), 3)
+
+    def test_set_library(self):
+        with open('test_library.gmt', 'w') as f:
+            f.write('s1\td1\tA\tb\n')
+            f.write('s2\td2\tb\tC\n')
+            f.write('s3\td3\ta\tD\n')
+        gs = wot.io.read_sets('test_library.gmt#s3,s1', ['c', 'B', 'a', 'x'])
+        cache_path = wot.io.get_cache_path('test_library.gmt', wot.io.SET_LIBRARY_SUFFIX)
+        self.assertTrue(os.path.exists(cache_path))
+        gs2 = wot.io.read_sets('test_library.gmt', ['c', 'B', 'a', 'x'], set_names=['s1', 's3'], cache=False)
+        os.remove('test_library.gmt')
+        os.remove(cache_path)
+        self.assertEqual(list(gs.var.index), ['s1', 's3'])
+        self.assertEqual(list(gs.var['description']), ['d1', 'd3'])
+        self.assertEqual(list(gs.obs.index), ['c', 'B', 'a', 'x'])
+        np.testing.assert_array_equal(gs.X.toarray(), [[0, 0], [1, 0], [1, 1], [0, 0]])
+        np.testing.assert_array_equal(gs.X.toarray(), gs2.X.toarray())
+
     def test_mtx_to_gct(self):
         ds = wot.io.read_dataset(
             'inputs/io/filtered_gene_bc_matrices/hg19/matrix.mtx')
@@ -137,3 +165,159 @@ class TestIO(unittest.TestCase):
         pd.testing.assert_frame_equal(
             ds.var,
             ds2.var)
+
+    def test_dataset_reader(self):
+        x = np.arange(24, dtype=np.float64).reshape(6, 4)
+        x[x % 3 == 0] = 0
+        ds = anndata.AnnData(X=scipy.sparse.csr_matrix(x),
+                             obs=pd.DataFrame(index=['c1', 'c2', 'c3', 'c4', 'c5', 'c6']),
+                             var=pd.DataFrame(index=['g1', 'g2', 'g3', 'g4']))
+        ds.write_h5ad('test_reader.h5ad')
+        with wot.io.DatasetReader('test_reader.h5ad', chunk_size=2) as reader:
+            subset = reader.read([4, 0, 1, 5], [3, 1])
+        os.remove('test_reader.h5ad')
+        self.assertTrue(scipy.sparse.issparse(subset.X))
+        np.testing.assert_array_equal(subset.X.toarray(), x[[4, 0, 1, 5]][:, [3, 1]])
+        self.assertEqual(list(subset.obs.index), ['c5', 'c1', 'c2', 'c6'])
+        self.assertEqual(list(subset.var.index), ['g4', 'g2'])
+
+    def test_read_dataset_filter(self):
+        x = np.arange(20, dtype=np.float64).reshape(5, 4)
+        ds = anndata.AnnData(X=scipy.sparse.csr_matrix(x),
+                             obs=pd.DataFrame(index=['c1', 'c2', 'c3', 'c4', 'c5'],
+                                              data={'keep': [True, False, True, True, False]}),
+                             var=pd.DataFrame(index=['g1', 'g2', 'g3', 'g4']))
+        ds.write_h5ad('test_filter.h5ad')
+        filtered = wot.io.read_dataset('test_filter.h5ad', obs_filter='keep', var_filter='g4,g2')
+        os.remove('test_filter.h5ad')
+        self.assertEqual(list(filtered.obs.index), ['c1', 'c3', 'c4'])
+        self.assertEqual(list(filtered.var.index), ['g2', 'g4'])
+        np.testing.assert_array_equal(filtered.X.toarray(), x[[0, 2, 3]][:, [1, 3]])
+
+    def test_read_table(self):
+        with open('test_table.txt', 'w') as f:
+            f.write('id,day,covariate\nc1,1,a\nc2,2.5,b\n')
+        df = wot.io.read_table('test_table.txt', index_col='id', dtype={'day': np.float64, 'missing': str})
+        os.remove('test_table.txt')
+        self.assertEqual(list(df.index), ['c1', 'c2'])
+        self.assertEqual(list(df.columns), ['day', 'covariate'])
+        self.assertEqual(df['day'].dtype, np.float64)
+        with open('test_table.txt', 'w') as f:
+            f.write('id\tday\nc1\t1\n')
+        df = wot.io.read_days_data_frame('test_table.txt')
+        os.remove('test_table.txt')
+        self.assertEqual(df.loc['c1', 'day'], 1.0)
+
+    def test_txt_cache(self):
+        with open('test_cache.txt', 'w') as f:
+            f.write('id\tg1\tg2\nc1\t1\t2\nc2\t3\t4\n')
+        cache_path = wot.io.get_cache_path('test_cache.txt')
+        ds = wot.io.read_dataset('test_cache.txt')
+        self.assertTrue(os.path.exists(cache_path))
+        ds2 = wot.io.read_dataset('test_cache.txt')
+        np.testing.assert_array_equal(ds.X, ds2.X)
+        self.assertEqual(list(ds2.var.index), ['g1', 'g2'])
+        with open('test_cache.txt', 'w') as f:
+            f.write('id\tg1\tg2\nc1\t5\t6\nc2\t7\t8\n')
+        os.utime('test_cache.txt', ns=(0, os.stat(cache_path).st_mtime_ns + 10 ** 9))
+        ds3 = wot.io.read_dataset('test_cache.txt')
+        os.remove('test_cache.txt')
+        os.remove(cache_path)
+        np.testing.assert_array_equal(ds3.X, [[5, 6], [7, 8]])
+
+    def test_write_txt_and_mtx(self):
+        x = np.array([[1.5, 0, 0], [0, 0, 2], [0, 3.25, 0], [4, 0, 5]])
+        ds = anndata.AnnData(X=scipy.sparse.csr_matrix(x), obs=pd.DataFrame(index=['c1', 'c2', 'c3', 'c4']),
+                             var=pd.DataFrame(index=['g1', 'g2', 'g3']))
+        wot.io.write_dataset(ds, 'test_write', output_format='txt', chunk_size=3)
+        df = pd.read_csv('test_write.txt', sep='\t', index_col='id')
+        os.remove('test_write.txt')
+        np.testing.assert_array_equal(df.values, x)
+        self.assertEqual(list(df.index), ['c1', 'c2', 'c3', 'c4'])
+        wot.io.write_dataset(ds, 'test_write', output_format='mtx', chunk_size=3)
+        ds2 = wot.io.read_dataset('test_write.mtx')
+        for path in ['test_write.mtx', 'test_write.barcodes.tsv', 'test_write.genes.tsv']:
+            os.remove(path)
+        np.testing.assert_array_equal(ds2.X.toarray(), x)
+        self.assertEqual(list(ds2.var.index), ['g1', 'g2', 'g3'])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            wot.io.write_dataset(ds, os.path.join(tmp_dir, 'out'), output_format='mtx', atomic=True, compress=True)
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['out.barcodes.tsv', 'out.genes.tsv', 'out.mtx.gz'])
+            ds3 = wot.io.read_dataset(os.path.join(tmp_dir, 'out.mtx.gz'))
+        np.testing.assert_array_equal(ds3.X.toarray(), x)
+        self.assertEqual(list(ds3.obs.index), ['c1', 'c2', 'c3', 'c4'])
+
+    def test_get_partial_path(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'out.h5ad')
+            partial_paths = [wot.io.get_partial_path(path) for _ in range(2)]
+            self.assertNotEqual(partial_paths[0], partial_paths[1])
+            for partial_path in partial_paths:
+                self.assertEqual(os.path.dirname(partial_path), tmp_dir)
+                self.assertTrue(os.path.basename(partial_path).startswith('.partial-'))
+                self.assertTrue(partial_path.endswith('out.h5ad'))
+
+    def test_read_10x_filter(self):
+        X = scipy.sparse.csc_matrix(np.array([[1, 0, 2], [0, 3, 0]], dtype=np.int32).T)  # genes by cells
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'test.h5')
+            with h5py.File(path, 'w') as f:
+                group = f.create_group('matrix')
+                group['barcodes'] = np.array([b'AAA-1', b'CCC-1'])
+                group['data'], group['indices'], group['indptr'] = X.data, X.indices, X.indptr
+                group['shape'] = np.array(X.shape)
+                features = group.create_group('features')
+                features['id'] = np.array([b'ENSG1', b'ENSG2', b'ENSG3'])
+                features['name'] = np.array([b'A', b'B', b'C'])
+                features['feature_type'] = np.array([b'Gene Expression'] * 3)
+                features['genome'] = np.array([b'hg19'] * 3)
+            ds = wot.io.read_dataset(path)
+            filtered = wot.io.read_dataset(path, var_filter='A,C')
+        self.assertEqual(list(filtered.obs.index), list(ds.obs.index))
+        self.assertEqual(list(filtered.var.index), [ds.var.index[0], ds.var.index[2]])
+        np.testing.assert_array_equal(filtered.X.toarray(), ds.X.toarray()[:, [0, 2]])
+
+    def test_convert_to_h5ad(self):
+        x = np.array([[1.5, 0, 0], [0, 0, 2], [0, 3.25, 0], [4, 0, 5]])
+        ds = anndata.AnnData(X=scipy.sparse.csr_matrix(x), obs=pd.DataFrame(index=['c1', 'c2', 'c3', 'c4']),
+                             var=pd.DataFrame(index=['g1', 'g2', 'g3']))
+        wot.io.write_dataset(ds, 'test_convert', output_format='mtx')
+        wot.io.convert_to_h5ad('test_convert.mtx', 'test_convert', transpose=True, chunk_size=2, max_entries=2)
+        ds2 = anndata.read_h5ad('test_convert.h5ad')
+        for path in ['test_convert.mtx', 'test_convert.barcodes.tsv', 'test_convert.genes.tsv',
+                     'test_convert.h5ad']:
+            os.remove(path)
+        np.testing.assert_array_equal(ds2.X.toarray(), x.T)
+        self.assertEqual(list(ds2.obs.index), ['g1', 'g2', 'g3'])
+        self.assertEqual(list(ds2.var.index), ['c1', 'c2', 'c3', 'c4'])
+
+    def test_convert_csc_to_h5ad(self):
+        x = scipy.sparse.random(30, 7, density=0.3, format='csc', random_state=0)
+        ds = anndata.AnnData(X=x, obs=pd.DataFrame(index=['c{}'.format(i) for i in range(30)]),
+                             var=pd.DataFrame(index=['g{}'.format(i) for i in range(7)]))
+        read = wot.io.DatasetReader.read
+
+        def fail_read(*args, **kwargs):
+            raise AssertionError('CSC matrix read by rows')
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ds.write_h5ad(os.path.join(tmp_dir, 'csc.h5ad'))
+            wot.io.DatasetReader.read = fail_read
+            try:
+                wot.io.convert_to_h5ad(os.path.join(tmp_dir, 'csc.h5ad'), os.path.join(tmp_dir, 'out'), chunk_size=4,
+                                       max_entries=10)
+            finally:
+                wot.io.DatasetReader.read = read
+            ds2 = anndata.read_h5ad(os.path.join(tmp_dir, 'out.h5ad'))
+        self.assertEqual(ds2.X.format, 'csr')
+        np.testing.assert_array_equal(ds2.X.toarray(), x.toarray())
+        self.assertEqual(list(ds2.obs.index), list(ds.obs.index))
+
+    def test_convert_to_h5ad_promotes_dtype(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'test.txt')
+            with open(path, 'wt') as f:
+                f.write('id\tg1\tg2\nc1\t1\t0\nc2\t0\t2\nc3\t0.5\t0\nc4\t0\t2.25\n')
+            wot.io.convert_to_h5ad(path, os.path.join(tmp_dir, 'test'), chunk_size=2)
+            ds = anndata.read_h5ad(os.path.join(tmp_dir, 'test.h5ad'))
+        np.testing.assert_array_equal(ds.X.toarray(), [[1, 0], [0, 2], [0.5, 0], [0, 2.25]])
@@ -0,0 +1,560 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import anndata
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import wot.ot
+import wot.tmap
+
+
+def _make_tmaps(sizes, rng, sparse_at=None):
+    # random transport maps between consecutive days of cells named c<day>_<i>, and the cells' metadata
+    ids = [['c{}_{}'.format(t, i) for i in range(sizes[t])] for t in range(len(sizes))]
+    tmaps = {}
+    for t in range(len(sizes) - 1):
+        X = rng.rand(sizes[t], sizes[t + 1])
+        if t == sparse_at:
+            X = scipy.sparse.csr_matrix(X * (X > 0.5))
+        tmaps[(t, t + 1)] = anndata.AnnData(X, obs=pd.DataFrame(index=ids[t]), var=pd.DataFrame(index=ids[t + 1]))
+    meta = pd.DataFrame(index=np.concatenate(ids), data={'day': np.repeat(np.arange(len(sizes)), sizes)})
+    return tmaps, meta
+
+
+def _write_tmaps(prefix, tmaps):
+    for (t0, t1), tmap in tmaps.items():
+        tmap.write_h5ad('{}_{}_{}.h5ad'.format(prefix, t0, t1))
+
+
+class TestOT(unittest.TestCase):
+
+    def test_parse_memory_size(self):
+        self.assertEqual(wot.ot.parse_memory_size('52GB'), 52 * 1024 ** 3)
+        self.assertEqual(wot.ot.parse_memory_size('1.5m'), int(1.5 * 1024 ** 2))
+        self.assertEqual(wot.ot.parse_memory_size(1000), 1000)
+        self.assertRaises(ValueError, wot.ot.parse_memory_size, '12 parsecs')
+
+    def test_run_with_memory_budget(self):
+        lock = threading.Lock()
+        running = []
+        max_running = [0]
+        started = []
+
+        def job(key, estimate):
+            def fn():
+                with lock:
+                    started.append(key)
+                    running.append(estimate)
+                    max_running[0] = max(max_running[0], sum(running))
+                    self.assertTrue(sum(running) <= 100 or running == [150])
+                time.sleep(0.05)
+                with lock:
+                    running.remove(estimate)
+                return key
+
+            return key, estimate, fn
+
+        jobs = [job('a', 30), job('b', 60), job('c', 50), job('d', 20), job('e', 150)]
+        results = wot.ot.run_with_memory_budget(jobs, 100, max_workers=4)
+        self.assertEqual(results, {k: k for k in 'abcde'})
+        self.assertEqual(started[0], 'e')  # largest first, run alone as it exceeds the budget
+        self.assertEqual(max_running[0], 150)
+        self.assertEqual(set(started[1:3]), {'b', 'a'})
+
+    def test_memory_monitor(self):
+        with wot.ot.scheduling._MemoryMonitor(interval=0.01) as monitor:
+            monitor.begin('a')
+            x = np.ones(2 ** 23)  # 64MB
+            observed = monitor.end('a')
+            del x
+            monitor.begin('b')
+            monitor.begin('c')
+            self.assertIsNone(monitor.end('b'))  # shared with c
+            self.assertIsNone(monitor.end('c'))
+        if observed is not None:
+            self.assertGreater(observed, 2 ** 25)
+
+    def test_run_with_memory_budget_hold_memory(self):
+        lock = threading.Lock()
+        held = []
+        max_held = [0]
+        releases = []
+
+        def job(key, estimate):
+            def fn(release):
+                with lock:
+                    held.append(estimate)
+                    max_held[0] = max(max_held[0], sum(held))
+
+                def write():
+                    time.sleep(0.05)
+                    with lock:
+                        held.remove(estimate)
+                    release()
+
+                # results written in the background keep their memory reserved
+                thread = threading.Thread(target=write)
+                thread.start()
+                releases.append(thread)
+                return key
+
+            return key, estimate, fn
+
+        jobs = [job(k, 40) for k in 'abcdef']
+        results = wot.ot.run_with_memory_budget(jobs, 100, max_workers=4, hold_memory=True)
+        for thread in releases:
+            thread.join()
+        self.assertEqual(results, {k: k for k in 'abcdef'})
+        self.assertEqual(max_held[0], 80)
+
+    def test_assign_shards(self):
+        self.assertEqual(wot.ot.parse_shard('1/3'), (1, 3))
+        self.assertRaises(ValueError, wot.ot.parse_shard, '3/3')
+        self.assertRaises(ValueError, wot.ot.parse_shard, '1')
+        assignment = wot.ot.assign_shards([10, 40, 30, 20, 5], 2)
+        self.assertEqual(assignment, [0, 0, 1, 1, 0])
+        self.assertEqual(assignment, wot.ot.assign_shards([10, 40, 30, 20, 5], 2))
+
+    def test_merge_shards(self):
+        rng = np.random.RandomState(0)
+        sizes = [6, 5, 7]
+        obs = pd.DataFrame(index=['c{}'.format(i) for i in range(sum(sizes))],
+                           data={'day': np.repeat(np.arange(len(sizes)), sizes),
+                                 'covariate': ['a', 'b'] * (sum(sizes) // 2)})
+        ds = anndata.AnnData(rng.rand(sum(sizes), 4), obs=obs, var=pd.DataFrame(index=['g0', 'g1', 'g2', 'g3']))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model = wot.ot.OTModel(ds, local_pca=0, growth_iters=2)
+            full_prefix = os.path.join(tmp_dir, 'full', 'tmaps')
+            model.compute_all_transport_maps(tmap_out=full_prefix, output_file_format='txt', with_covariates=True)
+            shard_prefix = os.path.join(tmp_dir, 'shards', 'run')
+            for shard in ('0/2', '1/2'):
+                model.compute_all_transport_maps(tmap_out=shard_prefix, output_file_format='txt',
+                                                 with_covariates=True, shard=shard)
+            merged_prefix = os.path.join(tmp_dir, 'merged', 'tmaps')
+            wot.ot.merge_shards([shard_prefix], merged_prefix)
+
+            full_manifest = wot.ot.TransportMapManifest(full_prefix + '_manifest.json')
+            merged_manifest = wot.ot.TransportMapManifest(merged_prefix + '_manifest.json')
+            self.assertEqual(len(full_manifest.maps), 8)
+            self.assertEqual(sorted(merged_manifest.maps), sorted(full_manifest.maps))
+            for name, entry in full_manifest.maps.items():
+                for field in ('parameters', 'input_fingerprint', 'checksum', 'size'):
+                    self.assertEqual(merged_manifest.maps[name][field], entry[field])
+                merged = wot.io.read_dataset(os.path.join(tmp_dir, 'merged', name), cache=False)
+                full = wot.io.read_dataset(os.path.join(tmp_dir, 'full', name), cache=False)
+                np.testing.assert_array_equal(merged.X, full.X)
+                self.assertEqual(list(merged.obs.index), list(full.obs.index))
+                self.assertEqual(list(merged.var.index), list(full.var.index))
+            pd.testing.assert_frame_equal(
+                wot.io.read_table(merged_prefix + '_g.txt', sep='\t', index_col='id', dtype={'id': str}),
+                wot.io.read_table(full_prefix + '_g.txt', sep='\t', index_col='id', dtype={'id': str}))
+
+            os.remove(shard_prefix + '_shard1of2_g.txt')
+            self.assertRaises(ValueError, wot.ot.merge_shards, [shard_prefix], merged_prefix)
+            os.remove(shard_prefix + '_shard1of2.json')
+            self.assertRaises(ValueError, wot.ot.merge_shards, [shard_prefix], merged_prefix)
+
+    def test_run_with_memory_budget_error(self):
+        def fail():
+            raise RuntimeError('failed')
+
+        self.assertRaises(RuntimeError, wot.ot.run_with_memory_budget, [('a', 1, fail), ('b', 1, lambda: 1)], 10)
+
+    def test_background_writer(self):
+        written = []
+
+        def fail():
+            raise IOError('disk full')
+
+        writer = wot.ot.BackgroundWriter(max_pending=1)
+        writer.submit('a', lambda: written.append('a'))
+        writer.submit('b', fail)
+        writer.submit('c', lambda: written.append('c'))
+        self.assertRaises(IOError, writer.close)
+        self.assertEqual(written, ['a', 'c'])
+        # day pairs are logged as plain numbers
+        with self.assertLogs('wot', level='INFO') as logs:
+            with wot.ot.BackgroundWriter() as writer:
+                writer.submit((np.float64(0), np.float64(1.5)), lambda: None)
+        self.assertTrue(logs.output[0].startswith('INFO:wot:(0.0, 1.5): written in'))
+
+    def test_downsample_counts(self):
+        X = scipy.sparse.csr_matrix(np.array([[5, 0, 3, 2], [1, 0, 0, 1], [0, 0, 0, 0], [0, 40, 10, 0]]))
+        result = wot.ot.downsample_counts(X, 4, random_state=0)
+        self.assertTrue(scipy.sparse.issparse(result))
+        np.testing.assert_array_equal(np.asarray(result.sum(axis=1)).ravel(), [4, 2, 0, 4])
+        np.testing.assert_array_equal(result[1].toarray(), X[1].toarray())
+        self.assertEqual(((result != 0).toarray() & (X == 0).toarray()).sum(), 0)
+        np.testing.assert_array_equal(result.toarray(),
+                                      wot.ot.downsample_counts(X.toarray(), 4, random_state=0))
+
+    def test_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest_path = os.path.join(tmp_dir, 'tmaps_manifest.json')
+            tmap_path = os.path.join(tmp_dir, 'tmaps_0_1.h5ad')
+            params = {'epsilon': 0.05, 't0': 0.0, 't1': 1.0, 'covariate': None}
+            manifest = wot.ot.TransportMapManifest(manifest_path)
+            self.assertFalse(manifest.is_current(tmap_path, params, 'abc'))
+            with open(tmap_path, 'wb') as f:
+                f.write(b'tmap')
+            manifest.record(tmap_path, params, 'abc', 1.0)
+
+            manifest = wot.ot.TransportMapManifest(manifest_path)
+            self.assertTrue(manifest.is_current(tmap_path, params, 'abc'))
+            self.assertFalse(manifest.is_current(tmap_path, {**params, 'epsilon': 0.1}, 'abc'))
+            self.assertFalse(manifest.is_current(tmap_path, params, 'abd'))
+            with open(tmap_path, 'ab') as f:
+                f.write(b'partial')
+            self.assertFalse(manifest.is_current(tmap_path, params, 'abc'))
+
+    def test_day_index(self):
+        rng = np.random.RandomState(0)
+        days = rng.permutation([0.0] * 4 + [1.5] * 6 + [3.0] * 5)
+        obs = pd.DataFrame(index=['c{}'.format(i) for i in range(len(days))],
+                           data={'day': days, 'covariate': rng.choice(['a', 'b'], len(days))})
+        ds = anndata.AnnData(rng.rand(len(days), 3), obs=obs, var=pd.DataFrame(index=['g0', 'g1', 'g2']))
+        model = wot.ot.OTModel(ds, local_pca=0)
+        self.assertEqual(model.timepoints, [0.0, 1.5, 3.0])
+        self.assertEqual(list(model.day_ranges.keys()), model.timepoints)
+        # days that were filtered out or never sampled have no cells, like an empty boolean mask
+        filtered_model = wot.ot.OTModel(ds, local_pca=0, cell_day_filter='0,3')
+        for t in [0, 1.5, 2, 3]:
+            for m, expected_days in ((model, [0.0, 1.5, 3.0]), (filtered_model, [0.0, 3.0])):
+                expected = ds[(ds.obs['day'] == t).values & ds.obs['day'].isin(expected_days).values]
+                cells = m.get_cells(t)
+                self.assertEqual(list(cells.obs.index), list(expected.obs.index))
+                np.testing.assert_array_equal(cells.X, expected.X)
+                for covariate in ['a', 'b']:
+                    expected_ids = expected.obs.index[expected.obs['covariate'] == covariate]
+                    self.assertEqual(list(m.get_cells(t, covariate).obs.index), list(expected_ids))
+        self.assertEqual(model.get_cell_indices(2), slice(0, 0))
+        self.assertNotIn(1.5, filtered_model.day_ranges)
+
+    def test_lazy_model_reads(self):
+        rng = np.random.RandomState(0)
+        obs = pd.DataFrame(index=['c{}'.format(i) for i in range(12)],
+                           data={'day': [0] * 5 + [1] * 7, 'covariate': ['a', 'b'] * 6})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'matrix.h5ad')
+            anndata.AnnData(rng.rand(12, 3), obs=obs, var=pd.DataFrame(index=['g0', 'g1', 'g2'])).write(path)
+            model = wot.ot.initialize_ot_model(path, lazy=True)
+            tmap_out = os.path.join(tmp_dir, 'tmaps')
+            model.compute_all_transport_maps(tmap_out=tmap_out, output_file_format='txt')
+
+            def read(*args):
+                raise AssertionError('cells read')
+
+            model.reader.read = read
+            self.assertEqual(model.get_cell_counts(0, 1), (5, 7))
+            self.assertEqual(model.get_cell_counts(0, 1, ('a', 'b')), (3, 4))
+            self.assertEqual(model.estimate_transport_map_cost(0, 1), 35)
+            # the maps recorded when overwriting are current without reading the cells again
+            model.compute_all_transport_maps(tmap_out=tmap_out, output_file_format='txt', overwrite=False)
+
+    def test_lazy_csc_reads(self):
+        rng = np.random.RandomState(0)
+        X = scipy.sparse.random(300, 5, density=0.8, format='csc', random_state=rng)
+        obs = pd.DataFrame(index=['c{}'.format(i) for i in range(300)], data={'day': rng.randint(0, 3, 300)})
+        iter_csc_entries = wot.io.dataset_reader._iter_csc_entries
+        segments = []
+
+        def record_csc_entries(*args):
+            for i, j, v in iter_csc_entries(*args):
+                segments.append(len(i))
+                yield i, j, v
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'matrix.h5ad')
+            anndata.AnnData(X, obs=obs, var=pd.DataFrame(index=['g{}'.format(i) for i in range(5)])).write(path)
+            model = wot.ot.initialize_ot_model(path, lazy=True)
+            model.reader.chunk_size = 1
+            wot.io.dataset_reader._iter_csc_entries = record_csc_entries
+            try:
+                cells = model.get_cells(1)
+            finally:
+                wot.io.dataset_reader._iter_csc_entries = iter_csc_entries
+            model.reader.close()
+        day = np.flatnonzero(obs['day'].values == 1)
+        self.assertEqual(list(cells.obs.index), list(obs.index[day]))
+        np.testing.assert_array_equal(cells.X.toarray(), X.toarray()[day])
+        # the matrix is scanned in segments, only the entries of the day are kept
+        self.assertEqual(sum(segments), X.nnz)
+        self.assertLessEqual(max(segments), 100)
+        self.assertEqual(cells.X.nnz, X[day].nnz)
+
+    def test_checkpoint_resume(self):
+        rng = np.random.RandomState(0)
+        C = rng.rand(20, 30)
+        C = C / np.median(C)
+        params = dict(C=C, G=np.ones(20), growth_iters=2, lambda1=1, lambda2=50, epsilon=0.05, batch_size=5,
+                      tolerance=1e-8, tau=10000, epsilon0=1, max_iter=1e7)
+        expected, expected_growth = wot.ot.compute_transport_matrix(wot.ot.optimal_transport_duality_gap,
+                                                                    **dict(params))
+
+        class Interrupt(Exception):
+            pass
+
+        class InterruptedCheckpoint(wot.ot.SolverCheckpoint):
+            saves = 0
+
+            def save(self, force=False, **solver_state):
+                super().save(force=force, **solver_state)
+                InterruptedCheckpoint.saves += 1
+                if InterruptedCheckpoint.saves == 40:
+                    raise Interrupt()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'checkpoint.npz')
+            with self.assertRaises(Interrupt):
+                wot.ot.compute_transport_matrix(wot.ot.optimal_transport_duality_gap,
+                                                checkpoint=InterruptedCheckpoint(path, interval=0, key='k'),
+                                                **dict(params))
+            self.assertIsNone(wot.ot.SolverCheckpoint(path, key='other').load())
+            tmap, growth = wot.ot.compute_transport_matrix(wot.ot.optimal_transport_duality_gap,
+                                                           checkpoint=wot.ot.SolverCheckpoint(path, key='k'),
+                                                           **dict(params))
+        np.testing.assert_allclose(tmap, expected, rtol=1e-6)
+        np.testing.assert_allclose(growth[1], expected_growth[1], rtol=1e-6)
+
+    def test_tmap_chunk_size(self):
+        tmaps, meta = _make_tmaps([5, 7, 4], np.random.RandomState(0), sparse_at=1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prefix = os.path.join(tmp_dir, 'tmaps')
+            _write_tmaps(prefix, tmaps)
+            model = wot.tmap.TransportMapModel.from_directory(prefix)
+            chunked_model = wot.tmap.TransportMapModel.from_directory(prefix, chunk_size=2)
+            population = model.population_from_ids(['c1_0', 'c1_3', 'c1_4'], at_time=1)[0]
+            np.testing.assert_allclose(chunked_model.trajectories([population]).X,
+                                       model.trajectories([population]).X)
+            np.testing.assert_allclose(chunked_model.fates([population]).X, model.fates([population]).X)
+            for name, compute in (('trajectories', model.trajectories), ('fates', model.fates)):
+                expected = compute([population])
+                result = compute([population], out=os.path.join(tmp_dir, name))
+                self.assertTrue(result.isbacked)
+                np.testing.assert_allclose(result.X[()], expected.X)
+                self.assertEqual(list(result.obs.index), list(expected.obs.index))
+                result.file.close()
+
+            def fail(*args, **kwargs):
+                raise ValueError('interrupted')
+
+            # an interrupted computation leaves no partial output
+            failing_model = wot.tmap.TransportMapModel.from_directory(prefix)
+            failing_model.pull_back = fail
+            files = sorted(os.listdir(tmp_dir))
+            self.assertRaises(ValueError, failing_model.fates, [population], out=os.path.join(tmp_dir, 'failed'))
+            self.assertEqual(sorted(os.listdir(tmp_dir)), files)
+            coupling_path = os.path.join(tmp_dir, 'coupling.h5ad')
+            wot.tmap.write_long_range_coupling(chunked_model, 0, 2, coupling_path, chunk_size=3)
+            coupling = anndata.read_h5ad(coupling_path)
+            expected = model.get_coupling(0, 2)
+            np.testing.assert_allclose(coupling.X, scipy.sparse.csr_matrix(expected.X).toarray())
+            self.assertEqual(list(coupling.var.index), list(expected.var.index))
+            # without chunk_size or cache, every transport map is still read by blocks of rows
+            loads = []
+            load_coupling = model._load_coupling
+            model._load_coupling = lambda key: loads.append(key) or load_coupling(key)
+            wot.tmap.write_long_range_coupling(model, 0, 2, coupling_path, chunk_size=2)
+            self.assertEqual(loads, [])
+            np.testing.assert_allclose(anndata.read_h5ad(coupling_path).X, coupling.X)
+
+    def test_push_forward_support(self):
+        tmaps, meta = _make_tmaps([40, 30, 20], np.random.RandomState(0), sparse_at=1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prefix = os.path.join(tmp_dir, 'tmaps')
+            _write_tmaps(prefix, tmaps)
+            model = wot.tmap.TransportMapModel.from_directory(prefix)
+            full_model = wot.tmap.TransportMapModel.from_directory(prefix)
+            full_model.support_fraction = 0
+            for t, ids in ((0, ['c0_3', 'c0_17']), (1, ['c1_2', 'c1_29'])):
+                population = model.population_from_ids(ids, at_time=t)[0]
+                np.testing.assert_allclose(model.push_forward(population, to_time=2).p,
+                                           full_model.push_forward(population, to_time=2).p)
+            cached_model = wot.tmap.TransportMapModel.from_directory(prefix, cache=True)
+            cached_model.get_coupling(0, 1)
+            population = model.population_from_ids(['c0_3', 'c0_17'], at_time=0)[0]
+            np.testing.assert_allclose(cached_model.push_forward(population).p, full_model.push_forward(population).p)
+
+            # rows are read instead of waiting for a prefetched map that is not loaded yet
+            prefetch_model = wot.tmap.TransportMapModel.from_directory(prefix)
+            prefetch_model.prefetch_depth = 1
+            load_coupling = prefetch_model._load_coupling
+            loaded = []
+
+            def slow_load_coupling(key):
+                time.sleep(0.5)
+                loaded.append(key)
+                return load_coupling(key)
+
+            prefetch_model._load_coupling = slow_load_coupling
+            np.testing.assert_allclose(prefetch_model.push_forward(population, to_time=2).p,
+                                       full_model.push_forward(population, to_time=2).p)
+            self.assertNotIn((0, 1), loaded)
+
+    def test_catalog(self):
+        rng = np.random.RandomState(0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prefix = os.path.join(tmp_dir, 'tmaps')
+            _write_tmaps(prefix, _make_tmaps([5, 7, 4], rng)[0])
+            model = wot.tmap.TransportMapModel.from_directory(prefix)
+            catalog_path = wot.tmap.get_catalog_path(prefix)
+            self.assertTrue(os.path.exists(catalog_path))
+            expected = wot.tmap.TransportMapModel.from_directory(prefix, catalog=False)
+            pd.testing.assert_frame_equal(wot.tmap.read_catalog(catalog_path, model.tmaps), expected.meta)
+            model = wot.tmap.TransportMapModel.from_directory(prefix)
+            pd.testing.assert_frame_equal(model.meta, expected.meta)
+            self.assertEqual(model.timepoints, expected.timepoints)
+            self.assertEqual(model.day_pairs, expected.day_pairs)
+            # the catalog is rebuilt once a transport map changes
+            tmaps = _make_tmaps([5, 7, 6], rng)[0]
+            _write_tmaps(prefix, {(1, 2): tmaps[(1, 2)]})
+            os.utime(prefix + '_1_2.h5ad', ns=(0, 0))
+            self.assertIsNone(wot.tmap.read_catalog(catalog_path, model.tmaps))
+            model = wot.tmap.TransportMapModel.from_directory(prefix)
+            self.assertEqual(model.meta.shape[0], 5 + 7 + 6)
+            self.assertIsNotNone(wot.tmap.read_catalog(catalog_path, model.tmaps))
+            # a catalog whose cells do not match the transport map shapes is ignored
+            with h5py.File(catalog_path, 'a') as f:
+                f['shapes'][1, 1] = 5
+            self.assertIsNone(wot.tmap.read_catalog(catalog_path, model.tmaps))
+            model = wot.tmap.TransportMapModel.from_directory(prefix)
+            with h5py.File(catalog_path, 'a') as f:
+                f['offsets'][1] = 4
+            self.assertIsNone(wot.tmap.read_catalog(catalog_path, model.tmaps))
+
+    def test_tmap_server(self):
+        tmaps, meta = _make_tmaps([5, 7, 4], np.random.RandomState(0))
+        model = wot.tmap.TransportMapModel(tmaps, meta)
+        cell_sets = {'A': ['c1_0', 'c1_3'], 'B': ['c1_1', 'c1_2', 'c1_6', 'c2_1']}
+        populations = model.population_from_cell_sets(cell_sets, at_time=1)
+        trajectories = model.trajectories(populations)
+        trajectories_call = threading.Event()
+
+        def slow_trajectories(populations):
+            trajectories_call.set()
+            time.sleep(0.5)
+            return trajectories
+
+        model.trajectories = slow_trajectories
+        server = wot.tmap.TransportMapServer(model)
+        loop = asyncio.new_event_loop()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'wot.sock')
+            loop.run_until_complete(server.start(path=path))
+            thread = threading.Thread(target=loop.run_forever, daemon=True)
+            thread.start()
+            try:
+                client = wot.tmap.TransportMapClient(path=path)
+                results = []
+                clients = [threading.Thread(target=lambda: results.append(client.trajectories(cell_sets, 1)))
+                           for _ in range(3)]
+                clients[0].start()
+                trajectories_call.wait()
+                for c in clients[1:]:
+                    c.start()
+                for c in clients:
+                    c.join()
+                for result in results:
+                    np.testing.assert_allclose(result.X, trajectories.X)
+                    self.assertEqual(list(result.obs.index), list(trajectories.obs.index))
+                status = client.status()
+                self.assertEqual((status['queries'], status['coalesced']), (1, 2))
+                np.testing.assert_allclose(client.fates(cell_sets, 1).X, model.fates(populations).X)
+                np.testing.assert_allclose(client.transition_table(cell_sets, 1, 2).X,
+                                           model.transition_table(populations, model.population_from_cell_sets(
+                                               cell_sets, at_time=2)).X)
+                census = client.census(cell_sets, 1)
+                self.assertEqual(list(census.keys()), ['A', 'B'])
+                self.assertEqual(census['A'].shape, (3, 2))
+                np.testing.assert_allclose(census['A'].X[1], [1, 0])
+                with self.assertRaises(ValueError):
+                    client.fates(cell_sets, 7)
+            finally:
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join()
+                server.close()
+                loop.close()
+
+    def test_tmap_cache(self):
+        cache = wot.tmap.TransportMapCache(max_bytes=200)
+        cache.put('a', np.zeros(10))
+        cache.put('b', np.zeros(10))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', np.zeros(10))  # evicts b, the least recently used
+        cache.put('d', np.zeros(100))  # too large
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNone(cache.get('d'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual((cache.hits, cache.misses, cache.evictions, cache.nbytes), (2, 2, 1, 160))
+        self.assertEqual(wot.tmap.get_nbytes(scipy.sparse.csr_matrix(np.eye(3))), 3 * 8 + 3 * 4 + 4 * 4)
+
+    def test_chain_transport_maps(self):
+        cost, split = wot.tmap.matrix_chain_order([10, 30, 5, 60])
+        self.assertEqual((cost[0][2], split[0][2]), (4500, 1))
+        tmaps, meta = _make_tmaps([4, 9, 2, 8, 3], np.random.RandomState(0))
+        cache = wot.tmap.TransportMapCache()
+        model = wot.tmap.TransportMapModel(tmaps, meta, timepoints=list(range(5)), chain_cache=cache)
+        expected = tmaps[(0, 1)].X
+        for t in range(1, 4):
+            expected = expected @ tmaps[(t, t + 1)].X
+        np.testing.assert_allclose(model.get_coupling(0, 3).X, tmaps[(0, 1)].X @ tmaps[(1, 2)].X @ tmaps[(2, 3)].X)
+        np.testing.assert_allclose(model.get_coupling(0, 4).X, expected)
+        self.assertEqual(cache.hits, 1)  # the product from 0 to 3 is reused
+        misses = cache.misses
+        self.assertEqual(list(model.get_coupling(0, 4).var.index), list(tmaps[(3, 4)].var.index))
+        self.assertEqual((cache.hits, cache.misses), (2, misses))
+
+    def test_one_vs_rest_fates(self):
+        tmaps, meta = _make_tmaps([6, 5, 4], np.random.RandomState(1))
+        model = wot.tmap.TransportMapModel(tmaps, meta, timepoints=[0, 1, 2])
+        ids = list(tmaps[(1, 2)].var.index)
+        populations = model.population_from_cell_sets({'a': ids[:1], 'b': ids[1:3], 'all': ids}, at_time=2)
+        results = model.one_vs_rest_fates(populations)
+        for population, result in zip(populations, results):
+            expected = model.fates([population])
+            self.assertEqual(list(result.var.index), list(expected.var.index))
+            np.testing.assert_allclose(result.X, expected.X)
+
+    def test_tmap_prefetcher(self):
+        loaded = []
+
+        def load(key):
+            if key == 'd':
+                raise IOError('corrupt')
+            loaded.append(key)
+            return np.zeros(3)
+
+        with wot.tmap.TransportMapPrefetcher(load, ['a', 'b', 'c', 'd'], depth=2) as prefetcher:
+            self.assertIsNotNone(prefetcher.get('a'))
+            self.assertIsNone(prefetcher.get('x'))
+            self.assertIsNotNone(prefetcher.get('c'))  # b is skipped
+            self.assertIsNone(prefetcher.get('b'))
+            self.assertRaises(IOError, prefetcher.get, 'd')
+        self.assertEqual(loaded[0], 'a')
+
+        def slow_load(key):
+            time.sleep(0.1)
+            return np.zeros(3)
+
+        start = time.time()
+        with wot.tmap.TransportMapPrefetcher(slow_load, range(5), depth=1) as prefetcher:
+            for key in range(5):
+                prefetcher.get(key)
+                time.sleep(0.1)
+        self.assertLess(time.time() - start, 0.9)  # loads overlap with use
+
+        with wot.tmap.TransportMapPrefetcher(slow_load, ['a', 'b'], depth=1) as prefetcher:
+            self.assertIsNone(prefetcher.get('a', wait=False))
+            self.assertIsNone(prefetcher.get('a'))  # discarded
+            self.assertIsNotNone(prefetcher.get('b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
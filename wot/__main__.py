@@ -6,8 +6,8 @@ from wot.commands import *
 
 def main():
     command_list = [convert_matrix, cells_by_gene_set, census, diff_exp, fates,
-                    gene_set_scores, optimal_transport,
-                    optimal_transport_validation, trajectory, trajectory_divergence,
+                    gene_set_scores, long_range_coupling, merge_tmaps, optimal_transport,
+                    optimal_transport_validation, serve, trajectory, trajectory_divergence,
                     trajectory_trends, transition_table]
     tool_parser = argparse.ArgumentParser(description='Run a wot command')
     command_list_strings = list(map(lambda x: x.__name__[len('wot.commands.'):], command_list))
@@ -5,8 +5,11 @@ from .convert_matrix import *
 from .diff_exp import *
 from .fates import *
 from .gene_set_scores import *
+from .long_range_coupling import *
+from .merge_tmaps import *
 from .optimal_transport import *
 from .optimal_transport_validation import *
+from .serve import *
 from .trajectory import *
 from .trajectory_divergence import *
 from .trajectory_trends import *
@@ -13,7 +13,7 @@ import wot.io
 def create_parser():
     parser = argparse.ArgumentParser(
         description='Generate ancestor census for each time point given an initial cell set')
-    parser.add_argument('--tmap', help=wot.commands.TMAP_HELP, required=True)
+    wot.commands.add_tmap_arguments(parser)
     parser.add_argument('--cell_set', help=wot.commands.CELL_SET_HELP, required=True)
     parser.add_argument('--day', help='The starting timepoint at which to consider the cell sets', required=True)
     parser.add_argument('--out', help='Output files prefix', default='census')
@@ -21,7 +21,7 @@ def create_parser():
 
 
 def main(args):
-    tmap_model = wot.tmap.TransportMapModel.from_directory(args.tmap)
+    tmap_model = wot.commands.initialize_tmap_model_from_args(args)
     cell_sets_matrix = wot.io.read_sets(args.cell_set)
     cell_sets = wot.io.convert_binary_dataset_to_dict(cell_sets_matrix)
     populations = tmap_model.population_from_cell_sets(cell_sets, at_time=args.day)
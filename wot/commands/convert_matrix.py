@@ -2,8 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-
-import pandas as pd
+import logging
 
 import wot.io
 
@@ -16,19 +15,34 @@ def create_parser():
     parser.add_argument('--obs', help='Row metadata to join with ids in matrix', action='append')
     parser.add_argument('--var', help='Column metadata to join with ids in matrix', action='append')
     parser.add_argument('--transpose', help='Transpose the matrix before saving', action='store_true')
+    parser.add_argument('--streaming',
+                        help='Convert to h5ad in chunks of rows without loading the matrix in memory',
+                        action='store_true')
+    parser.add_argument('--chunk_size', help='Number of rows read at once when streaming', type=int, default=10000)
+    parser.add_argument('--verbose', help='Print progress information', action='store_true')
     return parser
 
 
 def main(args):
+    if args.verbose:
+        logger = logging.getLogger('wot')
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(logging.StreamHandler())
     obs = []
     if args.obs is not None:
         for path in args.obs:
-            obs.append(pd.read_csv(path, index_col='id', engine='python', sep=None))
+            obs.append(wot.io.read_table(path, index_col='id', dtype={'id': str}))
     var = []
     if args.var is not None:
         for path in args.var:
-            var.append(pd.read_csv(path, index_col='id', engine='python', sep=None))
-
+            var.append(wot.io.read_table(path, index_col='id', dtype={'id': str}))
+
+    if args.streaming:
+        if args.format != 'h5ad':
+            raise ValueError('Streaming conversion only supports h5ad output')
+        wot.io.convert_to_h5ad(args.matrix, args.out, obs=obs, var=var, transpose=args.transpose,
+                               chunk_size=args.chunk_size)
+        return
     ds = wot.io.read_dataset(args.matrix)
     for df in obs:
         ds.obs = ds.obs.join(df)
@@ -55,19 +55,15 @@ def main(args):
     #     cell_filter = ds.obs.index.isin(background_cells_ids)
     #     background_ds = anndata.AnnData(ds.X[cell_filter], ds.obs.iloc[cell_filter], ds.var)
 
-    gs = wot.io.read_sets(gene_sets, ds.var.index.values)
-    logger.info('Read ' + gene_sets)
-
-    if gs.shape[1] == 0:
-        raise ValueError('No overlap of genes in gene sets and dataset')
+    set_names = None
     if args.gene_set_filter is not None:
         if os.path.exists(args.gene_set_filter):
-            set_names = pd.read_csv(args.gene_set_filter, header=None, index_col=0, engine='python',
-                sep='\n').index.values
+            set_names = wot.io.read_table(args.gene_set_filter, sep='\t', header=None, index_col=0).index.values
         else:
             set_names = args.gene_set_filter.split(',')
-        gs_filter = gs.var.index.isin(set_names)
-        gs = gs[:, gs_filter]
+    # only the selected sets are read from the compiled gene set library
+    gs = wot.io.read_sets(gene_sets, ds.var.index.values, set_names=set_names)
+    logger.info('Read ' + gene_sets)
     if gs.shape[1] == 0:
         raise ValueError('No gene sets')
 
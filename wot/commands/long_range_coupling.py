@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+
+import wot.tmap
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Compute the coupling between two non-adjacent timepoints by chaining transport maps, '
+                    'without holding the coupling in memory')
+    wot.commands.add_tmap_arguments(parser)
+    parser.add_argument('--t0', help='Source timepoint', required=True, type=float)
+    parser.add_argument('--t1', help='Destination timepoint', required=True, type=float)
+    parser.add_argument('--chunk_size', help='Number of source cells computed at once', type=int, default=1000)
+    parser.add_argument('--out', help='Output h5ad file name', required=True)
+    parser.add_argument('--verbose', help='Print progress information', action='store_true')
+    return parser
+
+
+def main(args):
+    if args.verbose:
+        logger = logging.getLogger('wot')
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(logging.StreamHandler())
+    tmap_model = wot.commands.initialize_tmap_model_from_args(args)
+    wot.tmap.write_long_range_coupling(tmap_model, args.t0, args.t1, args.out, chunk_size=args.chunk_size)
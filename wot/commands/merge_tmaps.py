@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+
+import wot.ot
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Validate and merge the transport maps computed by sharded optimal_transport runs')
+    parser.add_argument('--tmap', help='Output prefix (--out) of one or more optimal_transport shards',
+                        required=True, action='append')
+    parser.add_argument('--out', help='Prefix for merged output file names', default='./tmaps')
+    parser.add_argument('--verbose', help='Print progress information', action='store_true')
+    return parser
+
+
+def main(args):
+    if args.verbose:
+        logger = logging.getLogger('wot')
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(logging.StreamHandler())
+    wot.ot.merge_shards(args.tmap, args.out)
@@ -13,10 +13,23 @@ def create_parser():
     parser = argparse.ArgumentParser(description='Compute transport maps between pairs of time points')
     wot.commands.add_ot_parameters_arguments(parser)
     parser.add_argument('--format', help='Output file format', default='h5ad', choices=['h5ad', 'loom'])
-    parser.add_argument('--no_overwrite', help='Do not overwrite existing transport maps if they exist',
+    parser.add_argument('--no_overwrite',
+                        help='Only compute transport maps that are missing, or whose parameters or input cells '
+                             'changed since they were recorded in the run manifest',
                         action='store_true')
     parser.add_argument('--out', default='./tmaps',
                         help='Prefix for output file names')
+    parser.add_argument('--max_memory',
+                        help='Memory budget (e.g. 52GB) for computing several day pairs concurrently, largest first')
+    parser.add_argument('--checkpoint_interval', type=float,
+                        help='Save the solver state every checkpoint_interval seconds so that an interrupted run '
+                             'resumes where it stopped')
+    parser.add_argument('--shard',
+                        help='Only compute the i-th of N shards of day pairs (i/N, with i starting at 0), balanced by '
+                             'estimated cost. Combine the shards with merge_tmaps')
+    parser.add_argument('--max_pending_writes', type=int, default=1,
+                        help='Maximum number of computed transport maps waiting to be written in the background. '
+                             'Use 0 to write each transport map before computing the next one')
     return parser
 
 
@@ -27,4 +40,6 @@ def main(args):
         logger.addHandler(logging.StreamHandler())
     ot_model = wot.commands.initialize_ot_model_from_args(args)
     ot_model.compute_all_transport_maps(overwrite=not args.no_overwrite, output_file_format=args.format,
-                                        tmap_out=args.out)
+                                        tmap_out=args.out, max_memory=args.max_memory,
+                                        checkpoint_interval=args.checkpoint_interval, shard=args.shard,
+                                        max_pending_writes=args.max_pending_writes)
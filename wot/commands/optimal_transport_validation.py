@@ -56,7 +56,7 @@ def main(args):
     if args.day_triplets is not None:
         day_triplets = []
         if os.path.isfile(args.day_triplets):
-            day_triplets_df = pd.read_csv(args.day_triplets, engine='python', sep=None)
+            day_triplets_df = wot.io.read_table(args.day_triplets)
         else:
             triplets = args.day_triplets.split(';')
             array_of_arrays = []
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+
+import wot.tmap
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Answer trajectory, fates, census and transition table queries over HTTP, keeping the '
+                    'transport maps in memory between queries')
+    wot.commands.add_tmap_arguments(parser)
+    parser.add_argument('--host', help='Host to listen on', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on', type=int, default=8000)
+    parser.add_argument('--socket', help='Unix socket to listen on, instead of host and port')
+    parser.add_argument('--workers', help='Maximum number of queries computed at once', type=int)
+    parser.add_argument('--verbose', help='Print progress information', action='store_true')
+    return parser
+
+
+def main(args):
+    if args.verbose:
+        logger = logging.getLogger('wot')
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(logging.StreamHandler())
+    tmap_model = wot.commands.initialize_tmap_model_from_args(args)
+    if tmap_model.cache is None:
+        # without --cache_mb, keep every transport map loaded by a query
+        tmap_model.cache = wot.tmap.TransportMapCache()
+    server = wot.tmap.TransportMapServer(tmap_model, max_workers=args.workers)
+    server.serve_forever(host=args.host, port=args.port, path=args.socket)
@@ -4,7 +4,6 @@
 import argparse
 import logging
 
-import pandas as pd
 import wot
 import wot.ot
 
@@ -59,7 +58,7 @@ def main(args):
     local_pca = args.local_pca
     cell_days_df = None
     if args.cell_days is not None:
-        cell_days_df = pd.read_csv(args.cell_days, sep=None, index_col='id', engine='python')
+        cell_days_df = wot.io.read_days_data_frame(args.cell_days)
     adata = wot.io.read_dataset(args.matrix, obs_filter=args.cell_filter,
         var_filter=args.gene_filter)
     days = None
@@ -9,7 +9,7 @@ import wot.io
 def create_parser():
     parser = argparse.ArgumentParser(
         description='Generate a transition table from one cell set to another cell set')
-    parser.add_argument('--tmap', help=wot.commands.TMAP_HELP, required=True)
+    wot.commands.add_tmap_arguments(parser)
     parser.add_argument('--cell_set', help=wot.commands.CELL_SET_HELP, required=True)
     parser.add_argument('--start_time',
                         help='The start time for the cell sets to compute the transitions to cell sets at end_time',
@@ -21,7 +21,7 @@ def create_parser():
 
 
 def main(args):
-    tmap_model = wot.tmap.TransportMapModel.from_directory(args.tmap)
+    tmap_model = wot.commands.initialize_tmap_model_from_args(args)
     cell_sets = wot.io.read_sets(args.cell_set, as_dict=True)
     start_populations = tmap_model.population_from_cell_sets(cell_sets, at_time=args.start_time)
     end_populations = tmap_model.population_from_cell_sets(cell_sets, at_time=args.end_time)
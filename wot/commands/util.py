@@ -11,7 +11,7 @@ TMAP_HELP = 'Directory of transport maps as produced by optimal transport'
 MATRIX_HELP = 'A matrix with cells on rows and features, such as genes or pathways on columns'
 
 FORMAT_HELP = 'Output file format'
-FORMAT_CHOICES = ['gct', 'h5ad', 'loom', 'txt']
+FORMAT_CHOICES = ['gct', 'h5ad', 'loom', 'mtx', 'txt']
 try:
     import pyarrow
 
@@ -24,7 +24,7 @@ def get_trajectory_or_fates_parser(fates):
     parser = argparse.ArgumentParser(
         description='Generate {} for cell sets generated at the given time.'.format(
             'fates' if fates else 'trajectories'))
-    parser.add_argument('--tmap', help=wot.commands.TMAP_HELP, required=True)
+    wot.commands.add_tmap_arguments(parser)
     parser.add_argument('--cell_set', help=wot.commands.CELL_SET_HELP, required=True)
     parser.add_argument('--day', help='Day to consider for cell sets', required=True, type=float)
     parser.add_argument('--cell_set_filter', help='Comma separated list of cell sets to include (e.g. IPS,Stromal)')
@@ -39,7 +39,7 @@ def get_trajectory_or_fates_parser(fates):
 
 def run_trajectory_or_fates(args, fates):
     import os
-    tmap_model = wot.tmap.TransportMapModel.from_directory(args.tmap)
+    tmap_model = wot.commands.initialize_tmap_model_from_args(args)
     if os.path.exists(args.cell_set):
         cell_sets = wot.io.read_sets(args.cell_set, as_dict=True)
     else:
@@ -75,7 +75,7 @@ def run_trajectory_or_fates(args, fates):
         nbins = 500
         embedding_file = args.embedding
         if os.path.exists(embedding_file):
-            full_embedding_df = pd.read_csv(args.embedding, sep=None, engine='python', index_col='id')
+            full_embedding_df = wot.io.read_table(args.embedding, index_col='id', dtype={'id': str})
         else:
             import anndata  # h5ad#obsm
             tokens = embedding_file.split('#')
@@ -89,58 +89,105 @@ def run_trajectory_or_fates(args, fates):
         full_embedding_df['y'] = np.floor(
             np.interp(full_embedding_df['y'], [yrange[0], yrange[1]], [0, nbins - 1])).astype(int)
 
-    for pop_index in range(len(list_of_populations)):
-        populations = list_of_populations[pop_index]
-        result_ds = tmap_model.trajectories(populations) if not fates else tmap_model.fates(populations)
-        suffix = '_trajectory' if not fates else '_fates'
-        # dataset has cells on rows and cell sets (trajectories or fates) on columns
-        prefix = args.out
-        if len(list_of_population_names) > 0:
-            prefix += '_' + list_of_population_names[pop_index]
-        wot.io.write_dataset(result_ds, prefix + suffix, args.format)
-        if args.embedding:
-            for j in range(result_ds.shape[1]):  # each trajectory or fate
-                color = result_ds.X[:, j]
-                if scipy.sparse.issparse(color):
-                    color = color.toarray().flatten()
-
-                color_df = pd.DataFrame(index=result_ds.obs.index,
-                    data={'day': result_ds.obs['day'], 'color': color})
-                embedding_df = color_df.join(full_embedding_df)
-                figure = plt.figure(figsize=(10, 10))
-                plt.axis('off')
-                plt.tight_layout()
-                plt.scatter(full_embedding_df['x'], full_embedding_df['y'], c='#f0f0f0',
-                    s=4, marker=',', edgecolors='none', alpha=0.8)  # background
-                summed_df = embedding_df.groupby(['x', 'y'], as_index=False).agg('sum')
-                plt.scatter(summed_df['x'], summed_df['y'], c=summed_df['color'],
-                    s=6, marker=',', edgecolors='none', cmap='viridis_r', alpha=1,
-                    vmax=np.quantile(color, 0.975))
-                plt.colorbar()
-                ncells = (populations[j].p > 0).sum()
-                plt.suptitle('{}, day {}, {}/{} cells'.format(result_ds.var.index[j], args.day, ncells,
-                    len(populations[j].p)))
-                figure.savefig(args.out + '_' + str(result_ds.var.index[j]) + suffix + '.png')
-                plt.close(figure)
-
-                # create movie
-                # plt.tight_layout()
-                # unique_days = result_ds.obs['day'].unique()
-                #
-                # def animate(day_index):
-                #     summed_df = embedding_df[embedding_df['day'] == unique_days[day_index]].groupby(['x', 'y'],
-                #         as_index=False).agg('sum')
-                #     plt.title('{}, day {}'.format(result_ds.var.index[j], unique_days[day_index]))
-                #     plt.scatter(full_embedding_df['x'], full_embedding_df['y'], c='#f0f0f0',
-                #         s=4, marker=',', edgecolors='none', alpha=0.8)  # background
-                #     plt.scatter(summed_df['x'], summed_df['y'], c=summed_df['color'],
-                #         s=6, marker=',', edgecolors='none', cmap='viridis_r', alpha=1,
-                #         vmax=np.quantile(result_ds.obs_vector(j), 0.975))
-                #
-                # anim = animation.FuncAnimation(figure, func=animate, frames=range(0, len(unique_days)),
-                #     init_func=lambda **args: None, repeat=False, interval=400)
-                # anim.save(args.out + '_' + str(result_ds.var.index[j]) + suffix + '.mov')
-                # plt.close(figure)
+    suffix = '_trajectory' if not fates else '_fates'
+    # h5ad output is written as it is computed, without holding it in memory
+    out = args.out + suffix if args.format == 'h5ad' and not args.one_vs_rest else None
+    if args.one_vs_rest and len(list_of_populations) > 0:
+        # each transport map is applied once to all cell sets
+        all_populations = [populations[0] for populations in list_of_populations]
+        if fates:
+            results = tmap_model.one_vs_rest_fates(all_populations)
+        else:
+            result_ds = tmap_model.trajectories(all_populations)
+            results = [result_ds[:, [j]].copy() for j in range(result_ds.shape[1])]
+    else:
+        results = [tmap_model.trajectories(populations, out=out) if not fates else tmap_model.fates(
+            populations, out=out) for populations in list_of_populations]
+
+    try:
+        for pop_index in range(len(list_of_populations)):
+            populations = list_of_populations[pop_index]
+            result_ds = results[pop_index]
+            # dataset has cells on rows and cell sets (trajectories or fates) on columns
+            prefix = args.out
+            if len(list_of_population_names) > 0:
+                prefix += '_' + list_of_population_names[pop_index]
+            if out is None:
+                wot.io.write_dataset(result_ds, prefix + suffix, args.format)
+            if args.embedding:
+                for j in range(result_ds.shape[1]):  # each trajectory or fate
+                    color = result_ds.X[:, j]
+                    if scipy.sparse.issparse(color):
+                        color = color.toarray().flatten()
+
+                    color_df = pd.DataFrame(index=result_ds.obs.index,
+                        data={'day': result_ds.obs['day'], 'color': color})
+                    embedding_df = color_df.join(full_embedding_df)
+                    figure = plt.figure(figsize=(10, 10))
+                    plt.axis('off')
+                    plt.tight_layout()
+                    plt.scatter(full_embedding_df['x'], full_embedding_df['y'], c='#f0f0f0',
+                        s=4, marker=',', edgecolors='none', alpha=0.8)  # background
+                    summed_df = embedding_df.groupby(['x', 'y'], as_index=False).agg('sum')
+                    plt.scatter(summed_df['x'], summed_df['y'], c=summed_df['color'],
+                        s=6, marker=',', edgecolors='none', cmap='viridis_r', alpha=1,
+                        vmax=np.quantile(color, 0.975))
+                    plt.colorbar()
+                    ncells = (populations[j].p > 0).sum()
+                    plt.suptitle('{}, day {}, {}/{} cells'.format(result_ds.var.index[j], args.day, ncells,
+                        len(populations[j].p)))
+                    figure.savefig(args.out + '_' + str(result_ds.var.index[j]) + suffix + '.png')
+                    plt.close(figure)
+
+                    # create movie
+                    # plt.tight_layout()
+                    # unique_days = result_ds.obs['day'].unique()
+                    #
+                    # def animate(day_index):
+                    #     summed_df = embedding_df[embedding_df['day'] == unique_days[day_index]].groupby(['x', 'y'],
+                    #         as_index=False).agg('sum')
+                    #     plt.title('{}, day {}'.format(result_ds.var.index[j], unique_days[day_index]))
+                    #     plt.scatter(full_embedding_df['x'], full_embedding_df['y'], c='#f0f0f0',
+                    #         s=4, marker=',', edgecolors='none', alpha=0.8)  # background
+                    #     plt.scatter(summed_df['x'], summed_df['y'], c=summed_df['color'],
+                    #         s=6, marker=',', edgecolors='none', cmap='viridis_r', alpha=1,
+                    #         vmax=np.quantile(result_ds.obs_vector(j), 0.975))
+                    #
+                    # anim = animation.FuncAnimation(figure, func=animate, frames=range(0, len(unique_days)),
+                    #     init_func=lambda **args: None, repeat=False, interval=400)
+                    # anim.save(args.out + '_' + str(result_ds.var.index[j]) + suffix + '.mov')
+                    # plt.close(figure)
+    finally:
+        if out is not None:
+            # h5ad results are opened backed by trajectories and fates
+            for result_ds in results:
+                result_ds.file.close()
+
+
+def add_tmap_arguments(parser):
+    parser.add_argument('--tmap', help=wot.commands.TMAP_HELP, required=True)
+    parser.add_argument('--tmap_chunk_size', type=int,
+                        help='Read transport maps in blocks of this many rows instead of loading them in memory')
+    parser.add_argument('--cache_mb', type=float,
+                        help='Keep recently used transport maps in memory, up to this many megabytes')
+    parser.add_argument('--chain_cache_mb', type=float,
+                        help='Keep the products of transport maps between non-adjacent timepoints in memory for '
+                             'later queries, up to this many megabytes')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Number of transport maps loaded in the background while the current one is applied. '
+                             'Each one adds a transport map to peak memory')
+    parser.add_argument('--prefetch_mb', type=float,
+                        help='Stop loading transport maps in the background once they use this many megabytes')
+
+
+def initialize_tmap_model_from_args(args):
+    cache = wot.tmap.TransportMapCache(max_bytes=int(args.cache_mb * 2 ** 20)) if args.cache_mb else False
+    tmap_model = wot.tmap.TransportMapModel.from_directory(args.tmap, cache=cache, chunk_size=args.tmap_chunk_size)
+    if args.chain_cache_mb:
+        tmap_model.chain_cache = wot.tmap.TransportMapCache(max_bytes=int(args.chain_cache_mb * 2 ** 20))
+    tmap_model.prefetch_depth = args.prefetch
+    tmap_model.prefetch_max_bytes = int(args.prefetch_mb * 2 ** 20) if args.prefetch_mb else None
+    return tmap_model
 
 
 def initialize_ot_model_from_args(args):
@@ -168,7 +215,9 @@ def initialize_ot_model_from_args(args):
         inner_iter_max=args.inner_iter_max,
         ncells=args.ncells,
         ncounts=args.ncounts,
+        ncounts_seed=args.ncounts_seed,
         transpose=args.transpose,
+        lazy=args.lazy,
         max_iter=args.max_iter,
         batch_size=args.batch_size,
         tolerance=args.tolerance,
@@ -224,6 +273,9 @@ def add_ot_parameters_arguments(parser):
     parser.add_argument('--tau', type=float, default=10000, help='For OT solver')
     parser.add_argument('--ncells', type=int, help='Number of cells to downsample from each timepoint and covariate')
     parser.add_argument('--ncounts', help='Sample ncounts from each cell', type=int)
+    parser.add_argument('--ncounts_seed', help='Random seed for sampling ncounts from each cell', type=int)
+    parser.add_argument('--lazy', action='store_true',
+        help='Read the cells of each day from the h5ad or loom matrix when needed instead of loading the whole matrix')
     # parser.add_argument('--sampling_bias', help='File with "id" and "pp" to correct sampling bias.')
 
     parser.add_argument('--solver', choices=['duality_gap', 'fixed_iters'],
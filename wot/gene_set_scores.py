@@ -85,10 +85,10 @@ def score_gene_sets(ds, gs, method='mean_z_score', max_z_score=5, permutations=N
     if not scipy.sparse.issparse(gs_1_0):
         gs_1_0 = scipy.sparse.csr_matrix(gs_1_0)
 
-    gs_indices = (gs_1_0 > 0)
-    if hasattr(gs_indices, 'toarray'):
-        gs_indices = gs_indices.toarray()
-    gs_indices = gs_indices.flatten()
+    # genes in any of the sets, without densifying the membership matrix
+    gs_1_0 = gs_1_0.tocoo()
+    gs_indices = np.zeros(gs_1_0.shape[0], dtype=bool)
+    gs_indices[gs_1_0.row[gs_1_0.data > 0]] = True
 
     if len(x.shape) == 1:
         x = np.array([x])
@@ -1,3 +1,6 @@
 # -*- coding: utf-8 -*-
+from .dataset_reader import *
 from .io import *
 from .performance import *
+from .set_library import *
+from .streaming import *
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import os
+
+import anndata
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+_LOOM_ROW_IDS = ['Gene', 'var_names', 'id']
+_LOOM_COL_IDS = ['CellID', 'obs_names', 'id']
+
+
+def _get_runs(indices):
+    """
+    Splits sorted indices into runs of consecutive values.
+
+    Returns
+    -------
+    runs : list of (int, int, int)
+        Start and end (exclusive) of each run, and the position of its first index in indices
+    """
+    if len(indices) == 0:
+        return []
+    breaks = np.where(np.diff(indices) != 1)[0] + 1
+    positions = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(indices)]))
+    return [(int(indices[p]), int(indices[e - 1]) + 1, int(p)) for p, e in zip(positions, ends)]
+
+
+def _iter_csc_entries(group, indptr, columns, max_entries):
+    """
+    Iterates over the entries of the selected columns of a CSC matrix stored in group, reading at most
+    max_entries entries at once.
+
+    Yields
+    ------
+    i, j, v : ndarray
+        Rows, positions in columns and values of the entries
+    """
+    data = group['data']
+    indices = group['indices']
+    column_map = np.full(len(indptr) - 1, -1, dtype=np.int64)
+    column_map[columns] = np.arange(len(columns))
+    for start, end, _ in _get_runs(np.sort(columns)):
+        for offset in range(int(indptr[start]), int(indptr[end]), max_entries):
+            offset_end = min(offset + max_entries, int(indptr[end]))
+            file_columns = np.searchsorted(indptr, np.arange(offset, offset_end), side='right') - 1
+            yield indices[offset:offset_end].astype(np.int64), column_map[file_columns], data[offset:offset_end]
+
+
+def _open_text(path):
+    return gzip.open(path, 'rt') if path.lower().endswith('.gz') else open(path, 'rt')
+
+
+def _find_file(directory, names):
+    for name in names:
+        for suffix in ('', '.gz'):
+            path = os.path.join(directory, name + suffix)
+            if os.path.exists(path):
+                return path
+    raise ValueError('None of {} found in {}'.format(', '.join(names), directory))
+
+
+class DatasetReader:
+    """
+    Read-only access to subsets of the rows and columns of a dataset, without loading the whole matrix.
+
+    Row and column metadata are read when the reader is created, the matrix is read on demand by read.
+    h5ad, loom and 10x h5 files are read by slices. mtx files are scanned in chunks, keeping only
+    the selected entries.
+
+    Parameters
+    ----------
+    path : str
+        Path to a h5ad, loom, 10x h5 or mtx file
+    chunk_size : int, optional
+        Maximum number of rows read from the file at once
+    """
+
+    FORMATS = {'.h5ad': 'h5ad', '.loom': 'loom', '.h5': '10x', '.mtx': 'mtx', '.mtx.gz': 'mtx'}
+
+    def __init__(self, path, chunk_size=10000):
+        self.path = str(path)
+        self.chunk_size = chunk_size
+        self.format = DatasetReader.get_format(self.path)
+        if self.format is None:
+            raise ValueError('Unable to read {} by slices. Supported formats are h5ad, loom, 10x h5 and mtx'.format(
+                self.path))
+        self.file = None
+        self.sparse_format = None
+        if self.format == 'h5ad':
+            adata = anndata.read_h5ad(self.path, backed='r')
+            self.obs = adata.obs.copy()
+            self.var = adata.var.copy()
+            adata.file.close()
+        elif self.format == 'mtx':
+            self._init_mtx()
+            return
+        self.file = h5py.File(self.path, 'r')
+        if self.format == '10x':
+            self._init_10x()
+        elif self.format == 'loom':
+            self.obs = DatasetReader._read_loom_attrs(self.file['col_attrs'], _LOOM_COL_IDS)
+            self.var = DatasetReader._read_loom_attrs(self.file['row_attrs'], _LOOM_ROW_IDS)
+            self.X = self.file['matrix']
+        else:
+            self.X = self.file['X']
+            if isinstance(self.X, h5py.Group):
+                encoding = self.X.attrs.get('encoding-type', self.X.attrs.get('h5sparse_format', 'csr'))
+                encoding = encoding.decode() if isinstance(encoding, bytes) else str(encoding)
+                self.sparse_format = 'csc' if encoding.startswith('csc') else 'csr'
+                self.indptr = self.X['indptr'][()]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    @staticmethod
+    def get_format(path):
+        """
+        Returns the format of path if it can be read by slices, otherwise None
+        """
+        path = str(path).lower()
+        return next((f for ext, f in DatasetReader.FORMATS.items() if path.endswith(ext)), None)
+
+    def _init_10x(self):
+        # 10x stores a genes by cells CSC matrix, i.e. a cells by genes CSR matrix
+        if 'matrix' in self.file:  # Cell Ranger v3
+            group = self.file['matrix']
+            ids = group['features']['id'][()]
+            names = group['features']['name'][()]
+        else:  # Cell Ranger v2, one group per genome
+            group = self.file[next(iter(self.file.keys()))]
+            ids = group['genes'][()]
+            names = group['gene_names'][()]
+        self.obs = pd.DataFrame(index=group['barcodes'][()].astype(str))
+        self.var = pd.DataFrame(index=ids.astype(str), data={'symbol': names.astype(str)})
+        self.X = group
+        self.sparse_format = 'csr'
+        self.indptr = group['indptr'][()]
+
+    def _init_mtx(self):
+        directory, name = os.path.split(self.path)
+        # ids written by wot.io.write_dataset, or 10x file names
+        prefix = name[:-len('.mtx.gz')] if name.lower().endswith('.mtx.gz') else name[:-len('.mtx')]
+        barcodes = pd.read_csv(_find_file(directory, [prefix + '.barcodes.tsv', 'barcodes.tsv']), sep='\t',
+                               header=None, dtype=str)
+        features = pd.read_csv(_find_file(directory, [prefix + '.genes.tsv', 'genes.tsv', 'features.tsv']),
+                               sep='\t', header=None, dtype=str)
+        self.obs = pd.DataFrame(index=barcodes[0].values)
+        self.var = pd.DataFrame(index=features[0].values,
+                                data={'symbol': features[1].values} if features.shape[1] > 1 else None)
+        with _open_text(self.path) as f:
+            self.mtx_header_lines = 0
+            line = f.readline()
+            while line.startswith('%'):
+                self.mtx_header_lines += 1
+                line = f.readline()
+        self.mtx_shape = tuple(int(x) for x in line.split()[0:2])
+        # 10x matrices are stored genes by cells
+        self.mtx_transposed = self.mtx_shape != self.shape
+
+    @property
+    def shape(self):
+        return self.obs.shape[0], self.var.shape[0]
+
+    @staticmethod
+    def _read_loom_attrs(group, id_keys):
+        data = {}
+        for key in group.keys():
+            values = group[key][()]
+            if values.ndim == 1:
+                data[key] = values.astype(str) if values.dtype.kind in ('S', 'O') else values
+        index_key = next((key for key in id_keys if key in data), None)
+        index = data.pop(index_key) if index_key is not None else None
+        return pd.DataFrame(index=index, data=data)
+
+    def read(self, rows=None, columns=None):
+        """
+        Reads a subset of the dataset
+
+        Parameters
+        ----------
+        rows : ndarray, optional
+            Integer indices of the rows to read, all rows if None
+        columns : ndarray, optional
+            Integer indices of the columns to read, all columns if None.
+            Columns are selected while each chunk of rows is read.
+
+        Returns
+        -------
+        adata : anndata.AnnData
+            The subset, in the order of rows and columns. X is sparse if stored sparse.
+        """
+        rows = np.arange(self.shape[0]) if rows is None else np.asarray(rows, dtype=np.int64)
+        columns = None if columns is None else np.asarray(columns, dtype=np.int64)
+        var = self.var if columns is None else self.var.iloc[columns]
+        if self.format == 'mtx':
+            X = self._read_mtx(rows, columns)
+            return anndata.AnnData(X=X, obs=self.obs.iloc[rows].copy(), var=var.copy())
+        order = np.argsort(rows, kind='stable')
+        sorted_rows = rows[order]
+        if self.sparse_format == 'csc':
+            X = self._read_csc(sorted_rows, columns)
+        else:
+            chunks = []
+            for start in range(0, len(sorted_rows), self.chunk_size):
+                chunks.append(self._read_rows(sorted_rows[start:start + self.chunk_size], columns))
+            n_columns = self.shape[1] if columns is None else len(columns)
+            if self.sparse_format == 'csr':
+                X = scipy.sparse.vstack(chunks, format='csr') if chunks else scipy.sparse.csr_matrix(
+                    (0, n_columns), dtype=self.X['data'].dtype)
+            else:
+                X = np.vstack(chunks) if chunks else np.zeros((0, n_columns), dtype=self.X.dtype)
+        if np.any(order != np.arange(len(order))):
+            inverse = np.empty_like(order)
+            inverse[order] = np.arange(len(order))
+            X = X[inverse]
+        return anndata.AnnData(X=X, obs=self.obs.iloc[rows].copy(), var=var.copy())
+
+    def iter_row_blocks(self, chunk_size=None):
+        """
+        Iterates over the matrix in blocks of consecutive rows
+
+        Parameters
+        ----------
+        chunk_size : int, optional
+            Number of rows in each block, chunk_size of the reader if None
+
+        Yields
+        ------
+        start : int
+            Index of the first row of the block
+        X : ndarray or scipy.sparse.csr_matrix
+            The block
+        """
+        chunk_size = chunk_size or self.chunk_size
+        for start in range(0, self.shape[0], chunk_size):
+            rows = np.arange(start, min(start + chunk_size, self.shape[0]))
+            if self.format == 'mtx' or self.sparse_format == 'csc':
+                yield start, self.read(rows).X
+            else:
+                yield start, self._read_rows(rows, None)
+
+    def _read_rows(self, rows, columns):
+        # rows are sorted, each run of consecutive rows is read with a single slice
+        runs = _get_runs(rows)
+        if self.sparse_format == 'csr':
+            data = self.X['data']
+            indices = self.X['indices']
+            blocks = []
+            for start, end, _ in runs:
+                offset = self.indptr[start]
+                block = scipy.sparse.csr_matrix(
+                    (data[offset:self.indptr[end]], indices[offset:self.indptr[end]],
+                     self.indptr[start:end + 1] - offset), shape=(end - start, self.shape[1]))
+                blocks.append(block[:, columns] if columns is not None else block)
+            return scipy.sparse.vstack(blocks, format='csr')
+        blocks = []
+        for start, end, _ in runs:
+            if self.format == 'loom':
+                # loom matrices are stored genes by cells
+                block = self.X[:, start:end].T
+            else:
+                block = self.X[start:end]
+            blocks.append(block[:, columns] if columns is not None else block)
+        return np.vstack(blocks)
+
+    def _read_csc(self, rows, columns):
+        # columns are scanned in segments, keeping only the entries of the selected rows
+        columns = np.arange(self.shape[1]) if columns is None else columns
+        row_map = np.full(self.shape[0], -1, dtype=np.int64)
+        row_map[rows] = np.arange(len(rows))
+        selected_rows = []
+        selected_columns = []
+        selected_data = []
+        for i, j, v in _iter_csc_entries(self.X, self.indptr, columns, self.chunk_size * 100):
+            i = row_map[i]
+            keep = i >= 0
+            selected_rows.append(i[keep])
+            selected_columns.append(j[keep])
+            selected_data.append(v[keep])
+        if len(selected_data) == 0:
+            return scipy.sparse.csr_matrix((len(rows), len(columns)), dtype=self.X['data'].dtype)
+        return scipy.sparse.csr_matrix((np.concatenate(selected_data),
+                                        (np.concatenate(selected_rows), np.concatenate(selected_columns))),
+                                       shape=(len(rows), len(columns)))
+
+    def _read_mtx(self, rows, columns):
+        # position of each file row and column in the output, -1 if not selected
+        row_map = np.full(self.shape[0], -1, dtype=np.int64)
+        row_map[rows] = np.arange(len(rows))
+        if columns is None:
+            column_map = np.arange(self.shape[1])
+        else:
+            column_map = np.full(self.shape[1], -1, dtype=np.int64)
+            column_map[columns] = np.arange(len(columns))
+        selected_rows = []
+        selected_columns = []
+        selected_data = []
+        for chunk in pd.read_csv(self.path, sep=r'\s+', header=None, skiprows=self.mtx_header_lines + 1,
+                                 chunksize=self.chunk_size * 100, dtype={0: np.int64, 1: np.int64}):
+            i = chunk[0].values - 1
+            j = chunk[1].values - 1
+            if self.mtx_transposed:
+                i, j = j, i
+            i = row_map[i]
+            j = column_map[j]
+            keep = (i >= 0) & (j >= 0)
+            selected_rows.append(i[keep])
+            selected_columns.append(j[keep])
+            selected_data.append(chunk[2].values[keep] if chunk.shape[1] > 2 else np.ones(keep.sum()))
+        n_columns = self.shape[1] if columns is None else len(columns)
+        if len(selected_data) == 0:
+            return scipy.sparse.csr_matrix((len(rows), n_columns))
+        return scipy.sparse.csr_matrix((np.concatenate(selected_data),
+                                        (np.concatenate(selected_rows), np.concatenate(selected_columns))),
+                                       shape=(len(rows), n_columns))
@@ -1,14 +1,32 @@
 # -*- coding: utf-8 -*-
+import contextlib
+import csv
 import glob
+import gzip
+import logging
 import os
+import tempfile
 
 import anndata
+import h5py
 import numpy as np
 import pandas as pd
 import pegasus as pg
 import scipy.sparse
 import wot
 
+try:
+    import pyarrow
+
+    _has_pyarrow = True
+except ImportError:
+    _has_pyarrow = False
+
+logger = logging.getLogger('wot')
+
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 
 def group_cell_sets(cell_set_paths, group_by_df, group_by_key='day'):
     """
@@ -49,7 +67,7 @@ def group_cell_sets(cell_set_paths, group_by_df, group_by_key='day'):
         cell_set_ds = wot.io.read_sets(path)
         for i in range(cell_set_ds.shape[1]):
             cell_set_name = cell_set_ds.var.index.values[i]
-            cell_ids_in_set = cell_set_ds.obs.index.values[cell_set_ds[:, i].X > 0]
+            cell_ids_in_set = cell_set_ds.obs.index.values[_get_set_members(cell_set_ds.X, i)]
 
             grouped = group_by_df[group_by_df.index.isin(cell_ids_in_set)].groupby(group_by_key)
             for name, group in grouped:
@@ -181,25 +199,54 @@ def read_transport_maps(input_dir, ids=None, time=None):
     return transport_maps_inputs
 
 
-def read_sets(path, feature_ids=None, as_dict=False):
-    path = str(path)
-    hash_index = path.rfind('#')
-    set_names = None
-    if hash_index != -1:
-        set_names = path[hash_index + 1:].split(',')
-        path = path[0:hash_index]
+def _read_sets_file(path, feature_ids=None):
     ext = get_filename_and_extension(path)[1]
     if ext == 'gmt':
-        gs = read_gmt(path, feature_ids)
+        return read_gmt(path, feature_ids)
     elif ext == 'gmx':
-        gs = read_gmx(path, feature_ids)
+        return read_gmx(path, feature_ids)
     elif ext == 'txt' or ext == 'grp':
-        gs = read_grp(path, feature_ids)
+        return read_grp(path, feature_ids)
+    raise ValueError('Unknown file format "{}"'.format(ext))
+
+
+def read_sets(path, feature_ids=None, as_dict=False, set_names=None, cache=True):
+    """
+    Read gene or cell sets from a gmt, gmx or grp file
+
+    Parameters
+    ----------
+    path : str
+        Path to the sets. path#SET_A,SET_B selects sets by name.
+    feature_ids : list of str, optional
+        Ids to use as rows, matched ignoring case
+    as_dict : bool, optional
+        Return a dict that maps set name to member ids
+    set_names : list of str, optional
+        Names of the sets to include, combined with the names given in path
+    cache : bool, optional
+        Compile the file into an indexed library beside it (see get_set_library), so that later calls
+        only read the requested sets
+
+    Returns
+    -------
+    gs : anndata.AnnData
+        Features on rows and sets on columns, with a sparse membership matrix
+    """
+    path = str(path)
+    hash_index = path.rfind('#')
+    if hash_index != -1:
+        path_set_names = path[hash_index + 1:].split(',')
+        path = path[0:hash_index]
+        set_names = path_set_names if set_names is None else [name for name in path_set_names if
+                                                              name in set(set_names)]
+    if cache:
+        gs = wot.io.get_set_library(path).get_sets(set_names=set_names, feature_ids=feature_ids)
     else:
-        raise ValueError('Unknown file format "{}"'.format(ext))
-    if set_names is not None:
-        gs_filter = gs.var.index.isin(set_names)
-        gs = gs[:, gs_filter]
+        gs = _read_sets_file(path, feature_ids)
+        if set_names is not None:
+            gs_filter = gs.var.index.isin(set_names)
+            gs = gs[:, gs_filter]
     if as_dict:
         return wot.io.convert_binary_dataset_to_dict(gs)
     return gs
@@ -215,7 +262,7 @@ def read_grp(path, feature_ids=None):
                 row_id_lc_to_index[fid] = i
                 row_id_lc_to_row_id[fid] = feature_ids[i]
 
-        ids_in_set = set()
+        members = []
         for line in fp:
             if line == '' or line[0] == '#' or line[0] == '>':
                 continue
@@ -230,18 +277,14 @@ def read_grp(path, feature_ids=None):
                         row_id_lc_to_index[value_lc] = row_index
 
                 if row_index is not None:
-                    ids_in_set.add(value)
+                    members.append(row_index)
 
         if feature_ids is None:
             feature_ids = np.empty(len(row_id_lc_to_index), dtype='object')
             for rid_lc in row_id_lc_to_index:
                 feature_ids[row_id_lc_to_index[rid_lc]] = row_id_lc_to_row_id[rid_lc]
 
-        x = np.zeros(shape=(len(feature_ids), 1), dtype=np.int8)
-        for id in ids_in_set:
-            row_index = row_id_lc_to_index.get(id.lower())
-            x[row_index, 0] = 1
-
+        x = _get_set_matrix([members], len(feature_ids))
         obs = pd.DataFrame(index=feature_ids)
         var = pd.DataFrame(index=[wot.io.get_filename_and_extension(os.path.basename(path))[0]])
         return anndata.AnnData(X=x, obs=obs, var=var)
@@ -286,20 +329,14 @@ def read_gmt(path, feature_ids=None):
                             row_id_lc_to_index[value_lc] = row_index
 
                     if row_index is not None:
-                        ids_in_set.append(value)
+                        ids_in_set.append(row_index)
 
         if feature_ids is None:
             feature_ids = np.empty(len(row_id_lc_to_index), dtype='object')
             for rid_lc in row_id_lc_to_index:
                 feature_ids[row_id_lc_to_index[rid_lc]] = row_id_lc_to_row_id[rid_lc]
 
-        x = np.zeros(shape=(len(feature_ids), len(set_names)), dtype=np.int8)
-        for j in range(len(members_array)):
-            ids = members_array[j]
-            for id in ids:
-                row_index = row_id_lc_to_index.get(id.lower())
-                x[row_index, j] = 1
-
+        x = _get_set_matrix(members_array, len(feature_ids))
         obs = pd.DataFrame(index=feature_ids)
         var = pd.DataFrame(data={'description': set_descriptions}, index=set_names)
         return anndata.AnnData(X=x, obs=obs, var=var)
@@ -315,16 +352,12 @@ def read_gmx(path, feature_ids=None):
 
         row_id_lc_to_index = {}
         row_id_lc_to_row_id = {}
-        x = None
-        array_of_arrays = None
         if feature_ids is not None:
             for i in range(len(feature_ids)):
                 fid = feature_ids[i].lower()
                 row_id_lc_to_index[fid] = i
                 row_id_lc_to_row_id[fid] = feature_ids[i]
-            x = np.zeros(shape=(len(feature_ids), nsets), dtype=np.int8)
-        else:
-            array_of_arrays = []
+        members_array = [[] for _ in range(nsets)]
         for line in fp:
             tokens = line.split('\t')
             for j in range(nsets):
@@ -337,17 +370,14 @@ def read_gmx(path, feature_ids=None):
                             row_id_lc_to_row_id[value_lc] = value
                             row_index = len(row_id_lc_to_index)
                             row_id_lc_to_index[value_lc] = row_index
-                            array_of_arrays.append(np.zeros(shape=(nsets,), dtype=np.int8))
-                        array_of_arrays[row_index][j] = 1
-                    elif row_index is not None:
-                        x[row_index, j] = 1
+                    if row_index is not None:
+                        members_array[j].append(row_index)
         if feature_ids is None:
             feature_ids = np.empty(len(row_id_lc_to_index), dtype='object')
             for rid_lc in row_id_lc_to_index:
                 feature_ids[row_id_lc_to_index[rid_lc]] = row_id_lc_to_row_id[rid_lc]
 
-        if array_of_arrays is not None:
-            x = np.array(array_of_arrays)
+        x = _get_set_matrix(members_array, len(feature_ids))
         obs = pd.DataFrame(index=feature_ids)
         var = pd.DataFrame(data={'description': descriptions},
             index=set_ids)
@@ -368,15 +398,57 @@ def write_sets(sets, path):
             f.write('{}\t{}\t{}\n'.format(gset, '-', '\t'.join(sets[gset])))
 
 
+def _get_set_matrix(members_array, n_features):
+    """
+    Builds a sparse membership matrix with features on rows and sets on columns
+
+    Parameters
+    ----------
+    members_array : list of list of int
+        Row indices of the members of each set, possibly with duplicates
+    n_features : int
+        Number of rows
+
+    Returns
+    -------
+    x : scipy.sparse.csc_matrix
+        Matrix of int8 with a 1 for each member of each set
+    """
+    members_array = [np.unique(np.asarray(members, dtype=np.int64)) for members in members_array]
+    indptr = np.zeros(len(members_array) + 1, dtype=np.int64)
+    np.cumsum([len(members) for members in members_array], out=indptr[1:])
+    indices = np.concatenate(members_array) if members_array else np.zeros(0, dtype=np.int64)
+    return scipy.sparse.csc_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr),
+                                   shape=(n_features, len(members_array)))
+
+
+def _get_set_members(x, j, value=None):
+    """
+    Returns the row indices of the members of set j in a dense or sparse membership matrix
+
+    Members are the rows with a value equal to value if given, otherwise greater than 0.
+    """
+    if scipy.sparse.issparse(x):
+        column = scipy.sparse.csc_matrix(x[:, j])
+        selected = column.data == value if value is not None else column.data > 0
+        return np.sort(column.indices[selected])
+    column = np.asarray(x[:, j]).flatten()
+    return np.where(column == value if value is not None else column > 0)[0]
+
+
 def convert_binary_dataset_to_dict(ds):
     cell_sets = {}
+    x = ds.X
+    if scipy.sparse.issparse(x):
+        # column slices of a CSC matrix are cheap
+        x = scipy.sparse.csc_matrix(x)
     for i in range(ds.shape[1]):
-        selected = np.where(ds[:, i].X == 1)[0]
+        selected = _get_set_members(x, i, value=1)
         cell_sets[ds.var.index[i]] = list(ds.obs.index[selected])
     return cell_sets
 
 
-def read_dataset(path, obs=None, var=None, obs_filter=None, var_filter=None, **keywords):
+def read_dataset(path, obs=None, var=None, obs_filter=None, var_filter=None, cache=True, **keywords):
     """
     Read h5ad, loom, mtx, 10X h5, and csv formatted files
 
@@ -392,15 +464,42 @@ def read_dataset(path, obs=None, var=None, obs_filter=None, var_filter=None, **k
         File with one id per line, name of a boolean field in obs, or a list of ids
     var_filter: {str, pd.DataFrame}
         File with one id per line, name of a boolean field in obs, or a list of ids
+    cache: bool
+        Keep a binary copy of txt matrices next to the file, see get_cache_path
     Returns
     -------
     Annotated data matrix.
+
+    Notes
+    -----
+    When a filter is given, h5ad and loom files are filtered while reading, so that only the selected rows and
+    columns are loaded. Other formats are filtered after reading, so that ids are the same with and without
+    a filter.
     """
+    reader = None
+    adata = None
+    has_filter = obs_filter is not None or var_filter is not None
     if str(path).lower().endswith('.txt'):
-        df = pd.read_csv(path, engine='python', header=0, sep=None, index_col=0)
-        adata = anndata.AnnData(X=df.values, obs=pd.DataFrame(index=df.index), var=pd.DataFrame(index=df.columns))
+        cache_path = None
+        if cache and os.path.isfile(path):
+            cache_path, adata = _update_cache(path)
+        if cache_path is None and adata is None:
+            adata = _read_txt_matrix(path)
+        elif adata is None and has_filter:
+            reader = wot.io.DatasetReader(cache_path)
+        elif adata is None:
+            adata = anndata.read_h5ad(cache_path)
+    elif has_filter and len(keywords) == 0 and wot.io.DatasetReader.get_format(path) in ('h5ad', 'loom'):
+        # pegasus renames 10x and mtx ids (gene symbols, barcodes without suffix), which DatasetReader does not
+        reader = wot.io.DatasetReader(path)
+    elif str(path).lower().endswith(('.mtx', '.mtx.gz')) and os.path.exists(_get_mtx_prefix(path) + '.barcodes.tsv'):
+        # written by write_dataset
+        with wot.io.DatasetReader(path) as mtx_reader:
+            adata = mtx_reader.read()
     else:
         adata = pg.read_input(path, **keywords)
+    if reader is not None:
+        adata = anndata.AnnData(obs=reader.obs, var=reader.var)
 
     def get_df(meta):
         if not isinstance(meta, pd.DataFrame):
@@ -408,7 +507,7 @@ def read_dataset(path, obs=None, var=None, obs_filter=None, var_filter=None, **k
             if meta.startswith('gs://'):
                 tmp_path = download_gs_url(meta)
                 meta = tmp_path
-            meta = pd.read_csv(meta, sep=None, index_col='id', engine='python')
+            meta = read_table(meta, index_col='id', dtype={'id': str})
             if tmp_path is not None:
                 os.remove(tmp_path)
         return meta
@@ -424,21 +523,248 @@ def read_dataset(path, obs=None, var=None, obs_filter=None, var_filter=None, **k
         for item in var:
             adata.var = adata.var.join(get_df(item))
 
+    if reader is not None:
+        with reader:
+            obs_indices = np.where(_get_filter_mask(adata.obs, obs_filter))[0] if obs_filter is not None else None
+            var_indices = np.where(_get_filter_mask(adata.var, var_filter))[0] if var_filter is not None else None
+            subset = reader.read(obs_indices, var_indices)
+        return anndata.AnnData(X=subset.X,
+                               obs=adata.obs.iloc[obs_indices] if obs_indices is not None else adata.obs,
+                               var=adata.var.iloc[var_indices] if var_indices is not None else adata.var)
     return filter_adata(adata, obs_filter=obs_filter, var_filter=var_filter)
 
 
-def write_dataset(ds, path, output_format='txt'):
+def _read_txt_matrix(path):
+    df = read_table(path, header=0, index_col=0)
+    return anndata.AnnData(X=df.values, obs=pd.DataFrame(index=df.index.astype(str)),
+                           var=pd.DataFrame(index=df.columns.astype(str)))
+
+
+CACHE_SUFFIX = '.cache.h5ad'
+
+
+def get_cache_path(path, suffix=CACHE_SUFFIX):
+    """
+    Returns the path of the hidden binary copy of the text file at path, in the same directory.
+
+    The copy is an HDF5 file that records the size and modification time of the text file it was made from,
+    and is rewritten when the text file changes. Text matrices are copied to h5ad files, set files to
+    libraries with the suffix wot.io.SET_LIBRARY_SUFFIX.
+    """
+    directory, name = os.path.split(str(path))
+    return os.path.join(directory, '.' + name + suffix)
+
+
+def _get_cache_source(path):
+    stat = os.stat(path)
+    return '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def _is_cache_current(cache_path, source):
+    if os.path.exists(cache_path):
+        try:
+            with h5py.File(cache_path, 'r') as f:
+                return f.attrs.get('wot_source') == source
+        except OSError:
+            pass
+    return False
+
+
+def _update_cache(path):
+    """
+    Returns the path of an up to date binary copy of a text matrix, and the parsed matrix if the copy was
+    (re)written. The path is None if the copy cannot be written.
+    """
+    cache_path = get_cache_path(path)
+    source = _get_cache_source(path)
+    if _is_cache_current(cache_path, source):
+        return cache_path, None
+    adata = _read_txt_matrix(path)
+    tmp_path = None
+    try:
+        tmp_path = get_partial_path(cache_path)
+        adata.write_h5ad(tmp_path)
+        with h5py.File(tmp_path, 'a') as f:
+            f.attrs['wot_source'] = source
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning('Unable to write {}: {}'.format(cache_path, e))
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None, adata
+    return cache_path, adata
+
+
+def read_dataset_obs(path):
+    """
+    Read the row metadata of a dataset. Only the metadata is read from h5ad files.
+    """
+    if str(path).lower().endswith('.h5ad'):
+        adata = anndata.read_h5ad(path, backed='r')
+        obs = adata.obs.copy()
+        adata.file.close()
+        return obs
+    return read_dataset(path).obs
+
+
+def write_dataset(ds, path, output_format='txt', atomic=False, compress=False, float_format=None,
+                  chunk_size=None):
+    """
+    Write a dataset
+
+    Parameters
+    ----------
+    ds : anndata.AnnData
+        The dataset
+    path : str
+        Output path. The output_format extension is appended if missing.
+    output_format : str
+        h5ad, loom, gct, txt or mtx. txt and mtx are written in blocks of rows, without densifying or copying
+        the whole matrix. mtx writes the non-zero entries as a Matrix Market coordinate file, with the row and
+        column ids in path.barcodes.tsv and path.genes.tsv.
+    atomic : bool
+        Write to a temporary file in the same directory and rename it to path once complete,
+        so that an interrupted write never leaves a partial file at path.
+    compress : bool
+        Gzip txt and mtx output. '.gz' is appended to path.
+    float_format : str, optional
+        Format string for floating point numbers in txt and mtx output, for example '%.6g'.
+        Numbers are written with full precision by default.
+    chunk_size : int, optional
+        Number of rows per block for txt and mtx output. Defaults to about a million values per block.
+    """
     path = str(path)
-    if not path.lower().endswith('.' + output_format):
+    if not path.lower().endswith('.' + output_format) and not path.lower().endswith('.' + output_format + '.gz'):
         path += '.' + output_format
-    if output_format == 'txt':
-        x = ds.X.toarray() if scipy.sparse.isspmatrix(ds.X) else ds.X
-        pd.DataFrame(x, index=ds.obs.index, columns=ds.var.index).to_csv(path,
-            index_label='id', sep='\t', doublequote=False)
+    if compress and output_format in ('txt', 'mtx') and not path.lower().endswith('.gz'):
+        path += '.gz'
+    if atomic:
+        tmp_path = get_partial_path(path)
+        # mtx ids are written beside the matrix and renamed with it
+        suffixes = ['.barcodes.tsv', '.genes.tsv'] if output_format == 'mtx' else []
+        tmp_files = [(tmp_path, path)] + [(_get_mtx_prefix(tmp_path) + suffix, _get_mtx_prefix(path) + suffix) for
+                                          suffix in suffixes]
+        try:
+            write_dataset(ds, tmp_path, output_format=output_format, compress=compress, float_format=float_format,
+                          chunk_size=chunk_size)
+            for src, dst in tmp_files[1:] + tmp_files[:1]:  # the matrix last
+                os.replace(src, dst)
+        finally:
+            for src, _ in tmp_files:
+                if os.path.exists(src):
+                    os.remove(src)
+        return
+    if output_format in ('txt', 'mtx'):
+        if chunk_size is None:
+            chunk_size = max(1, 1000000 // max(1, ds.shape[1]))
+        opener = gzip.open if path.lower().endswith('.gz') else open
+        with opener(path, 'wt') as f:
+            if output_format == 'txt':
+                _write_txt(ds, f, float_format, chunk_size)
+            else:
+                _write_mtx(ds, f, float_format, chunk_size)
+        if output_format == 'mtx':
+            prefix = _get_mtx_prefix(path)
+            pd.Series(ds.obs.index).to_csv(prefix + '.barcodes.tsv', index=False, header=False)
+            pd.Series(ds.var.index).to_csv(prefix + '.genes.tsv', index=False, header=False)
     else:
         pg.write_output(ds, path)
 
 
+@contextlib.contextmanager
+def h5ad_array_writer(path, obs, var, chunk_size=1000, dtype=np.float64):
+    """
+    Creates an h5ad file whose dense X is filled in blocks, so that X is never held in memory.
+
+    obs and var are written first, the h5py dataset X is yielded to be assigned by slices. The file is
+    written to a temporary file in the same directory and renamed to path once the block exits without error.
+
+    Parameters
+    ----------
+    path : str
+        Output path. The h5ad extension is appended if missing.
+    obs : pandas.DataFrame
+        Row metadata
+    var : pandas.DataFrame
+        Column metadata
+    chunk_size : int, optional
+        Number of rows in each HDF5 chunk of X
+    dtype : numpy.dtype, optional
+        Type of X
+
+    Yields
+    ------
+    X : h5py.Dataset
+        The obs by var matrix, initially filled with zeros
+    """
+    path = check_file_extension(str(path), 'h5ad')
+    partial_path = get_partial_path(path)
+    # h5ad indexes must be strings
+    obs = obs.set_axis(obs.index.astype(str), axis=0)
+    var = var.set_axis(var.index.astype(str), axis=0)
+    try:
+        anndata.AnnData(obs=obs, var=var).write_h5ad(partial_path)
+        with h5py.File(partial_path, 'a') as f:
+            if 'X' in f:
+                del f['X']
+            X = f.create_dataset('X', shape=(obs.shape[0], var.shape[0]), dtype=dtype,
+                                 chunks=(max(1, min(chunk_size, obs.shape[0])), max(1, min(1024, var.shape[0]))))
+            X.attrs['encoding-type'] = 'array'
+            X.attrs['encoding-version'] = '0.2.0'
+            yield X
+        os.replace(partial_path, path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def _get_mtx_prefix(path):
+    path = str(path)
+    return path[:-len('.mtx.gz')] if path.lower().endswith('.mtx.gz') else path[:-len('.mtx')]
+
+
+def _iter_row_blocks(X, chunk_size):
+    for start in range(0, X.shape[0], chunk_size):
+        yield start, X[start:start + chunk_size]
+
+
+def _write_txt(ds, f, float_format, chunk_size):
+    X = ds.X.tocsr() if scipy.sparse.issparse(ds.X) and not scipy.sparse.isspmatrix_csr(ds.X) else ds.X
+    if ds.shape[0] == 0:
+        pd.DataFrame(columns=ds.var.index).to_csv(f, index_label='id', sep='\t')
+    for start, block in _iter_row_blocks(X, chunk_size):
+        block = block.toarray() if scipy.sparse.issparse(block) else np.asarray(block)
+        pd.DataFrame(block, index=ds.obs.index[start:start + block.shape[0]], columns=ds.var.index).to_csv(
+            f, header=start == 0, index_label='id', sep='\t', doublequote=False, float_format=float_format)
+
+
+def _write_mtx(ds, f, float_format, chunk_size):
+    X = ds.X.tocsr() if scipy.sparse.issparse(ds.X) and not scipy.sparse.isspmatrix_csr(ds.X) else ds.X
+    is_integer = np.issubdtype(X.dtype, np.integer)
+    nnz = X.nnz if scipy.sparse.issparse(X) else sum(
+        np.count_nonzero(block) for _, block in _iter_row_blocks(X, chunk_size))
+    f.write('%%MatrixMarket matrix coordinate {} general\n'.format('integer' if is_integer else 'real'))
+    f.write('{} {} {}\n'.format(X.shape[0], X.shape[1], nnz))
+    for start, block in _iter_row_blocks(X, chunk_size):
+        block = scipy.sparse.coo_matrix(block)
+        pd.DataFrame({'i': block.row + start + 1, 'j': block.col + 1, 'v': block.data}).to_csv(
+            f, sep=' ', header=False, index=False, float_format=float_format)
+
+
+def get_partial_path(path):
+    """
+    Creates an empty hidden temporary file, in the same directory as path and with the same extension, to write
+    path to before renaming it. The name is unique, so that processes writing path concurrently never write to
+    the same temporary file.
+    """
+    directory, name = os.path.split(str(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix='.partial-', suffix='-' + name)
+    os.close(fd)
+    # mkstemp creates the file readable by its owner only, use the permissions of a regular file instead
+    os.chmod(tmp_path, 0o666 & ~_UMASK)
+    return tmp_path
+
+
 def download_gs_url(gs_url):
     from google.cloud import storage
     client = storage.Client()
@@ -483,31 +809,81 @@ def get_filename_and_extension(name):
     return basename, ext
 
 
+def _get_filter_mask(df, id_filter):
+    """
+    Returns a boolean array selecting the rows of df that pass id_filter: a file with one id per line,
+    the name of a boolean field in df, or a comma separated list of ids.
+    """
+    if not isinstance(id_filter, str):
+        return df.index.isin(id_filter)
+    if os.path.exists(id_filter):
+        return df.index.isin(wot.io.read_sets(id_filter, cache=False).obs.index)
+    id_filter = id_filter.split(',')
+    if len(id_filter) == 1 and id_filter[0] in df:  # boolean field
+        return (df[id_filter[0]] == True).values
+    return df.index.isin(id_filter)  # list of ids
+
+
 def filter_adata(adata, obs_filter=None, var_filter=None):
     if obs_filter is not None:
-        if os.path.exists(obs_filter):
-            adata = adata[adata.obs.index.isin(wot.io.read_sets(obs_filter).obs.index)].copy()
-        else:
-            obs_filter = obs_filter.split(',')
-            if len(obs_filter) == 1 and obs_filter[0] in adata.obs:  # boolean field in obs
-                adata = adata[adata.obs[obs_filter] == True].copy()
-            else:  # list of ids
-                adata = adata[adata.obs.index.isin(obs_filter)].copy()
+        adata = adata[_get_filter_mask(adata.obs, obs_filter)].copy()
     if var_filter is not None:
-        if os.path.exists(var_filter):
-            adata = adata[:, adata.var.index.isin(wot.io.read_sets(var_filter).obs.index)].copy()
-        else:
-            var_filter = var_filter.split(',')
-            if len(var_filter) == 1 and var_filter[0] in adata.var:  # boolean field in var
-                adata = adata[:, adata.var[var_filter[0]]].copy()
-            else:  # list of ids
-                adata = adata[:, adata.var.index.isin(var_filter)].copy()
+        adata = adata[:, _get_filter_mask(adata.var, var_filter)].copy()
     return adata
 
 
+def _sniff_delimiter(path, sample_size):
+    opener = gzip.open if str(path).lower().endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        sample = f.read(sample_size)
+    if len(sample) == sample_size and '\n' in sample:  # only sniff complete lines
+        sample = sample[:sample.rindex('\n')]
+    try:
+        return csv.Sniffer().sniff(sample, delimiters='\t,; ').delimiter
+    except csv.Error:
+        first_line = sample.split('\n', 1)[0]
+        return '\t' if '\t' in first_line else ',' if ',' in first_line else None
+
+
+def read_table(path, sep=None, index_col=None, header='infer', dtype=None, sample_size=65536):
+    """
+    Reads a delimited text table such as cell days, growth rates or other metadata
+
+    The delimiter is sniffed from the first sample_size characters only, and the table is then parsed with
+    pyarrow if installed, otherwise with the C parser.
+
+    Parameters
+    ----------
+    path : str
+        Path to a delimited text file, optionally gzipped
+    sep : str, optional
+        The delimiter. Sniffed if None
+    index_col : int or str, optional
+        The column to use as index
+    header : int or None, optional
+        Row number to use as column names, None if the file has no header
+    dtype : dict, optional
+        Column name to dtype. Columns that are missing in the file are ignored.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The table
+    """
+    if sep is None:
+        sep = _sniff_delimiter(path, sample_size)
+    if sep is None or sep == ' ':
+        return pd.read_csv(path, sep=r'\s+', index_col=index_col, header=header, dtype=dtype)
+    if _has_pyarrow:
+        try:
+            return pd.read_csv(path, sep=sep, index_col=index_col, header=header, dtype=dtype, engine='pyarrow')
+        except ValueError:
+            pass  # options or content not supported by pyarrow
+    return pd.read_csv(path, sep=sep, index_col=index_col, header=header, dtype=dtype, engine='c')
+
+
 def read_days_data_frame(path):
-    return pd.read_csv(path, index_col='id',
-        engine='python', sep=None, dtype={'day': np.float64})
+    return read_table(path, index_col='id', dtype={'id': str, 'day': np.float64})
 
 
 def add_row_metadata_to_dataset(dataset, days=None, growth_rates=None, covariate=None):
@@ -518,7 +894,8 @@ def add_row_metadata_to_dataset(dataset, days=None, growth_rates=None, covariate
     if growth_rates is not None:
         if not os.path.exists(growth_rates):
             raise ValueError(growth_rates + ' not found')
-        dataset.obs = dataset.obs.join(pd.read_csv(growth_rates, index_col='id', engine='python', sep=None))
+        dataset.obs = dataset.obs.join(
+            read_table(growth_rates, index_col='id', dtype={'id': str, 'cell_growth_rate': np.float64}))
         # if 'cell_growth_rate' not in dataset.obs:
         #     raise ValueError('Cell growth rates must that the column headers id and cell_growth_rate')
     else:
@@ -529,15 +906,11 @@ def add_row_metadata_to_dataset(dataset, days=None, growth_rates=None, covariate
     if covariate is not None:
         if not os.path.exists(covariate):
             raise ValueError(covariate + ' not found')
-        dataset.obs = dataset.obs.join(pd.read_csv(covariate, index_col='id', engine='python', sep=None))
+        dataset.obs = dataset.obs.join(read_table(covariate, index_col='id', dtype={'id': str}))
 
 
 def read_day_pairs(day_pairs):
     if os.path.isfile(day_pairs):
-        target = day_pairs
-        args = {'engine': 'python', 'sep': None}
-    else:
-        import io
-        target = io.StringIO(day_pairs)
-        args = {'sep': ',', 'lineterminator': ';'}
-    return pd.read_csv(target, **args)
+        return read_table(day_pairs)
+    import io
+    return pd.read_csv(io.StringIO(day_pairs), sep=',', lineterminator=';')
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+import io
+import logging
+import os
+
+import anndata
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from .dataset_reader import _get_runs
+from .io import _get_cache_source, _is_cache_current, _read_sets_file, get_cache_path, get_partial_path
+
+logger = logging.getLogger('wot')
+
+SET_LIBRARY_SUFFIX = '.sets.h5'
+
+
+def _encode(ids):
+    values = np.char.encode(np.asarray(ids, dtype=str), 'utf-8')
+    # h5py can not store zero length strings
+    return values.astype('S{}'.format(max(1, values.dtype.itemsize)))
+
+
+def _decode(values):
+    return np.char.decode(values, 'utf-8').astype(object)
+
+
+def _search(sorted_values, order, values):
+    """
+    Finds all positions of values in the original order of sorted_values. Values that are not found are ignored.
+
+    Returns
+    -------
+    positions : ndarray
+        Original positions of the matches
+    matches : ndarray
+        Index in values of each match
+    """
+    start = np.searchsorted(sorted_values, values, side='left')
+    counts = np.searchsorted(sorted_values, values, side='right') - start
+    matches = np.repeat(np.arange(len(values)), counts)
+    offsets = np.arange(len(matches)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return order[np.repeat(start, counts) + offsets], matches
+
+
+class SetLibrary:
+    """
+    Gene or cell sets compiled to an indexed HDF5 file, so that a few sets can be read by name without parsing
+    the whole source file.
+
+    The library holds the feature ids of all sets, the members of each set as a sets by features CSR matrix,
+    and the set names and descriptions. Feature ids (ignoring case) and set names are also stored sorted,
+    and are looked up with binary search. Use get_set_library to compile a gmt, gmx or grp file once into
+    a library stored beside it.
+
+    Parameters
+    ----------
+    path : str or file-like object
+        Library written by SetLibrary.write
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with h5py.File(self.path, 'r') as f:
+            self.shape = (f['features'].shape[0], f['names'].shape[0])
+
+    @staticmethod
+    def write(gs, path):
+        """
+        Compiles a membership matrix as returned by read_sets to path
+
+        Parameters
+        ----------
+        gs : anndata.AnnData
+            Features on rows and sets on columns. Feature ids must be unique ignoring case.
+        path : str or file-like object
+            Output library
+        """
+        x = scipy.sparse.csc_matrix(gs.X, dtype=np.int8)
+        x.eliminate_zeros()
+        x.sort_indices()
+        features = np.asarray(gs.obs.index.values, dtype=str)
+        features_lc = _encode(np.char.lower(features))
+        names = _encode(gs.var.index.values)
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('features', data=_encode(features))
+            order = np.argsort(features_lc, kind='stable')
+            f.create_dataset('features_lc_sorted', data=features_lc[order])
+            f.create_dataset('features_lc_order', data=order)
+            f.create_dataset('names', data=names)
+            order = np.argsort(names, kind='stable')
+            f.create_dataset('names_sorted', data=names[order])
+            f.create_dataset('names_order', data=order)
+            if 'description' in gs.var:
+                f.create_dataset('descriptions', data=_encode(gs.var['description'].values))
+            # the CSC features by sets matrix is the CSR sets by features matrix
+            f.create_dataset('indptr', data=x.indptr.astype(np.int64))
+            f.create_dataset('indices', data=x.indices.astype(np.int32))
+
+    def get_sets(self, set_names=None, feature_ids=None):
+        """
+        Returns the membership matrix of the given sets
+
+        Parameters
+        ----------
+        set_names : list of str, optional
+            Names of the sets to include, all sets if None. Names that are not in the library are ignored.
+        feature_ids : list of str, optional
+            Feature ids to use as rows, matched ignoring case. All features in the library if None.
+
+        Returns
+        -------
+        gs : anndata.AnnData
+            Features on rows and sets on columns, in library order, with a sparse CSC matrix
+        """
+        with h5py.File(self.path, 'r') as f:
+            if set_names is None:
+                sets = np.arange(self.shape[1])
+            else:
+                sets = _search(f['names_sorted'][()], f['names_order'][()], _encode(list(set_names)))[0]
+                sets = np.unique(sets)
+            indptr = f['indptr'][()]
+            lengths = indptr[sets + 1] - indptr[sets]
+            if len(sets) == self.shape[1]:
+                indices = f['indices'][()]
+                names = f['names'][()]
+                descriptions = f['descriptions'][()] if 'descriptions' in f else None
+            else:
+                # sets are sorted, consecutive sets are read with a single slice
+                blocks = [f['indices'][indptr[start]:indptr[end]] for start, end, _ in _get_runs(sets)]
+                indices = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.int32)
+                names = f['names'][sets] if len(sets) > 0 else np.zeros(0, dtype='S1')
+                descriptions = (f['descriptions'][sets] if len(sets) > 0 else np.zeros(0, dtype='S1')) if \
+                    'descriptions' in f else None
+            if feature_ids is None:
+                features = _decode(f['features'][()])
+            else:
+                features = np.asarray(feature_ids)
+                positions, rows = _search(f['features_lc_sorted'][()], f['features_lc_order'][()],
+                                          _encode(np.char.lower(np.asarray(features, dtype=str))))
+        set_indptr = np.zeros(len(sets) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=set_indptr[1:])
+        x = scipy.sparse.csc_matrix((np.ones(len(indices), dtype=np.int8), indices, set_indptr),
+                                    shape=(self.shape[0], len(sets)))
+        if feature_ids is not None:
+            # one entry per row of feature_ids that matches a library feature
+            alignment = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, positions)),
+                                                shape=(len(features), self.shape[0]))
+            x = scipy.sparse.csc_matrix(alignment.dot(x))
+        var = pd.DataFrame(index=_decode(names),
+                           data={'description': _decode(descriptions)} if descriptions is not None else None)
+        return anndata.AnnData(X=x, obs=pd.DataFrame(index=features), var=var)
+
+
+def get_set_library(path):
+    """
+    Returns the compiled library of a gmt, gmx or grp file.
+
+    The library is stored as a hidden file beside path and rewritten when path changes. If the library
+    cannot be written there, it is compiled in memory.
+
+    Parameters
+    ----------
+    path : str
+        gmt, gmx or grp file
+
+    Returns
+    -------
+    library : SetLibrary
+    """
+    path = str(path)
+    cache_path = get_cache_path(path, SET_LIBRARY_SUFFIX)
+    source = _get_cache_source(path)
+    if _is_cache_current(cache_path, source):
+        return SetLibrary(cache_path)
+    gs = _read_sets_file(path)
+    tmp_path = None
+    try:
+        tmp_path = get_partial_path(cache_path)
+        SetLibrary.write(gs, tmp_path)
+        with h5py.File(tmp_path, 'a') as f:
+            f.attrs['wot_source'] = source
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning('Unable to write {}: {}'.format(cache_path, e))
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        buffer = io.BytesIO()
+        SetLibrary.write(gs, buffer)
+        return SetLibrary(buffer)
+    return SetLibrary(cache_path)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import time
+
+import anndata
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import wot
+from .dataset_reader import _iter_csc_entries
+from .io import _sniff_delimiter, get_partial_path
+
+logger = logging.getLogger('wot')
+
+
+class _CSRWriter:
+    """
+    Appends blocks of rows to a CSR matrix stored in resizable, chunked HDF5 datasets.
+    """
+
+    def __init__(self, group, n_columns):
+        self.group = group
+        self.n_columns = n_columns
+        self.data = None
+        self.indices = None
+        self.indptr = [np.zeros(1, dtype=np.int64)]
+        self.nnz = 0
+        self.n_rows = 0
+
+    def _create_datasets(self, dtype):
+        self.data = self.group.create_dataset('data', shape=(0,), maxshape=(None,), dtype=dtype, chunks=(1 << 16,))
+        self.indices = self.group.create_dataset('indices', shape=(0,), maxshape=(None,), dtype=np.int64,
+                                                 chunks=(1 << 16,))
+
+    def _promote(self, dtype):
+        # rewrite the data written so far when a block needs a wider type, e.g. floats after integers
+        dtype = np.promote_types(self.data.dtype, dtype)
+        if dtype == self.data.dtype:
+            return
+        data = self.group.create_dataset('data_promoted', shape=(self.nnz,), maxshape=(None,), dtype=dtype,
+                                         chunks=(1 << 16,))
+        for start in range(0, self.nnz, 1 << 20):
+            data[start:start + (1 << 20)] = self.data[start:start + (1 << 20)]
+        del self.group['data']
+        self.group.move('data_promoted', 'data')
+        self.data = data
+
+    def append(self, X):
+        X = scipy.sparse.csr_matrix(X)
+        X.sum_duplicates()
+        X.eliminate_zeros()
+        if self.data is None:
+            self._create_datasets(X.dtype)
+        else:
+            self._promote(X.dtype)
+        self.data.resize((self.nnz + X.nnz,))
+        self.indices.resize((self.nnz + X.nnz,))
+        self.data[self.nnz:] = X.data
+        self.indices[self.nnz:] = X.indices
+        self.indptr.append(X.indptr[1:].astype(np.int64) + self.nnz)
+        self.nnz += X.nnz
+        self.n_rows += X.shape[0]
+
+    def close(self):
+        if self.data is None:
+            self._create_datasets(np.float64)
+        self.group.create_dataset('indptr', data=np.concatenate(self.indptr))
+        shape = (self.n_rows, self.n_columns)
+        self.group.attrs['encoding-type'] = 'csr_matrix'
+        self.group.attrs['encoding-version'] = '0.1.0'
+        self.group.attrs['shape'] = shape
+        self.group.attrs['h5sparse_format'] = 'csr'
+        self.group.attrs['h5sparse_shape'] = shape
+
+
+class _Progress:
+    def __init__(self, total, name):
+        self.total = total
+        self.name = name
+        self.count = 0
+        self.start = time.time()
+
+    def update(self, n):
+        self.count += n
+        elapsed = max(time.time() - self.start, 1e-9)
+        total = '/{}'.format(self.total) if self.total is not None else ''
+        logger.info('{}: {}{} rows ({:.0f} rows/s)'.format(self.name, self.count, total, self.count / elapsed))
+
+
+def _iter_txt(path, chunk_size):
+    sep = _sniff_delimiter(path, 65536)
+    for df in pd.read_csv(path, sep=sep if sep not in (None, ' ') else r'\s+', index_col=0, chunksize=chunk_size):
+        yield df.index.astype(str), df.columns.astype(str), scipy.sparse.csr_matrix(df.values)
+
+
+def _iter_reader(reader, chunk_size):
+    for start in range(0, reader.shape[0], chunk_size):
+        rows = np.arange(start, min(start + chunk_size, reader.shape[0]))
+        yield scipy.sparse.csr_matrix(reader.read(rows).X)
+
+
+def _iter_mtx_entries(reader, chunk_size):
+    for chunk in pd.read_csv(reader.path, sep=r'\s+', header=None, skiprows=reader.mtx_header_lines + 1,
+                             chunksize=chunk_size * 100, dtype={0: np.int64, 1: np.int64}):
+        i = chunk[0].values - 1
+        j = chunk[1].values - 1
+        if reader.mtx_transposed:
+            i, j = j, i
+        yield i, j, chunk[2].values if chunk.shape[1] > 2 else np.ones(len(i))
+
+
+def _iter_csr_entries(group, chunk_size):
+    # entries of the transposed matrix
+    indptr = group['indptr'][()]
+    data = group['data']
+    indices = group['indices']
+    for start in range(0, len(indptr) - 1, chunk_size):
+        end = min(start + chunk_size, len(indptr) - 1)
+        lengths = np.diff(indptr[start:end + 1])
+        rows = np.repeat(np.arange(start, end), lengths)
+        yield indices[indptr[start]:indptr[end]], rows, data[indptr[start]:indptr[end]]
+
+
+def _write_entries(entries, shape, writer, max_entries, name, spill_path):
+    """
+    Writes a matrix given in arbitrary entry order to writer in row order, holding at most max_entries entries.
+
+    entries is a function returning a new iterator over (row, column, value) arrays. It is called twice: once
+    to count the entries of each row, and once to bucket the entries by row into memory mapped spill files at
+    spill_path (a counting sort). The rows are then appended to writer in blocks read from the spill files.
+    """
+    counts = np.zeros(shape[0], dtype=np.int64)
+    dtype = None
+    for i, _, v in entries():
+        counts += np.bincount(i, minlength=shape[0])
+        dtype = v.dtype if dtype is None else np.promote_types(dtype, v.dtype)
+    indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    nnz = int(indptr[-1])
+    progress = _Progress(shape[0], name)
+    if nnz == 0:
+        writer.append(scipy.sparse.csr_matrix(shape, dtype=dtype or np.float64))
+        progress.update(shape[0])
+        return
+    spilled_columns = np.memmap(spill_path + '.indices', dtype=np.int64, mode='w+', shape=(nnz,))
+    spilled_values = np.memmap(spill_path + '.data', dtype=dtype, mode='w+', shape=(nnz,))
+    try:
+        # next free position of each row
+        position = indptr[:-1].copy()
+        for i, j, v in entries():
+            order = np.argsort(i, kind='stable')
+            i = i[order]
+            # rank of each entry among the entries of its row in this chunk
+            ranks = np.arange(len(i)) - np.searchsorted(i, i, side='left')
+            positions = position[i] + ranks
+            spilled_columns[positions] = j[order]
+            spilled_values[positions] = v[order]
+            position += np.bincount(i, minlength=shape[0])
+        # split rows into blocks of at most max_entries entries
+        start = 0
+        while start < shape[0]:
+            end = int(np.searchsorted(indptr, indptr[start] + max_entries, side='right')) - 1
+            end = min(shape[0], max(end, start + 1))
+            offset = indptr[start]
+            X = scipy.sparse.csr_matrix((np.array(spilled_values[offset:indptr[end]]),
+                                         np.array(spilled_columns[offset:indptr[end]]),
+                                         indptr[start:end + 1] - offset), shape=(end - start, shape[1]))
+            writer.append(X)
+            progress.update(end - start)
+            start = end
+    finally:
+        del spilled_columns, spilled_values
+        for suffix in ('.indices', '.data'):
+            if os.path.exists(spill_path + suffix):
+                os.remove(spill_path + suffix)
+
+
+def convert_to_h5ad(path, out, obs=None, var=None, transpose=False, chunk_size=10000, max_entries=50000000):
+    """
+    Converts a matrix to h5ad without loading it in memory.
+
+    Rows are read in chunks and appended to a sparse, chunked X. The type of X is promoted as needed, e.g. when
+    integer rows are followed by floating point rows. mtx entries and CSC matrices are reordered and matrices are
+    transposed on disk, in two passes over the input, holding at most max_entries non-zero entries in memory.
+
+    Parameters
+    ----------
+    path : str
+        txt, mtx, h5ad, loom or 10x h5 matrix
+    out : str
+        Output h5ad path
+    obs : list of pandas.DataFrame, optional
+        Row metadata to join with the ids in the matrix
+    var : list of pandas.DataFrame, optional
+        Column metadata to join with the ids in the matrix
+    transpose : bool, optional
+        Transpose the matrix before saving
+    chunk_size : int, optional
+        Number of rows read at once
+    max_entries : int, optional
+        Maximum number of non-zero entries held in memory when reordering mtx entries or transposing
+    """
+    out = str(out)
+    if not out.lower().endswith('.h5ad'):
+        out += '.h5ad'
+    tmp_path = get_partial_path(out + '.X')
+    partial_out = get_partial_path(out)
+    try:
+        with h5py.File(tmp_path, 'w') as f:
+            writer = _CSRWriter(f.create_group('X'), 0)
+            if str(path).lower().endswith('.txt'):
+                row_ids = []
+                column_ids = None
+                progress = _Progress(None, path)
+                for ids, columns, X in _iter_txt(path, chunk_size):
+                    column_ids = columns
+                    writer.n_columns = X.shape[1]
+                    row_ids.append(ids)
+                    writer.append(X)
+                    progress.update(X.shape[0])
+                obs_df = pd.DataFrame(index=np.concatenate(row_ids) if row_ids else [])
+                var_df = pd.DataFrame(index=column_ids)
+            else:
+                with wot.io.DatasetReader(path, chunk_size=chunk_size) as reader:
+                    obs_df = reader.obs
+                    var_df = reader.var
+                    writer.n_columns = reader.shape[1]
+                    if reader.format == 'mtx':
+                        _write_entries(lambda: _iter_mtx_entries(reader, chunk_size), reader.shape, writer,
+                                       max_entries, path, tmp_path + '.spill')
+                    elif reader.sparse_format == 'csc':
+                        _write_entries(lambda: _iter_csc_entries(reader.X, reader.indptr, np.arange(reader.shape[1]),
+                                                                 chunk_size * 100), reader.shape, writer, max_entries,
+                                       path, tmp_path + '.spill')
+                    else:
+                        progress = _Progress(reader.shape[0], path)
+                        for X in _iter_reader(reader, chunk_size):
+                            writer.append(X)
+                            progress.update(X.shape[0])
+            writer.close()
+            if transpose:
+                transposed = _CSRWriter(f.create_group('X_T'), writer.n_rows)
+                _write_entries(lambda: _iter_csr_entries(f['X'], chunk_size), (writer.n_columns, writer.n_rows),
+                               transposed, max_entries, 'transpose', tmp_path + '.spill')
+                transposed.close()
+                obs_df, var_df = var_df, obs_df
+        for df in obs or []:
+            obs_df = obs_df.join(df)
+        for df in var or []:
+            var_df = var_df.join(df)
+        # write the metadata with anndata, then copy the streamed matrix into the file
+        anndata.AnnData(obs=obs_df, var=var_df).write_h5ad(partial_out)
+        with h5py.File(tmp_path, 'r') as src, h5py.File(partial_out, 'a') as dst:
+            if 'X' in dst:
+                del dst['X']
+            src.copy(src['X_T' if transpose else 'X'], dst, name='X')
+        os.replace(partial_out, out)
+    finally:
+        for p in (tmp_path, partial_out):
+            if os.path.exists(p):
+                os.remove(p)
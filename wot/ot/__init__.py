@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 from .initializer import *
+from .manifest import *
 from .optimal_transport import *
 from .optimal_transport_validation import *
 from .ot_model import *
+from .scheduling import *
+from .sharding import *
 from .util import *
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import anndata
+
 import wot
 
 from .ot_model import *
@@ -13,6 +15,9 @@ def initialize_ot_model(matrix, **kwargs):
     ----------
     matrix : str
         Path to a gene expression matrix file.
+    lazy : bool, optional
+        Read the cells of each timepoint from the h5ad or loom file on demand instead of loading the whole matrix,
+        so that memory is bounded by the largest pair of timepoints
     **kwargs : dict
         Other keywords arguments, will be passed to OT configuration.
 
@@ -29,14 +34,21 @@ def initialize_ot_model(matrix, **kwargs):
     >>> # Tweaking unbalanced parameters
     >>> initialize_ot_model('matrix.txt', 'days.txt', lambda1=50, lambda2=80, epsilon=.01)
     """
-    ds = wot.io.read_dataset(matrix)
-    if kwargs.pop('transpose', False):
-        ds = ds.T
+    reader = None
+    if kwargs.pop('lazy', False):
+        if kwargs.pop('transpose', False):
+            raise ValueError('transpose is not supported when reading cells on demand')
+        reader = wot.io.DatasetReader(matrix)
+        ds = anndata.AnnData(obs=reader.obs.copy(), var=reader.var.copy())
+    else:
+        ds = wot.io.read_dataset(matrix)
+        if kwargs.pop('transpose', False):
+            ds = ds.T
 
     wot.io.add_row_metadata_to_dataset(dataset=ds, days=kwargs.pop('cell_days', None),
                                        growth_rates=kwargs.pop('cell_growth_rates', None),
                                        covariate=kwargs.pop('covariate', None))
-    return OTModel(ds, **kwargs)
+    return OTModel(ds, reader=reader, **kwargs)
 
 
 def parse_configuration(config):
@@ -124,7 +136,7 @@ def parse_per_timepoint_configuration(config):
 
 
 def parse_parameter_file(path):
-    df = pd.read_csv(path, engine='python', sep=None, header=None)
+    df = wot.io.read_table(path, header=None)
     #  two column file containing parameter and value
     result = {}
     for i in range(len(df)):
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger('wot')
+
+
+def file_checksum(path, algorithm='sha256', block_size=1 << 20):
+    """
+    Computes the checksum of a file
+
+    Parameters
+    ----------
+    path : str
+        The file path
+    algorithm : str, optional
+        A hashlib algorithm name
+
+    Returns
+    -------
+    checksum : str
+        The hexadecimal digest
+    """
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _to_json_value(value):
+    if isinstance(value, (np.integer, np.floating, np.bool_)):
+        return value.item()
+    if isinstance(value, (tuple, list)):
+        return [_to_json_value(x) for x in value]
+    if isinstance(value, dict):
+        return {str(k): _to_json_value(value[k]) for k in value}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+class TransportMapManifest:
+    """
+    Records, for each transport map of a run, the parameters and input fingerprint it was computed from,
+    the checksum of the written file and the time it took.
+
+    The manifest is rewritten atomically after each recorded map so that a killed run can be resumed.
+
+    Parameters
+    ----------
+    path : str
+        Path to the manifest json file. Loaded if it exists.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.maps = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    d = json.load(f)
+                if d.get('version') == TransportMapManifest.VERSION:
+                    self.maps = d.get('maps', {})
+            except ValueError:
+                logger.warning('Ignoring unreadable manifest ' + path)
+
+    @staticmethod
+    def get_key(parameters, input_fingerprint):
+        """
+        Returns a digest identifying a transport map computation from its parameters and input fingerprint.
+        """
+        return hashlib.sha256((json.dumps(_to_json_value(parameters), sort_keys=True) + input_fingerprint).encode(
+            'utf-8')).hexdigest()
+
+    def is_current(self, output_file, parameters, input_fingerprint):
+        """
+        Checks whether output_file exists and was computed from the given parameters and inputs.
+
+        Parameters
+        ----------
+        output_file : str
+            The transport map path
+        parameters : dict
+            The parameters used to compute the transport map
+        input_fingerprint : str
+            The fingerprint of the cells used to compute the transport map
+
+        Returns
+        -------
+        result : bool
+            True if the transport map does not need to be recomputed
+        """
+        entry = self.maps.get(os.path.basename(output_file))
+        if entry is None or not os.path.exists(output_file):
+            return False
+        if entry['parameters'] != _to_json_value(parameters) or entry['input_fingerprint'] != input_fingerprint:
+            return False
+        if os.path.getsize(output_file) != entry['size']:
+            return False
+        return file_checksum(output_file) == entry['checksum']
+
+    def record(self, output_file, parameters, input_fingerprint, seconds):
+        """
+        Records a transport map that was written to output_file and saves the manifest.
+        """
+        entry = {'parameters': _to_json_value(parameters), 'input_fingerprint': input_fingerprint,
+                 'checksum': file_checksum(output_file), 'size': os.path.getsize(output_file),
+                 'seconds': seconds, 'completed': datetime.datetime.now().isoformat()}
+        with self.lock:
+            self.maps[os.path.basename(output_file)] = entry
+            self.save()
+
+    def save(self):
+        tmp_path = self.path + '.partial'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': TransportMapManifest.VERSION, 'maps': self.maps}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
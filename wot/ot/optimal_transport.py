@@ -1,33 +1,121 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
+import time
 
 import numpy as np
 
 logger = logging.getLogger('wot')
 
 
-def compute_transport_matrix(solver, **params):
+class SolverCheckpoint:
+    """
+    Periodically saves the state of a transport map computation to a small sidecar file,
+    so that an interrupted computation can be resumed.
+
+    The state holds the growth iteration, the growth learned so far and the solver's dual variables, all O(I+J).
+
+    Parameters
+    ----------
+    path : str
+        Path to the npz checkpoint file
+    interval : float, optional
+        Minimum number of seconds between two saves
+    key : str, optional
+        Identifies the inputs and parameters of the computation. A checkpoint saved with a different key is ignored.
+    """
+
+    def __init__(self, path, interval=600, key=''):
+        self.path = path
+        self.interval = interval
+        self.key = key
+        self.growth_iter = 0
+        self.learned_growth = []
+        self.last_save = time.time()
+
+    def load(self):
+        """
+        Loads the checkpoint
+
+        Returns
+        -------
+        state : dict or None
+            The saved state, or None if there is no valid checkpoint
+        """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with np.load(self.path, allow_pickle=False) as f:
+                state = {k: f[k] for k in f.files}
+        except (OSError, ValueError):
+            logger.warning('Ignoring unreadable checkpoint ' + self.path)
+            return None
+        if str(state.pop('key')) != self.key:
+            logger.info('Ignoring checkpoint for different inputs at ' + self.path)
+            return None
+        self.growth_iter = int(state.pop('growth_iter'))
+        self.learned_growth = list(state.pop('learned_growth'))
+        return state
+
+    def save(self, force=False, **solver_state):
+        """
+        Saves the current growth iteration, learned growth and solver_state if at least interval seconds
+        elapsed since the last save, or if force is True.
+        """
+        if not force and time.time() - self.last_save < self.interval:
+            return
+        tmp_path = self.path + '.partial'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, key=self.key, growth_iter=self.growth_iter, learned_growth=np.array(self.learned_growth),
+                     **solver_state)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.time()
+        logger.debug('Saved checkpoint to ' + self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def compute_transport_matrix(solver, checkpoint=None, **params):
     """
     Compute the optimal transport with stabilized numerics.
     Args:
     G: Growth (absolute)
     solver: transport_stablev2 or optimal_transport_duality_gap
     growth_iters:
+    checkpoint: optional wot.ot.SolverCheckpoint to save progress to and resume from
   """
 
     import gc
     G = params['G']
     growth_iters = params['growth_iters']
     learned_growth = []
-    for i in range(growth_iters):
-        if i == 0:
+    solver_state = None
+    start = 0
+    if checkpoint is not None:
+        state = checkpoint.load()
+        if state is not None:
+            start = checkpoint.growth_iter
+            learned_growth = checkpoint.learned_growth[:-1]
+            G = checkpoint.learned_growth[-1]
+            solver_state = state if len(state) > 0 else None
+            logger.info('Resuming from checkpoint at growth iteration {}'.format(start))
+    for i in range(start, growth_iters):
+        if i == start:
             row_sums = G
         else:
             row_sums = tmap.sum(axis=1)  # / tmap.shape[1]
         params['G'] = row_sums
         learned_growth.append(row_sums)
-        tmap = solver(**params)
+        if checkpoint is not None:
+            checkpoint.growth_iter = i
+            checkpoint.learned_growth = learned_growth
+            if solver_state is None:
+                checkpoint.save(force=True)
+        tmap = solver(**params, checkpoint=checkpoint, initial_state=solver_state)
+        solver_state = None
         gc.collect()
 
     return tmap, learned_growth
@@ -65,7 +153,7 @@ def dual(C, K, R, dx, dy, p, q, a, b, epsilon, lambda1, lambda2):
 # end @ Lénaïc Chizat
 
 def optimal_transport_duality_gap(C, G, lambda1, lambda2, epsilon, batch_size, tolerance, tau,
-                                  epsilon0, max_iter, **ignored):
+                                  epsilon0, max_iter, checkpoint=None, initial_state=None, **ignored):
     """
     Compute the optimal transport with stabilized numerics, with the guarantee that the duality gap is at most `tolerance`
 
@@ -91,6 +179,10 @@ def optimal_transport_duality_gap(C, G, lambda1, lambda2, epsilon, batch_size, t
         Starting value for exponentially-decreasing epsilon
     max_iter : int, optional
         Maximum number of iterations. Print a warning and return if it is reached, even without convergence.
+    checkpoint : wot.ot.SolverCheckpoint, optional
+        Checkpoint to periodically save the dual variables to, between duality gap checks
+    initial_state : dict, optional
+        Solver state loaded from a checkpoint to resume from
 
     Returns
     -------
@@ -112,17 +204,30 @@ def optimal_transport_duality_gap(C, G, lambda1, lambda2, epsilon, batch_size, t
 
     epsilon_i = epsilon0 * scale_factor
     current_iter = 0
-
-    for e in range(epsilon_scalings + 1):
+    start_stage = 0
+    if initial_state is not None:
+        if initial_state['u'].shape != (I,) or initial_state['v'].shape != (J,):
+            raise ValueError('Checkpoint does not match cost matrix of shape {}'.format(C.shape))
+        u, v = initial_state['u'], initial_state['v']
+        epsilon_i = float(initial_state['epsilon_i'])
+        start_stage = int(initial_state['epsilon_stage'])
+        current_iter = int(initial_state['current_iter'])
+
+    for e in range(start_stage, epsilon_scalings + 1):
         duality_gap = np.inf
-        u = u + epsilon_i * np.log(a)
-        v = v + epsilon_i * np.log(b)  # absorb
-        epsilon_i = epsilon_i / scale_factor
+        if initial_state is None:
+            u = u + epsilon_i * np.log(a)
+            v = v + epsilon_i * np.log(b)  # absorb
+            epsilon_i = epsilon_i / scale_factor
         _K = np.exp(-C / epsilon_i)
         alpha1 = lambda1 / (lambda1 + epsilon_i)
         alpha2 = lambda2 / (lambda2 + epsilon_i)
         K = np.exp((np.array([u]).T - C + np.array([v])) / epsilon_i)
-        a, b = np.ones(I), np.ones(J)
+        if initial_state is None:
+            a, b = np.ones(I), np.ones(J)
+        else:  # resume within the checkpointed epsilon stage
+            a, b = initial_state['a'], initial_state['b']
+            initial_state = None
         old_a, old_b = a, b
         threshold = tolerance if e == epsilon_scalings else 1e-6
 
@@ -159,6 +264,9 @@ def optimal_transport_duality_gap(C, G, lambda1, lambda2, epsilon, batch_size, t
                     np.linalg.norm(_a - old_a * np.exp(u / epsilon_i)) / (1 + np.linalg.norm(_a)),
                     np.linalg.norm(_b - old_b * np.exp(v / epsilon_i)) / (1 + np.linalg.norm(_b)))
 
+            if checkpoint is not None:
+                checkpoint.save(u=u, v=v, a=a, b=b, epsilon_stage=e, epsilon_i=epsilon_i, current_iter=current_iter)
+
     if np.isnan(duality_gap):
         raise RuntimeError("Overflow encountered in duality gap computation, please report this incident")
     return R / C.shape[1]
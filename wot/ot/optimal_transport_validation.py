@@ -65,9 +65,9 @@ def compute_validation_summary(ot_model, day_triplets=None, interp_size=10000, c
         t0, t05, t1 = triplet
         interp_frac = (t05 - t0) / (t1 - t0)
 
-        p0_ds = ot_model.matrix[ot_model.matrix.obs[ot_model.day_field] == float(t0), :]
-        p05_ds = ot_model.matrix[ot_model.matrix.obs[ot_model.day_field] == float(t05), :]
-        p1_ds = ot_model.matrix[ot_model.matrix.obs[ot_model.day_field] == float(t1), :]
+        p0_ds = ot_model.get_cells(t0)
+        p05_ds = ot_model.get_cells(t05)
+        p1_ds = ot_model.get_cells(t1)
 
         if local_pca > 0:
             matrices = list()
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import functools
+import hashlib
 import itertools
 import logging
 import os
+import time
 
 import anndata
 import numpy as np
@@ -30,13 +33,17 @@ class OTModel:
         Cell covariate obs name
     cell_growth_rate_field : str, optional
         Cell growth rate obs name
+    reader : wot.io.DatasetReader, optional
+        Read the expression values of each timepoint on demand from reader. matrix then only needs
+        the row and column metadata, its X is ignored.
     **kwargs : dict
         Dictionary of parameters. Will be inserted as is into OT configuration.
     """
 
     def __init__(self, matrix, day_field='day', covariate_field='covariate',
-                 growth_rate_field='cell_growth_rate', **kwargs):
+                 growth_rate_field='cell_growth_rate', reader=None, **kwargs):
         self.matrix = matrix
+        self.reader = reader
         self.day_field = day_field
         self.covariate_field = covariate_field
         self.cell_growth_rate_field = growth_rate_field
@@ -45,6 +52,7 @@ class OTModel:
         gene_filter = kwargs.pop('gene_filter', None)
         day_filter = kwargs.pop('cell_day_filter', None)
         ncounts = kwargs.pop('ncounts', None)
+        ncounts_seed = kwargs.pop('ncounts_seed', None)
         ncells = kwargs.pop('ncells', None)
         self.matrix = wot.io.filter_adata(self.matrix, obs_filter=cell_filter, var_filter=gene_filter)
         if day_filter is not None:
@@ -52,34 +60,31 @@ class OTModel:
             row_indices = self.matrix.obs[self.day_field].isin(days)
             self.matrix = self.matrix[row_indices].copy()
 
-        cvs = set(self.matrix.obs[self.covariate_field]) if self.covariate_field in self.matrix.obs else [None]
+        if self.day_field not in self.matrix.obs.columns:
+            raise ValueError("Days information not available for matrix")
+        if any(self.matrix.obs[self.day_field].isnull()):
+            self.matrix = self.matrix[self.matrix.obs[self.day_field].isnull() == False]
+        self._build_index()
         if ncells is not None:
             index_list = []
             for day in self.timepoints:
-                day_query = self.matrix.obs[self.day_field] == day
-                for cv in cvs:
-                    if cv is None:
-                        indices = np.where(day_query)[0]
-                    else:
-                        indices = np.where(day_query & (self.matrix.obs[self.covariate_field] == cv))[0]
+                for indices in self.get_covariate_indices(day).values():
                     if len(indices) > ncells:
+                        indices = indices.copy()
                         np.random.shuffle(indices)
-                        indices = indices[0:ncells]
+                        indices = np.sort(indices[0:ncells])
                     index_list.append(indices)
-            row_indices = np.concatenate(index_list)
-            self.matrix = self.matrix[row_indices]
+            row_indices = np.sort(np.concatenate(index_list))
+            self.matrix = self.matrix[row_indices].copy()
+            self._build_index()
         if ncounts is not None:
-            for i in range(self.matrix.X.shape[0]):
-                p = self.matrix[i].X
-                if scipy.sparse.isspmatrix(p):
-                    p = p.toarray()
-                p = p.astype('float64')
-                total = p.sum()
-                if total > ncounts:
-                    p /= total
-                    self.matrix.X[i] = np.random.multinomial(ncounts, p, size=1)[0]
-
-        if self.matrix.X.shape[0] is 0:
+            if self.reader is not None:
+                raise ValueError('ncounts is not supported when reading cells on demand')
+            if self.matrix.is_view:
+                self.matrix = self.matrix.copy()
+            self.matrix.X = wot.ot.downsample_counts(self.matrix.X, ncounts, random_state=ncounts_seed)
+
+        if self.matrix.shape[0] == 0:
             raise ValueError('No cells in matrix')
 
         self.ot_config = {'local_pca': 30, 'growth_iters': 1, 'epsilon': 0.05, 'lambda1': 1, 'lambda2': 50,
@@ -103,15 +108,85 @@ class OTModel:
                 self.ot_config[k] = config_dict[k]
 
         local_pca = self.ot_config['local_pca']
-        if local_pca > self.matrix.X.shape[1]:
+        if local_pca > self.matrix.shape[1]:
             logger.warning("local_pca set to {}, above gene count of {}. Disabling PCA" \
-                           .format(local_pca, self.matrix.X.shape[1]))
+                           .format(local_pca, self.matrix.shape[1]))
             self.ot_config['local_pca'] = 0
-        if self.day_field not in self.matrix.obs.columns:
-            raise ValueError("Days information not available for matrix")
-        if any(self.matrix.obs[self.day_field].isnull()):
-            self.matrix = self.matrix[self.matrix.obs[self.day_field].isnull() == False]
-        self.timepoints = sorted(set(self.matrix.obs[self.day_field]))
+
+    def _build_index(self):
+        """
+        Sorts cells by day, keeping their relative order within a day, so that each day is a contiguous row range.
+        """
+        days = self.matrix.obs[self.day_field].values.astype(np.float64)
+        order = np.argsort(days, kind='stable')
+        if np.any(order != np.arange(len(order))):
+            self.matrix = self.matrix[order].copy()
+            days = days[order]
+        self.timepoints = sorted(set(days))
+        starts = np.searchsorted(days, self.timepoints, side='left')
+        ends = np.searchsorted(days, self.timepoints, side='right')
+        self.day_ranges = {t: (int(start), int(end)) for t, start, end in zip(self.timepoints, starts, ends)}
+        self._covariate_index = None
+        if self.reader is not None:
+            # positions of the remaining cells and genes in the file
+            self._reader_rows = self.reader.obs.index.get_indexer(self.matrix.obs.index)
+            self._reader_columns = self.reader.var.index.get_indexer(self.matrix.var.index)
+
+    def get_covariate_indices(self, t):
+        """
+        Returns the row indices of the cells at time t for each covariate value
+
+        Parameters
+        ----------
+        t : float
+            The timepoint
+
+        Returns
+        -------
+        indices : dict
+            Maps each covariate value to an integer array of rows in the matrix, or None to all cells at t
+            if the matrix has no covariate
+        """
+        start, end = self.day_ranges.get(float(t), (0, 0))
+        if self.covariate_field is None or self.covariate_field not in self.matrix.obs.columns:
+            return {None: np.arange(start, end)}
+        if self._covariate_index is None:
+            # built on first use as the covariate can be added to obs after construction
+            codes, values = pd.factorize(self.matrix.obs[self.covariate_field].values)
+            self._covariate_index = {}
+            for day, (day_start, day_end) in self.day_ranges.items():
+                day_codes = codes[day_start:day_end]
+                order = np.argsort(day_codes, kind='stable')
+                bounds = np.searchsorted(day_codes[order], np.arange(len(values) + 1))
+                self._covariate_index[day] = {values[k]: day_start + order[bounds[k]:bounds[k + 1]]
+                                              for k in range(len(values)) if bounds[k + 1] > bounds[k]}
+        return self._covariate_index.get(float(t), {})
+
+    def get_cell_indices(self, t, covariate=None):
+        """
+        Returns the rows of the cells at time t, restricted to the covariate value if given
+
+        Returns
+        -------
+        indices : slice or ndarray
+            A slice when covariate is None, so that the rows can be taken without fancy indexing
+        """
+        if covariate is None:
+            start, end = self.day_ranges.get(float(t), (0, 0))
+            return slice(start, end)
+        return self.get_covariate_indices(t).get(covariate, np.arange(0))
+
+    def get_cells(self, t, covariate=None):
+        """
+        Returns a view of the cells at time t, restricted to the covariate value if given.
+        The cells are read from disk when the model was created with a reader.
+        """
+        indices = self.get_cell_indices(t, covariate)
+        if self.reader is None:
+            return self.matrix[indices]
+        adata = self.reader.read(self._reader_rows[indices], self._reader_columns)
+        obs = self.matrix.obs.iloc[indices]
+        return anndata.AnnData(X=adata.X, obs=obs, var=self.matrix.var)
 
     def get_covariate_pairs(self):
         """Get all covariate pairs in the dataset"""
@@ -122,7 +197,8 @@ class OTModel:
         return product(covariate, covariate)
 
     def compute_all_transport_maps(self, tmap_out='tmaps', overwrite=True, output_file_format='h5ad',
-                                   with_covariates=False):
+                                   with_covariates=False, max_memory=None, checkpoint_interval=None, shard=None,
+                                   max_pending_writes=1):
         """
         Computes all required transport maps.
 
@@ -131,11 +207,25 @@ class OTModel:
         tmap_out : str, optional
             Path and prefix for output transport maps
         overwrite : bool, optional
-            Overwrite existing transport maps
+            Overwrite existing transport maps. If False, only transport maps that are missing, or whose
+            parameters or input cells changed since they were recorded in the run manifest, are computed.
         output_file_format: str, optional
             Transport map file format
         with_covariates : bool, optional, default : False
             Compute all covariate-restricted transport maps as well
+        max_memory : int or str, optional
+            Memory budget (e.g. '52GB') for computing day pairs concurrently, largest first. The estimate of a
+            day pair stays reserved until its transport map is written. Day pairs are computed one at a time if None.
+        checkpoint_interval : float, optional
+            Save the solver state every checkpoint_interval seconds to a hidden file next to each transport map,
+            and resume from it if present. No checkpoints are saved if None.
+        shard : str or (int, int), optional
+            'i/N' to only compute the i-th of N deterministic shards of day pairs, balanced by estimated cost.
+            Shards are combined with wot.ot.merge_shards.
+        max_pending_writes : int, optional
+            Transport maps are written by a background thread while the next day pairs are computed.
+            Computation pauses when max_pending_writes maps are waiting to be written.
+            Maps are written synchronously if 0.
 
         Returns
         -------
@@ -153,6 +243,8 @@ class OTModel:
 
         if day_pairs is None or len(day_pairs) == 0:
             day_pairs = [(t[i], t[i + 1]) for i in range(len(t) - 1)]
+        # plain floats, so that day pairs in logs and shard descriptors do not print as numpy scalars
+        day_pairs = [(float(t0), float(t1)) for t0, t1 in day_pairs]
 
         if with_covariates:
             covariate_day_pairs = [(*d, c) for d, c in itertools.product(day_pairs, self.get_covariate_pairs())]
@@ -167,34 +259,107 @@ class OTModel:
         #     else:
         #         day_pairs = [x for x in day_pairs if self.tmaps.get(x, None) is None]
 
-        if not day_pairs:
-            logger.info('No day pairs')
-            return
-
-        full_learned_growth_df = None
         save_learned_growth = self.ot_config.get('growth_iters', 1) > 1
+        output_files = []
         for day_pair in day_pairs:
             path = tmap_prefix
             if not with_covariates:
                 path += "_{}_{}".format(*day_pair)
             else:
-                path += "_{}_{}_cv{}_cv{}".format(*day_pair)
+                path += "_{}_{}_cv{}_cv{}".format(*day_pair[:2], *day_pair[2])
             output_file = os.path.join(tmap_dir, path)
-            output_file = wot.io.check_file_extension(output_file, output_file_format)
-            if os.path.exists(output_file) and not overwrite:
-                logger.info('Found existing tmap at ' + output_file + '. ')
-                continue
-
-            tmap = self.compute_transport_map(*day_pair)
-            wot.io.write_dataset(tmap, output_file, output_format=output_file_format)
-            if save_learned_growth:
-                learned_growth_df = tmap.obs
-                full_learned_growth_df = learned_growth_df if full_learned_growth_df is None else pd.concat(
-                    (full_learned_growth_df, learned_growth_df), copy=False)
+            output_files.append(wot.io.check_file_extension(output_file, output_file_format))
+
+        run_prefix = tmap_prefix
+        if shard is not None:
+            shard = wot.ot.parse_shard(shard)
+            assignment = wot.ot.assign_shards([self.estimate_transport_map_cost(*day_pair) for day_pair in day_pairs],
+                                              shard[1])
+            wot.ot.write_shard_descriptor(tmap_dir, tmap_prefix, shard, [
+                {'t0': day_pair[0], 't1': day_pair[1], 'covariate': day_pair[2] if with_covariates else None,
+                 'file': os.path.basename(output_files[k]), 'shard': assignment[k]} for k, day_pair in
+                enumerate(day_pairs)], save_learned_growth)
+            day_pairs = [day_pairs[k] for k in range(len(day_pairs)) if assignment[k] == shard[0]]
+            output_files = [output_files[k] for k in range(len(output_files)) if assignment[k] == shard[0]]
+            run_prefix = wot.ot.get_shard_prefix(tmap_prefix, shard)
+
+        if not day_pairs:
+            logger.info('No day pairs')
+            return
+
+        manifest = wot.ot.TransportMapManifest(os.path.join(tmap_dir, run_prefix + '_manifest.json'))
+        jobs = []
+        learned_growth = {}
+        for day_pair, output_file in zip(day_pairs, output_files):
+            parameters = self.get_transport_map_parameters(*day_pair)
+            # only needed up front to skip current maps or to key checkpoints, otherwise computed when recorded
+            fingerprint = self.compute_input_fingerprint(
+                *day_pair) if not overwrite or checkpoint_interval is not None else None
+            if not overwrite:
+                if manifest.is_current(output_file, parameters, fingerprint):
+                    logger.info('Found up to date tmap at ' + output_file + '. ')
+                    if save_learned_growth:
+                        learned_growth[day_pair] = wot.io.read_dataset_obs(output_file)
+                    continue
+                if os.path.exists(output_file):
+                    logger.info('Recomputing out of date tmap at ' + output_file + '. ')
+            jobs.append((day_pair, output_file, parameters, fingerprint))
+
+        def compute_and_write(writer, day_pair, output_file, parameters, fingerprint, release=None):
+            # release frees the memory budget of the day pair once its transport map is written
+            start = time.time()
+            checkpoint = None
+            if checkpoint_interval is not None:
+                checkpoint_dir, checkpoint_name = os.path.split(output_file)
+                checkpoint = wot.ot.SolverCheckpoint(
+                    os.path.join(checkpoint_dir, '.checkpoint-' + checkpoint_name + '.npz'), checkpoint_interval,
+                    key=wot.ot.TransportMapManifest.get_key(parameters, fingerprint))
+            tmap = self.compute_transport_map(*day_pair, checkpoint=checkpoint)
+
+            def write():
+                try:
+                    wot.io.write_dataset(tmap, output_file, output_format=output_file_format, atomic=True)
+                    manifest.record(output_file, parameters, fingerprint if fingerprint is not None else
+                                    self.compute_input_fingerprint(*day_pair), time.time() - start)
+                    if checkpoint is not None:
+                        checkpoint.remove()
+                finally:
+                    if release is not None:
+                        release()
+
+            if writer is not None:
+                writer.submit(day_pair, write)
+            else:
+                write()
+            return tmap.obs if save_learned_growth else None
+
+        writer = wot.ot.BackgroundWriter(max_pending_writes) if max_pending_writes > 0 and jobs else None
+        try:
+            if max_memory is None:
+                for job in jobs:
+                    learned_growth[job[0]] = compute_and_write(writer, *job)
+            else:
+                learned_growth.update(wot.ot.run_with_memory_budget(
+                    [(job[0], self.estimate_transport_map_memory(*job[0]),
+                      functools.partial(compute_and_write, writer, *job)) for job in jobs], max_memory,
+                    hold_memory=True))
+        except BaseException:
+            if writer is not None:
+                writer.close(raise_errors=False)
+            raise
+        if writer is not None:
+            # write errors are raised once all day pairs have been computed and written
+            writer.close()
+        learned_growth_dfs = [learned_growth[day_pair] for day_pair in day_pairs if
+                              learned_growth.get(day_pair) is not None]
+        full_learned_growth_df = pd.concat(learned_growth_dfs, copy=False) if len(learned_growth_dfs) > 0 else None
         if full_learned_growth_df is not None:
-            full_learned_growth_df.to_csv(os.path.join(tmap_dir, tmap_prefix + '_g.txt'), sep='\t', index_label='id')
+            growth_path = os.path.join(tmap_dir, run_prefix + '_g.txt')
+            partial_growth_path = wot.io.get_partial_path(growth_path)
+            full_learned_growth_df.to_csv(partial_growth_path, sep='\t', index_label='id')
+            os.replace(partial_growth_path, growth_path)
 
-    def compute_transport_map(self, t0, t1, covariate=None):
+    def compute_transport_map(self, t0, t1, covariate=None, checkpoint=None):
         """
         Computes the transport map from time t0 to time t1
 
@@ -206,6 +371,8 @@ class OTModel:
             Destination timepoint for the transport map
         covariate : None or (str, str)
             The covariate restriction on cells from t0 and t1. None to skip
+        checkpoint : wot.ot.SolverCheckpoint, optional
+            Checkpoint to periodically save the solver state to and resume from
 
         Returns
         -------
@@ -227,9 +394,89 @@ class OTModel:
             logger.info('Computing transport map from {} to {}'.format(t0, t1))
         else:
             logger.info('Computing transport map from {} {} to {} {}'.format(t0, covariate[0], t1, covariate[1]))
-        config = {**self.ot_config, **local_config, 't0': t0, 't1': t1, 'covariate': covariate}
+        config = {**self.ot_config, **local_config, 't0': t0, 't1': t1, 'covariate': covariate,
+                  'checkpoint': checkpoint}
         return self.compute_single_transport_map(config)
 
+    def get_transport_map_parameters(self, t0, t1, covariate=None):
+        """
+        Returns all parameters that determine the transport map from t0 to t1, including the solver.
+        """
+        local_config = self.day_pairs.get((t0, t1), {}) if self.day_pairs is not None else {}
+        return {**self.ot_config, **local_config, 't0': t0, 't1': t1, 'covariate': covariate,
+                'solver': self.solver.__name__}
+
+    def compute_input_fingerprint(self, t0, t1, covariate=None):
+        """
+        Computes a fingerprint of the cells used for the transport map from t0 to t1:
+        their ids, expression values and growth rates. When cells are read on demand, the size and
+        modification time of the file stand in for the expression values, so that no cells are read.
+
+        Returns
+        -------
+        fingerprint : str
+            Hexadecimal digest
+        """
+        h = hashlib.sha256()
+        covariates = (None, None) if covariate is None else covariate
+        for t, cv in zip((t0, t1), covariates):
+            indices = self.get_cell_indices(t, cv)
+            obs = self.matrix.obs.iloc[indices]
+            h.update('\t'.join(obs.index.astype(str)).encode('utf-8'))
+            h.update('\t'.join(self.matrix.var.index.astype(str)).encode('utf-8'))
+            if self.reader is not None:
+                stat = os.stat(self.reader.path)
+                h.update('{}:{}'.format(stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+            else:
+                x = self.matrix[indices].X
+                if scipy.sparse.issparse(x):
+                    x = x.tocsr()
+                    for a in (x.data, x.indices, x.indptr):
+                        h.update(np.ascontiguousarray(a).tobytes())
+                else:
+                    h.update(np.ascontiguousarray(x).tobytes())
+            if self.cell_growth_rate_field in obs.columns:
+                h.update(np.ascontiguousarray(obs[self.cell_growth_rate_field].values, dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    def estimate_transport_map_memory(self, t0, t1, covariate=None):
+        """
+        Estimates the peak memory needed to compute the transport map from t0 to t1
+
+        Parameters
+        ----------
+        t0 : float
+            Source timepoint for the transport map
+        t1 : float
+            Destination timepoint for the transport map
+        covariate : None or (str, str)
+            The covariate restriction on cells from t0 and t1. None to skip
+
+        Returns
+        -------
+        nbytes : int
+            The estimated peak in bytes, see wot.ot.estimate_transport_map_memory
+        """
+        n0, n1 = self.get_cell_counts(t0, t1, covariate)
+        local_pca = self.ot_config.get('local_pca', 0)
+        return wot.ot.estimate_transport_map_memory(n0, n1, self.matrix.shape[1] if local_pca else 0, self.solver)
+
+    def estimate_transport_map_cost(self, t0, t1, covariate=None):
+        """
+        Estimates the relative cost of computing the transport map from t0 to t1,
+        proportional to the I x J work done at each solver iteration.
+        """
+        n0, n1 = self.get_cell_counts(t0, t1, covariate)
+        return n0 * n1
+
+    def get_cell_counts(self, t0, t1, covariate=None):
+        """
+        Returns the number of cells at t0 and t1, restricted to the covariate pair if given.
+        Counts are taken from the index, without reading the cells.
+        """
+        covariates = (None, None) if covariate is None else covariate
+        return tuple(len(self.matrix.obs.index[self.get_cell_indices(t, cv)]) for t, cv in zip((t0, t1), covariates))
+
     @staticmethod
     def compute_default_cost_matrix(a, b, eigenvals=None):
 
@@ -262,17 +509,9 @@ class OTModel:
         t1 = config.pop('t1', None)
         if t0 is None or t1 is None:
             raise ValueError("config must have both t0 and t1, indicating target timepoints")
-        ds = self.matrix
         covariate = config.pop('covariate', None)
-        if covariate is None:
-            p0_indices = ds.obs[self.day_field] == float(t0)
-            p1_indices = ds.obs[self.day_field] == float(t1)
-        else:
-            p0_indices = (ds.obs[self.day_field] == float(t0)) & (ds.obs[self.covariate_field] == covariate[0])
-            p1_indices = (ds.obs[self.day_field] == float(t1)) & (ds.obs[self.covariate_field] == covariate[1])
-
-        p0 = ds[p0_indices, :]
-        p1 = ds[p1_indices, :]
+        p0 = self.get_cells(t0, None if covariate is None else covariate[0])
+        p1 = self.get_cells(t1, None if covariate is None else covariate[1])
 
         if p0.shape[0] == 0:
             logger.info('No cells at {}'.format(t0))
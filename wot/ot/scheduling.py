@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import functools
+import itertools
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger('wot')
+
+# Number of simultaneously live I x J buffers at the peak of each solver, including the cost matrix,
+# the kernel, the temporaries created when the kernel is rebuilt and the returned transport map.
+SOLVER_BUFFERS = {'optimal_transport_duality_gap': 6, 'transport_stablev2': 4}
+
+_MEMORY_UNITS = {'': 1, 'B': 1, 'K': 1024, 'KB': 1024, 'M': 1024 ** 2, 'MB': 1024 ** 2, 'G': 1024 ** 3,
+                 'GB': 1024 ** 3, 'T': 1024 ** 4, 'TB': 1024 ** 4}
+
+
+def parse_memory_size(value):
+    """
+    Converts a memory size such as '52GB', '512M' or 1e9 to a number of bytes.
+
+    Parameters
+    ----------
+    value : str, int or float
+        The memory size. Plain numbers are interpreted as bytes.
+
+    Returns
+    -------
+    size : int
+        The number of bytes
+
+    Raises
+    ------
+    ValueError
+        If the value cannot be parsed.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    m = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*([a-zA-Z]*)\s*$', str(value))
+    if m is None or m.group(2).upper() not in _MEMORY_UNITS:
+        raise ValueError('Unable to parse memory size "{}"'.format(value))
+    return int(float(m.group(1)) * _MEMORY_UNITS[m.group(2).upper()])
+
+
+def format_memory_size(nbytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(nbytes) < 1024:
+            return '{:.1f}{}'.format(nbytes, unit)
+        nbytes /= 1024
+    return '{:.1f}TB'.format(nbytes)
+
+
+def _format_key(key):
+    # day pairs hold numpy scalars, which numpy 2 prints as np.float64(0.0) inside tuples
+    if isinstance(key, tuple):
+        return '({})'.format(', '.join(_format_key(k) for k in key))
+    return str(key.item() if isinstance(key, np.generic) else key)
+
+
+def estimate_transport_map_memory(n0, n1, n_features=0, solver='optimal_transport_duality_gap', dtype=np.float64):
+    """
+    Estimates the peak memory needed to compute a transport map between n0 and n1 cells.
+
+    Parameters
+    ----------
+    n0 : int
+        Number of cells at the source timepoint
+    n1 : int
+        Number of cells at the destination timepoint
+    n_features : int, optional
+        Number of features (genes) densified for the local PCA
+    solver : str or callable, optional
+        The solver, or its name
+    dtype : numpy.dtype, optional
+        The floating point type used by the solver
+
+    Returns
+    -------
+    nbytes : int
+        The estimated peak in bytes
+    """
+    name = solver if isinstance(solver, str) else solver.__name__
+    itemsize = np.dtype(dtype).itemsize
+    buffers = SOLVER_BUFFERS.get(name, max(SOLVER_BUFFERS.values()))
+    return int(itemsize * (buffers * n0 * n1 + 2 * (n0 + n1) * n_features))
+
+
+def _get_rss():
+    # resident set size of the process in bytes, None where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class _MemoryMonitor:
+    """
+    Samples the resident memory of the process in a background thread and records, for each running job,
+    the highest value seen since it started. The memory of the process can only be attributed to a job
+    that ran alone, so jobs that overlapped with others have no observed peak.
+    """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.jobs = {}  # key -> (baseline, peak, alone)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self._run, name='wot-memory-monitor', daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _sample(self):
+        current = _get_rss()
+        if current is None:
+            return
+        with self.lock:
+            for key, (baseline, peak, alone) in self.jobs.items():
+                self.jobs[key] = (baseline, max(peak, current), alone)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self._sample()
+
+    def begin(self, key):
+        current = _get_rss()
+        with self.lock:
+            for other, (baseline, peak, alone) in self.jobs.items():
+                self.jobs[other] = (baseline, peak, False)
+            self.jobs[key] = (current, current, len(self.jobs) == 0)
+
+    def end(self, key):
+        """
+        Returns the observed peak of the job in bytes above the memory in use when it started,
+        or None if it overlapped with other jobs or the memory of the process is not available
+        """
+        self._sample()
+        with self.lock:
+            baseline, peak, alone = self.jobs.pop(key)
+        return peak - baseline if alone and baseline is not None else None
+
+
+def run_with_memory_budget(jobs, max_memory, max_workers=None, hold_memory=False):
+    """
+    Runs jobs concurrently while the sum of their estimated peak memory stays within a budget.
+
+    Jobs are started largest first. A job whose estimate alone exceeds the budget is run by itself.
+
+    Parameters
+    ----------
+    jobs : list of (key, int, callable)
+        The job key, its estimated peak memory in bytes and a function without arguments to run
+    max_memory : int or str
+        The memory budget, in bytes or as a string such as '52GB'
+    max_workers : int, optional
+        Maximum number of concurrent jobs. Defaults to the number of CPUs
+    hold_memory : bool, optional
+        Call each function with a release function instead, and keep its estimate reserved after it returns
+        until release is called, e.g. once its result was written in the background. The estimate is
+        released when the function raises.
+
+    Returns
+    -------
+    results : dict
+        Maps each job key to the value returned by its function
+
+    Raises
+    ------
+    Exception
+        The first exception raised by a job, once all running jobs have finished.
+    """
+    max_memory = parse_memory_size(max_memory)
+    max_workers = max_workers or os.cpu_count() or 1
+    # a job larger than the budget is accounted as the whole budget so that it runs alone
+    pending = sorted([(key, estimate, min(estimate, max_memory), fn) for key, estimate, fn in jobs],
+                     key=lambda job: job[1], reverse=True)
+    results = {}
+    error = None
+    in_use = 0
+    running = {}
+    reserved = {}  # token of each job -> cost, until the job releases its memory
+    tokens = itertools.count()
+    # completed jobs and released reservations, in the order they happen
+    events = queue.Queue()
+
+    def run(key, estimate, fn, release):
+        monitor.begin(key)
+        start = time.time()
+        try:
+            return fn(release) if hold_memory else fn()
+        finally:
+            observed = monitor.end(key)
+            logger.info('{}: predicted peak {}, observed peak {} ({:.1f}s)'.format(
+                _format_key(key), format_memory_size(estimate), format_memory_size(observed) if observed is not None else
+                'unavailable', time.time() - start))
+
+    with _MemoryMonitor() as monitor, concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            while pending and error is None and len(running) < max_workers:
+                # largest job that fits in the remaining budget
+                index = next((i for i in range(len(pending)) if in_use + pending[i][2] <= max_memory), None)
+                if index is None:
+                    break
+                key, estimate, cost, fn = pending.pop(index)
+                if estimate > max_memory:
+                    logger.warning('{}: predicted peak {} exceeds memory budget of {}'.format(
+                        _format_key(key), format_memory_size(estimate), format_memory_size(max_memory)))
+                in_use += cost
+                token = next(tokens)
+                reserved[token] = cost
+                future = executor.submit(run, key, estimate, fn, functools.partial(events.put, ('release', token)))
+                running[future] = (key, token)
+                future.add_done_callback(lambda f: events.put(('done', f)))
+            if error is not None:
+                pending = []
+            if not running and (not pending or not reserved):
+                break
+            event, value = events.get()
+            if event == 'release':
+                in_use -= reserved.pop(value, 0)
+                continue
+            key, token = running.pop(value)
+            try:
+                results[key] = value.result()
+                if not hold_memory:
+                    in_use -= reserved.pop(token, 0)
+            except Exception as e:
+                in_use -= reserved.pop(token, 0)
+                if error is None:
+                    error = e
+    if error is not None:
+        raise error
+    return results
+
+
+class BackgroundWriter:
+    """
+    Runs write functions in a background thread so that computation can continue while results are written.
+
+    At most max_pending writes wait in the queue, submit blocks when the queue is full so that finished
+    results do not accumulate in memory faster than they can be written. Write errors are logged and the
+    first one is raised when the writer is closed.
+
+    Parameters
+    ----------
+    max_pending : int, optional
+        Maximum number of queued writes, not counting the write in progress
+    """
+
+    def __init__(self, max_pending=1):
+        if max_pending < 1:
+            raise ValueError('max_pending must be at least 1')
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, name='wot-writer', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_errors=exc_type is None)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            key, fn = item
+            start = time.time()
+            try:
+                fn()
+                logger.info('{}: written in {:.1f}s'.format(_format_key(key), time.time() - start))
+            except Exception as e:
+                logger.error('{}: write failed: {}'.format(_format_key(key), e))
+                self.errors.append((key, e))
+
+    def submit(self, key, fn):
+        """
+        Queues fn for writing, blocking while max_pending writes are already queued.
+
+        Parameters
+        ----------
+        key : object
+            Identifies the write in log messages
+        fn : callable
+            Function without arguments that writes the result
+        """
+        self.queue.put((key, fn))
+
+    def close(self, raise_errors=True):
+        """
+        Waits for all queued writes to finish.
+
+        Raises
+        ------
+        Exception
+            The first write error, if raise_errors is True
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if raise_errors and self.errors:
+            if len(self.errors) > 1:
+                logger.error('{} writes failed'.format(len(self.errors)))
+            raise self.errors[0][1]
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import json
+import logging
+import os
+import shutil
+
+import pandas as pd
+
+import wot
+from .manifest import _to_json_value
+
+logger = logging.getLogger('wot')
+
+
+def parse_shard(shard):
+    """
+    Parses a shard specification
+
+    Parameters
+    ----------
+    shard : str or (int, int)
+        'i/N' for the i-th of N shards, with 0 <= i < N
+
+    Returns
+    -------
+    shard : (int, int)
+        The shard index and number of shards
+
+    Raises
+    ------
+    ValueError
+        If the specification is invalid
+    """
+    if isinstance(shard, str):
+        tokens = shard.split('/')
+        if len(tokens) != 2:
+            raise ValueError('Shard must be specified as i/N')
+        try:
+            shard = int(tokens[0]), int(tokens[1])
+        except ValueError:
+            raise ValueError('Shard must be specified as i/N')
+    index, nshards = shard
+    if nshards < 1 or index < 0 or index >= nshards:
+        raise ValueError('Invalid shard {}/{}. Shard index must be between 0 and {}'.format(index, nshards,
+                                                                                            nshards - 1))
+    return index, nshards
+
+
+def assign_shards(costs, nshards):
+    """
+    Deterministically assigns jobs to shards so that the total cost per shard is balanced.
+
+    Jobs are assigned in decreasing cost order to the least loaded shard, ties broken by position.
+
+    Parameters
+    ----------
+    costs : list of float
+        The estimated cost of each job
+    nshards : int
+        The number of shards
+
+    Returns
+    -------
+    assignment : list of int
+        The shard of each job
+    """
+    loads = [0] * nshards
+    assignment = [None] * len(costs)
+    for k in sorted(range(len(costs)), key=lambda k: (-costs[k], k)):
+        shard = min(range(nshards), key=lambda i: (loads[i], i))
+        assignment[k] = shard
+        loads[shard] += costs[k]
+    return assignment
+
+
+def get_shard_prefix(tmap_prefix, shard):
+    return '{}_shard{}of{}'.format(tmap_prefix, *shard)
+
+
+def write_shard_descriptor(tmap_dir, tmap_prefix, shard, maps, save_learned_growth):
+    """
+    Writes the description of a shard of an optimal transport run, used by merge_shards.
+
+    Parameters
+    ----------
+    tmap_dir : str
+        The output directory
+    tmap_prefix : str
+        The transport map prefix
+    shard : (int, int)
+        The shard index and number of shards
+    maps : list of dict
+        All transport maps of the run, with keys t0, t1, covariate, file and shard
+    save_learned_growth : bool
+        Whether the shard writes a learned growth table
+    """
+    shard_prefix = get_shard_prefix(tmap_prefix, shard)
+    d = {'shard': shard[0], 'nshards': shard[1], 'prefix': tmap_prefix, 'maps': _to_json_value(maps),
+         'manifest': shard_prefix + '_manifest.json',
+         'growth': shard_prefix + '_g.txt' if save_learned_growth else None}
+    path = os.path.join(tmap_dir, shard_prefix + '.json')
+    with open(path + '.partial', 'w') as f:
+        json.dump(d, f, indent=1)
+    os.replace(path + '.partial', path)
+
+
+def merge_shards(tmap_prefixes, tmap_out):
+    """
+    Validates that all shards of an optimal transport run are complete and merges them into one directory.
+
+    Transport maps are linked (or copied) to the output directory, manifests and learned growth tables
+    are merged, and a json index readable by wot.tmap.TransportMapModel.from_json is written to tmap_out + '.json'.
+    Covariate-restricted transport maps have no index, they are read with
+    wot.tmap.TransportMapModel.from_directory(tmap_out, with_covariates=True).
+
+    Parameters
+    ----------
+    tmap_prefixes : list of str
+        The output prefixes (the --out argument) of the shards. Several shards may share a prefix.
+    tmap_out : str
+        Path and prefix for the merged transport maps
+
+    Raises
+    ------
+    ValueError
+        If shards, transport maps or learned growth tables are missing, or if a transport map does not match its
+        manifest
+    """
+    descriptors = {}
+    for tmap_prefix in tmap_prefixes:
+        tmap_dir, prefix = os.path.split(tmap_prefix)
+        tmap_dir = tmap_dir or '.'
+        for path in sorted(glob.glob(os.path.join(glob.escape(tmap_dir), glob.escape(prefix) + '_shard*of*.json'))):
+            if path.endswith('_manifest.json'):
+                continue
+            with open(path, 'r') as f:
+                d = json.load(f)
+            if d['shard'] in descriptors:
+                if os.path.realpath(descriptors[d['shard']]['dir']) != os.path.realpath(tmap_dir):
+                    raise ValueError('Shard {} found more than once'.format(d['shard']))
+                continue
+            d['dir'] = tmap_dir
+            descriptors[d['shard']] = d
+    if len(descriptors) == 0:
+        raise ValueError('No shards found')
+    nshards = descriptors[next(iter(descriptors))]['nshards']
+    missing_shards = [i for i in range(nshards) if i not in descriptors]
+    if missing_shards:
+        raise ValueError('Missing shards {} of {}'.format(', '.join(str(i) for i in missing_shards), nshards))
+    maps = descriptors[0]['maps']
+    for d in descriptors.values():
+        if d['nshards'] != nshards or d['maps'] != maps:
+            raise ValueError('Shard {} belongs to a different run'.format(d['shard']))
+
+    manifests = {i: wot.ot.TransportMapManifest(os.path.join(d['dir'], d['manifest'])) for i, d in
+                 descriptors.items()}
+    errors = []
+    for m in maps:
+        path = os.path.join(descriptors[m['shard']]['dir'], m['file'])
+        entry = manifests[m['shard']].maps.get(m['file'])
+        if not os.path.exists(path):
+            errors.append('missing ' + path)
+        elif entry is None:
+            errors.append('not recorded in manifest ' + path)
+        elif entry['size'] != os.path.getsize(path) or entry['checksum'] != wot.ot.file_checksum(path):
+            errors.append('checksum mismatch ' + path)
+    # shards without transport maps write no learned growth table
+    growth_paths = {m['shard']: os.path.join(descriptors[m['shard']]['dir'], descriptors[m['shard']]['growth'])
+                    for m in maps if descriptors[m['shard']]['growth'] is not None}
+    errors += ['missing learned growth ' + path for path in growth_paths.values() if not os.path.exists(path)]
+    if errors:
+        raise ValueError('Incomplete transport maps:\n' + '\n'.join(errors))
+    growth = {i: wot.io.read_table(path, sep='\t', index_col='id', dtype={'id': str}) for i, path in
+              growth_paths.items()}
+
+    out_dir, out_prefix = os.path.split(tmap_out)
+    out_dir = out_dir or '.'
+    os.makedirs(out_dir, exist_ok=True)
+    merged_manifest = wot.ot.TransportMapManifest(os.path.join(out_dir, out_prefix + '_manifest.json'))
+    tmaps = {}
+    for m in maps:
+        d = descriptors[m['shard']]
+        src = os.path.join(d['dir'], m['file'])
+        name = out_prefix + m['file'][len(d['prefix']):]
+        dst = os.path.join(out_dir, name)
+        if not os.path.exists(dst) or not os.path.samefile(src, dst):
+            if os.path.exists(dst):
+                os.remove(dst)
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copyfile(src, dst)
+        merged_manifest.maps[name] = manifests[m['shard']].maps[m['file']]
+        key = (m['t0'], m['t1']) if m['covariate'] is None else (m['t0'], m['t1'], *m['covariate'])
+        tmaps[key] = dst
+    merged_manifest.save()
+    logger.info('Merged {} transport maps from {} shards'.format(len(maps), nshards))
+
+    if any(m['covariate'] is not None for m in maps):
+        # covariate-restricted maps are read with TransportMapModel.from_directory(with_covariates=True), which
+        # needs no index. The growth table of each shard has the rows of its maps in order.
+        if growth:
+            positions = {i: 0 for i in growth}
+            parts = []
+            for m in maps:
+                if m['shard'] in growth:
+                    n = len(wot.io.read_dataset_obs(tmaps[(m['t0'], m['t1'], *m['covariate'])]))
+                    parts.append(growth[m['shard']].iloc[positions[m['shard']]:positions[m['shard']] + n])
+                    positions[m['shard']] += n
+            pd.concat(parts).to_csv(os.path.join(out_dir, out_prefix + '_g.txt'), sep='\t', index_label='id')
+        return
+    tmap_model = wot.tmap.TransportMapModel.from_paths(tmaps)
+    if growth:
+        g = pd.concat(growth.values())
+        g = g.reindex(tmap_model.meta.index[tmap_model.meta.index.isin(g.index)])
+        g.to_csv(os.path.join(out_dir, out_prefix + '_g.txt'), sep='\t', index_label='id')
+    tmap_model.to_json(tmap_out + '.json')
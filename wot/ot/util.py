@@ -306,3 +306,54 @@ def pca_transform(pca, mean, arr):
     ndarr = arr.toarray() if scipy.sparse.isspmatrix(arr) else arr
     ndarr = ndarr - mean
     return pca.transform(ndarr)
+
+
+def downsample_counts(X, ncounts, random_state=None, max_draws=10 ** 7):
+    """
+    Downsamples each cell with more than ncounts total counts to exactly ncounts counts.
+
+    For each such cell, ncounts counts are drawn with replacement with probability proportional to the
+    cell's values, as in numpy.random.multinomial. Cells are processed in blocks directly on the CSR data,
+    without densifying rows. Entries that receive no counts are removed so that the result stays sparse.
+
+    Parameters
+    ----------
+    X : ndarray or scipy.sparse matrix
+        The cells by genes count matrix
+    ncounts : int
+        The number of counts to keep per cell
+    random_state : int or numpy.random.Generator, optional
+        Seed for the random number generator
+    max_draws : int, optional
+        Maximum number of counts drawn at once, which bounds the temporary memory used
+
+    Returns
+    -------
+    X : ndarray or scipy.sparse.csr_matrix
+        The downsampled matrix, sparse if X was sparse
+    """
+    rng = np.random.default_rng(random_state)
+    is_sparse = scipy.sparse.issparse(X)
+    X = scipy.sparse.csr_matrix(X, copy=True)
+    X.sum_duplicates()
+    indptr = X.indptr
+    totals = np.add.reduceat(X.data.astype(np.float64), indptr[:-1]) if X.nnz > 0 else np.zeros(X.shape[0])
+    totals[indptr[:-1] == indptr[1:]] = 0  # reduceat returns the next value for empty rows
+    rows = np.where(totals > ncounts)[0]
+    block_size = max(1, max_draws // max(1, ncounts))
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        lengths = indptr[block + 1] - indptr[block]
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        # positions in X.data of the entries of all rows in the block
+        entries = np.repeat(indptr[block] - starts, lengths) + np.arange(ends[-1])
+        cumsum = np.cumsum(X.data[entries], dtype=np.float64)
+        offsets = np.concatenate(([0.0], cumsum[ends[:-1] - 1]))
+        draws = rng.random((len(block), ncounts)) * totals[block][:, np.newaxis] + offsets[:, np.newaxis]
+        positions = np.searchsorted(cumsum, draws, side='right')
+        # guard against rounding at row boundaries
+        positions = np.clip(positions, starts[:, np.newaxis], ends[:, np.newaxis] - 1)
+        X.data[entries] = np.bincount(positions.ravel(), minlength=len(entries))
+    X.eliminate_zeros()
+    return X if is_sparse else X.toarray()
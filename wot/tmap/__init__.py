@@ -1,5 +1,9 @@
+from .cache import *
+from .catalog import *
 from .chaining import *
 from .diff_exp import *
+from .prefetch import *
+from .server import *
 from .trajectory_divergence import *
 from .transport_map_model import *
 from .util import *
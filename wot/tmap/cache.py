@@ -0,0 +1,95 @@
+import collections
+import logging
+import threading
+
+import scipy.sparse
+
+logger = logging.getLogger('wot')
+
+
+def get_nbytes(ds):
+    """
+    Returns the number of bytes used by the matrix of a dataset
+
+    Parameters
+    ----------
+    ds : anndata.AnnData or ndarray or scipy.sparse.spmatrix
+
+    Returns
+    -------
+    nbytes : int
+    """
+    X = getattr(ds, 'X', ds)
+    if scipy.sparse.issparse(X):
+        return X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+    return X.nbytes
+
+
+class TransportMapCache:
+    """
+    Least recently used cache of loaded transport maps, bounded by the size of their matrices.
+
+    Any object with get(key) and put(key, value) methods can be given to wot.tmap.TransportMapModel instead.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Maximum number of bytes held by the cache. Unbounded if None.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Returns the cached value for key, or None. The entry becomes the most recently used.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Adds value to the cache, evicting the least recently used entries to stay within max_bytes.
+        Values larger than max_bytes are not cached.
+        """
+        nbytes = get_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                logger.info('{} is larger than the cache ({} bytes)'.format(key, nbytes))
+                return
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.max_bytes is not None and self.nbytes > self.max_bytes:
+                evicted_key, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+                logger.info('Evicted {} from the transport map cache'.format(evicted_key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __repr__(self):
+        return 'TransportMapCache({} maps, {} bytes, {} hits, {} misses, {} evictions)'.format(
+            len(self._entries), self.nbytes, self.hits, self.misses, self.evictions)
@@ -0,0 +1,146 @@
+import logging
+import os
+
+import h5py
+import numpy as np
+import pandas as pd
+
+import wot.io
+
+logger = logging.getLogger('wot')
+
+CATALOG_SUFFIX = '.catalog.h5'
+
+
+def get_catalog_path(tmap_out):
+    """
+    Returns the path of the catalog of the transport maps with path and prefix tmap_out, a hidden file in the
+    directory of the transport maps
+    """
+    tmap_dir, tmap_prefix = os.path.split(tmap_out)
+    return os.path.join(tmap_dir or '.', '.' + (tmap_prefix or 'tmaps') + CATALOG_SUFFIX)
+
+
+def _get_source(path):
+    stat = os.stat(path)
+    return '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def _get_segments(days):
+    # start of each run of equal days
+    days = np.asarray(days)
+    if len(days) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(([0], np.where(days[1:] != days[:-1])[0] + 1))
+
+
+def write_catalog(path, tmaps, meta):
+    """
+    Writes the catalog of transport maps, so that wot.tmap.read_catalog can create the cell metadata without
+    opening the transport maps.
+
+    The catalog holds the cell ids of all timepoints as a single block of text, the offset of each timepoint in it,
+    and the file name, stored matrix shape, size and modification time of each transport map.
+
+    Parameters
+    ----------
+    path : str
+        Catalog path, see get_catalog_path
+    tmaps : dict
+        Maps day pairs to transport map paths
+    meta : pandas.DataFrame
+        Cell metadata with index cell ids and 'day', as created by TransportMapModel.from_paths
+
+    Raises
+    ------
+    ValueError
+        If a cell id contains a newline
+    """
+    keys = sorted(tmaps.keys())
+    days = meta['day'].values
+    starts = _get_segments(days)
+    ids = [str(cell_id) for cell_id in meta.index.values]
+    # ids are stored as a single block of newline separated utf-8, decoded at once by read_catalog
+    ids_data = '\n'.join(ids).encode('utf-8')
+    if ids_data.count(b'\n') != max(0, len(ids) - 1):
+        raise ValueError('Cell ids can not contain newlines')
+    shapes = []
+    for key in keys:
+        with h5py.File(tmaps[key], 'r') as f:
+            X = f['matrix'] if 'matrix' in f else f['X']
+            if isinstance(X, h5py.Group):  # sparse h5ad
+                shapes.append(tuple(X.attrs.get('shape', X.attrs.get('h5sparse_shape'))))
+            else:
+                shapes.append(X.shape)
+    tmp_path = wot.io.get_partial_path(path)
+    try:
+        with h5py.File(tmp_path, 'w') as f:
+            f.create_dataset('ids', data=np.frombuffer(ids_data, dtype=np.uint8))
+            f['ids'].attrs['count'] = len(ids)
+            f.create_dataset('days', data=days[starts].astype(np.float64))
+            f.create_dataset('offsets', data=np.append(starts, len(days)).astype(np.int64))
+            f.create_dataset('day_pairs', data=np.asarray(keys, dtype=np.float64).reshape(len(keys), 2))
+            f.create_dataset('paths', data=np.char.encode([os.path.basename(tmaps[key]) for key in keys], 'utf-8'))
+            f.create_dataset('shapes', data=np.asarray(shapes, dtype=np.int64).reshape(len(keys), 2))
+            f.create_dataset('sources', data=np.char.encode([_get_source(tmaps[key]) for key in keys], 'utf-8'))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_catalog(path, tmaps):
+    """
+    Reads the cell metadata of transport maps from their catalog
+
+    Parameters
+    ----------
+    path : str
+        Catalog path, see get_catalog_path
+    tmaps : dict
+        Maps day pairs to transport map paths
+
+    Returns
+    -------
+    meta : pandas.DataFrame
+        Cell metadata with index cell ids and 'day', or None if the catalog does not exist, the transport maps
+        were added, removed or modified since the catalog was written, or the number of cells of each day does not
+        match the stored transport map shapes
+    """
+    if not os.path.exists(path):
+        return None
+    keys = sorted(tmaps.keys())
+    try:
+        with h5py.File(path, 'r') as f:
+            day_pairs = [tuple(pair) for pair in f['day_pairs'][()].tolist()]
+            if day_pairs != [(float(t0), float(t1)) for t0, t1 in keys]:
+                return None
+            names = np.char.decode(f['paths'][()], 'utf-8')
+            sources = np.char.decode(f['sources'][()], 'utf-8')
+            for key, name, source in zip(keys, names, sources):
+                if os.path.basename(tmaps[key]) != name or _get_source(tmaps[key]) != source:
+                    return None
+            offsets = f['offsets'][()]
+            days = f['days'][()]
+            shapes = f['shapes'][()]
+            count = f['ids'].attrs['count']
+            ids = f['ids'][()].tobytes().decode('utf-8').split('\n') if count > 0 else []
+    except (OSError, KeyError) as e:
+        logger.warning('Unable to read {}: {}'.format(path, e))
+        return None
+    # the cells of each day are the rows of the transport maps from that day, or the columns of the last
+    # transport map, as read by TransportMapModel.from_paths. A map has a column per row of the maps that follow it.
+    shapes = [tuple(shape) for shape in shapes.tolist()]
+    rows = {}
+    sizes = {}
+    for (t0, t1), shape in zip(day_pairs, shapes):
+        rows.setdefault(t0, shape[0])
+        sizes[t0] = sizes.get(t0, 0) + shape[0]
+    if len(shapes) > 0 and day_pairs[-1][1] not in sizes:
+        sizes[day_pairs[-1][1]] = shapes[-1][1]
+    if len(ids) != count or len(shapes) != len(day_pairs) or len(offsets) != len(days) + 1 \
+            or offsets[-1] != count or sizes != dict(zip(days.tolist(), np.diff(offsets).tolist())) \
+            or any(rows.get(t1, shape[1]) != shape[1] for (t0, t1), shape in zip(day_pairs, shapes)):
+        logger.warning('Ignoring catalog {} that does not match the transport map shapes'.format(path))
+        return None
+    return pd.DataFrame(index=np.array(ids, dtype=object), data={'day': np.repeat(days, np.diff(offsets))})
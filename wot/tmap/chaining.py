@@ -1,5 +1,14 @@
+import logging
+import time
+
+import numpy as np
+import scipy.sparse
+
+import wot.io
 import wot.tmap
 
+logger = logging.getLogger('wot')
+
 
 def chain_transport_maps(tmap_model, pairs_list):
     """
@@ -25,6 +34,12 @@ def chain_transport_maps(tmap_model, pairs_list):
         If any pair in pairs_list is not a valid day pair for the OTModel.
     ValueError
         If any pair (a, b) in pairs_list has a >= b.
+
+    Notes
+    -----
+    The maps are multiplied in the order that minimizes the number of scalar multiplications given the number
+    of cells at each timepoint. If tmap_model has a chain_cache, the products computed along the way are
+    cached by (start, end) timepoints, and cached products are reused by later chains that contain them.
     """
     for i in range(len(pairs_list) - 1):
         if pairs_list[i][1] != pairs_list[i + 1][0]:
@@ -33,11 +48,124 @@ def chain_transport_maps(tmap_model, pairs_list):
         if a >= b:
             raise ValueError("({}, {}) is not a valid transport map : it goes backwards in time".format(a, b))
 
-    tmap_0 = tmap_model.get_coupling(*pairs_list.pop(0))
-    while len(pairs_list) > 0:
-        tmap_1 = tmap_model.get_coupling(*pairs_list.pop(0))
-        tmap_0 = wot.tmap.glue_transport_maps(tmap_0, tmap_1)
-    return tmap_0
+    n = len(pairs_list)
+    cache = getattr(tmap_model, 'chain_cache', None)
+    day_counts = tmap_model.meta['day'].value_counts()
+    dims = [day_counts.get(pairs_list[0][0], 1)] + [day_counts.get(b, 1) for _, b in pairs_list]
+
+    def get_key(i, j):
+        return pairs_list[i][0], pairs_list[j][1]
+
+    cached = None
+    if cache is not None:
+        cached = [(i, j) for i in range(n) for j in range(i + 1, n) if get_key(i, j) in cache]
+    split = matrix_chain_order(dims, cached=cached)[1]
+
+    def multiply(i, j):
+        if i == j:
+            return tmap_model.get_coupling(*pairs_list[i])
+        if cache is not None:
+            tmap = cache.get(get_key(i, j))
+            if tmap is not None:
+                return tmap
+        k = split[i][j]
+        tmap = wot.tmap.glue_transport_maps(multiply(i, k), multiply(k + 1, j))
+        if cache is not None:
+            cache.put(get_key(i, j), tmap)
+        return tmap
+
+    return multiply(0, n - 1)
+
+
+def write_long_range_coupling(tmap_model, t0, t1, path, chunk_size=1000):
+    """
+    Computes the coupling between two timepoints out of core and writes it to an h5ad file.
+
+    Rows of the first transport map on the path from t0 to t1 are read chunk_size at a time and pushed
+    forward through the following transport maps. Each block of the result is written to a chunked X as soon
+    as it is computed, so only one block of the coupling is held in memory.
+
+    Parameters
+    ----------
+    tmap_model : wot.tmap.TransportMapModel
+        The transport maps to chain. Transport maps stored in h5ad or loom files that are not cached are read in
+        blocks of rows, others are loaded once.
+    t0 : float
+        Source timepoint
+    t1 : float
+        Destination timepoint
+    path : str
+        Output h5ad path. The result is written to a temporary file in the same directory and renamed to path
+        once complete.
+    chunk_size : int, optional
+        Number of cells at t0 computed at once
+    """
+    pairs_list = wot.tmap.find_path(t0, t1, tmap_model.day_pairs, tmap_model.timepoints)
+    obs = tmap_model.meta[tmap_model.meta['day'] == pairs_list[0][0]][[]]
+    var = tmap_model.meta[tmap_model.meta['day'] == pairs_list[-1][1]][[]]
+    # the following transport maps are read in blocks of rows as well when they are stored in h5ad or loom files,
+    # otherwise each is loaded when the first block reaches it
+    steps = [_long_range_step(tmap_model, a, b, chunk_size) for a, b in pairs_list[1:]]
+    start_time = time.time()
+    with wot.io.h5ad_array_writer(path, obs, var, chunk_size=chunk_size) as X:
+        for start, block in tmap_model.iter_coupling_row_blocks(*pairs_list[0], chunk_size):
+            if scipy.sparse.issparse(block):
+                block = block.toarray()
+            for step in steps:
+                block = step(block)
+            X[start:start + block.shape[0]] = block
+            logger.info('{}/{} rows ({:.0f} rows/s)'.format(start + block.shape[0], obs.shape[0],
+                                                          (start + block.shape[0]) / max(
+                                                              time.time() - start_time, 1e-9)))
+
+
+def _long_range_step(tmap_model, t0, t1, chunk_size):
+    if tmap_model._get_streamed_path(t0, t1, chunk_size=chunk_size) is not None:
+        return lambda block: tmap_model._push_forward_step(block, t0, t1, chunk_size=chunk_size)
+    loaded = []
+
+    def step(block):
+        if not loaded:
+            loaded.append(tmap_model.get_coupling(t0, t1).X)
+        return np.asarray(block @ loaded[0])
+
+    return step
+
+
+def matrix_chain_order(dims, cached=None):
+    """
+    Finds the order of multiplication of a chain of matrices that minimizes the number of scalar multiplications.
+
+    Parameters
+    ----------
+    dims : list of int
+        Matrix i has shape (dims[i], dims[i + 1])
+    cached : list of (int, int), optional
+        Products of matrices i to j (inclusive) that are available without computation
+
+    Returns
+    -------
+    cost : list of list of int
+        cost[i][j] is the minimum number of scalar multiplications to compute the product of matrices i to j
+    split : list of list of int
+        split[i][j] = k if the product of matrices i to j is best computed as (i..k) (k+1..j).
+        Splits are also given for cached products, should they be evicted.
+    """
+    n = len(dims) - 1
+    cached = set(cached) if cached is not None else set()
+    cost = [[0] * n for _ in range(n)]
+    split = [[0] * n for _ in range(n)]
+    for length in range(2, n + 1):
+        for i in range(n - length + 1):
+            j = i + length - 1
+            best = None
+            for k in range(i, j):
+                c = cost[i][k] + cost[k + 1][j] + dims[i] * dims[k + 1] * dims[j + 1]
+                if best is None or c < best:
+                    best = c
+                    split[i][j] = k
+            cost[i][j] = 0 if (i, j) in cached else best
+    return cost, split
 
 
 def find_path(t0, t1, available_pairs, timepoints):
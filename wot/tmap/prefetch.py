@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+
+import wot.tmap
+
+logger = logging.getLogger('wot')
+
+
+class TransportMapPrefetcher:
+    """
+    Loads transport maps in a background thread, ahead of a sweep that uses them in a known order.
+
+    Parameters
+    ----------
+    load : callable
+        Function that loads the transport map for a key
+    keys : list
+        Keys of the transport maps, in the order they will be requested
+    depth : int, optional
+        Maximum number of loaded transport maps waiting to be requested
+    max_bytes : int, optional
+        Stop loading ahead once the waiting transport maps use this many bytes. At least one transport map is
+        always loaded ahead.
+    """
+
+    def __init__(self, load, keys, depth=1, max_bytes=None):
+        self.keys = list(keys)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._load = load
+        self._positions = {key: i for i, key in enumerate(self.keys)}
+        self._loaded = {}  # position -> (value, error, nbytes)
+        self._position = 0  # position of the next key to be requested
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='wot-tmap-prefetch', daemon=True)
+        self._thread.start()
+
+    def _has_room(self):
+        if len(self._loaded) == 0:
+            return True
+        nbytes = sum(entry[2] for entry in self._loaded.values())
+        return len(self._loaded) < self.depth and (self.max_bytes is None or nbytes < self.max_bytes)
+
+    def _run(self):
+        for position, key in enumerate(self.keys):
+            with self._condition:
+                while not self._closed and not self._has_room():
+                    self._condition.wait()
+                if self._closed:
+                    return
+                if position < self._position:  # skipped by the sweep
+                    continue
+            start = time.time()
+            value, error, nbytes = None, None, 0
+            try:
+                value = self._load(key)
+                nbytes = wot.tmap.get_nbytes(value)
+            except BaseException as e:
+                error = e
+            logger.debug('{}: prefetched in {:.1f}s'.format(key, time.time() - start))
+            with self._condition:
+                if position >= self._position:
+                    self._loaded[position] = (value, error, nbytes)
+                self._condition.notify_all()
+
+    def get(self, key, wait=True):
+        """
+        Returns the transport map for key, waiting for it to be loaded. Returns None if key is not prefetched.
+        Keys that come before key in the sweep order and were not requested are discarded.
+        If wait is False, returns None instead of waiting for key to be loaded, and key is discarded.
+        """
+        position = self._positions.get(key)
+        if position is None:
+            return None
+        with self._condition:
+            if position < self._position:
+                return None
+            self._position = position
+            for skipped in [p for p in self._loaded if p < position]:
+                del self._loaded[skipped]
+            self._condition.notify_all()
+            while wait and position not in self._loaded and self._thread.is_alive():
+                self._condition.wait()
+            entry = self._loaded.pop(position, None)
+            self._position = position + 1
+            self._condition.notify_all()
+        if entry is None:
+            return None
+        value, error, _ = entry
+        if error is not None:
+            raise error
+        return value
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._loaded.clear()
+            self._condition.notify_all()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,319 @@
+import asyncio
+import concurrent.futures
+import http.client
+import json
+import logging
+import socket
+import time
+
+import anndata
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import wot.io
+
+logger = logging.getLogger('wot')
+
+
+def _encode_dataset(ds):
+    X = ds.X.toarray() if scipy.sparse.issparse(ds.X) else np.asarray(ds.X)
+    return {'index': [str(x) for x in ds.obs.index], 'columns': [str(x) for x in ds.var.index],
+            'obs': {str(c): ds.obs[c].tolist() for c in ds.obs.columns}, 'X': X.tolist()}
+
+
+def _decode_dataset(d):
+    X = np.asarray(d['X'], dtype=np.float64).reshape(len(d['index']), len(d['columns']))
+    return anndata.AnnData(X=X, obs=pd.DataFrame(index=d['index'], data=d['obs'] or None),
+                           var=pd.DataFrame(index=d['columns']))
+
+
+def _get_cell_set_matrix(cell_sets):
+    # cells by sets membership matrix of a dict of cell sets
+    names = list(cell_sets.keys())
+    members = [np.asarray(cell_sets[name], dtype=str) for name in names]
+    ids = pd.unique(np.concatenate(members)) if len(members) > 0 else np.zeros(0, dtype=str)
+    rows = pd.Index(ids).get_indexer(np.concatenate(members)) if len(members) > 0 else np.zeros(0, dtype=int)
+    columns = np.repeat(np.arange(len(names)), [len(m) for m in members])
+    X = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, columns)), shape=(len(ids), len(names)))
+    X.data[:] = 1  # duplicate members
+    return anndata.AnnData(X=X, obs=pd.DataFrame(index=ids), var=pd.DataFrame(index=names))
+
+
+class TransportMapServer:
+    """
+    Answers trajectory, fate, census and transition table queries over HTTP from a transport map model held
+    in memory, so that transport maps and cell metadata are loaded once for many queries.
+
+    Queries are POST requests to /trajectories, /fates, /census or /transition_table with a JSON object of
+    parameters: cell_set, the path of a gmt, gmx or grp file readable by the server, or cell_sets, an object
+    mapping set names to lists of cell ids; day for trajectories, fates and census; start_time and end_time for
+    transition tables. GET /status reports the timepoints and query counts. Queries run in a thread pool.
+    Identical queries received while one is running wait for its result instead of being computed again.
+
+    Parameters
+    ----------
+    tmap_model : wot.tmap.TransportMapModel
+        The model to query. Its prefetching is disabled, as queries use it concurrently.
+    max_workers : int, optional
+        Maximum number of queries computed at once
+    """
+
+    QUERIES = ('trajectories', 'fates', 'census', 'transition_table')
+
+    def __init__(self, tmap_model, max_workers=None):
+        self.tmap_model = tmap_model
+        tmap_model.prefetch_depth = 0
+        self.queries = 0
+        self.coalesced = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix='wot-serve')
+        self._pending = {}
+
+    def _get_cell_sets(self, params):
+        if params.get('cell_sets') is not None:
+            return {str(name): list(ids) for name, ids in params['cell_sets'].items()}
+        if params.get('cell_set') is not None:
+            return wot.io.read_sets(params['cell_set'], as_dict=True)
+        raise ValueError('cell_set or cell_sets is required')
+
+    def _get_populations(self, cell_sets, day):
+        populations = self.tmap_model.population_from_cell_sets(cell_sets, at_time=float(day))
+        if len(populations) == 0:
+            raise ValueError('No cells found at day {}'.format(day))
+        return populations
+
+    def _run_query(self, name, params):
+        # runs in the thread pool, returns the encoded response
+        start = time.time()
+        model = self.tmap_model
+        if name == 'trajectories' or name == 'fates':
+            populations = self._get_populations(self._get_cell_sets(params), params['day'])
+            result = _encode_dataset(model.trajectories(populations) if name == 'trajectories' else model.fates(
+                populations))
+        elif name == 'transition_table':
+            cell_sets = self._get_cell_sets(params)
+            result = _encode_dataset(model.transition_table(self._get_populations(cell_sets, params['start_time']),
+                                                            self._get_populations(cell_sets, params['end_time'])))
+        else:
+            if params.get('cell_sets') is not None:
+                cell_set_matrix = _get_cell_set_matrix(self._get_cell_sets(params))
+            else:
+                cell_set_matrix = wot.io.read_sets(params['cell_set'])
+            populations = self._get_populations(wot.io.convert_binary_dataset_to_dict(cell_set_matrix),
+                                                params['day'])
+            timepoints, census = model.ancestor_census(cell_set_matrix, *populations)
+            obs = pd.DataFrame(index=[str(t) for t in timepoints])
+            result = {populations[i].name: _encode_dataset(anndata.AnnData(census[i], obs, cell_set_matrix.var))
+                      for i in range(len(populations))}
+        data = json.dumps(result).encode('utf-8')
+        logger.info('{} computed in {:.2f}s'.format(name, time.time() - start))
+        return data
+
+    async def _query(self, name, params):
+        key = (name, json.dumps(params, sort_keys=True))
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, self._run_query, name, params)
+            self._pending[key] = future
+            self.queries += 1
+            future.add_done_callback(lambda f: self._pending.pop(key, None))
+        else:
+            self.coalesced += 1
+        # a client that disconnects does not cancel the query for the others
+        return await asyncio.shield(future)
+
+    async def _dispatch(self, method, target, body):
+        name = target.split('?')[0].strip('/')
+        if method == 'GET' and name == 'status':
+            status = {'timepoints': [float(t) for t in self.tmap_model.timepoints], 'queries': self.queries,
+                      'coalesced': self.coalesced,
+                      'cache': repr(self.tmap_model.cache) if self.tmap_model.cache is not None else None}
+            return 200, json.dumps(status).encode('utf-8')
+        if name not in TransportMapServer.QUERIES:
+            return 404, json.dumps({'error': 'Unknown query {}'.format(name)}).encode('utf-8')
+        if method != 'POST':
+            return 405, json.dumps({'error': 'Use POST for {}'.format(name)}).encode('utf-8')
+        try:
+            params = json.loads(body.decode('utf-8')) if body else {}
+            if not isinstance(params, dict):
+                raise ValueError('Query parameters must be a JSON object')
+            return 200, await self._query(name, params)
+        except (ValueError, KeyError, TypeError) as e:
+            message = 'Missing parameter {}'.format(e) if isinstance(e, KeyError) else str(e)
+            return 400, json.dumps({'error': message}).encode('utf-8')
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, target = request_line.decode('latin-1').split(' ')[0:2]
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                header, _, value = line.decode('latin-1').partition(':')
+                headers[header.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            try:
+                status, data = await self._dispatch(method, target, body)
+            except Exception as e:
+                logger.exception('Error answering {} {}'.format(method, target))
+                status, data = 500, json.dumps({'error': str(e)}).encode('utf-8')
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                         'Connection: close\r\n\r\n'.format(status, http.client.responses[status],
+                                                            len(data)).encode('latin-1'))
+            writer.write(data)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8000, path=None):
+        """
+        Starts listening on host and port, or on the Unix socket path
+
+        Returns
+        -------
+        server : asyncio.AbstractServer
+        """
+        if path is not None:
+            server = await asyncio.start_unix_server(self._handle, path=path)
+        else:
+            server = await asyncio.start_server(self._handle, host=host, port=port)
+        logger.info('Listening on {}'.format(path if path is not None else server.sockets[0].getsockname()))
+        return server
+
+    def serve_forever(self, host='127.0.0.1', port=8000, path=None):
+        """
+        Answers queries until interrupted
+        """
+
+        async def run():
+            server = await self.start(host=host, port=port, path=path)
+            async with server:
+                await server.serve_forever()
+
+        try:
+            asyncio.run(run())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class TransportMapClient:
+    """
+    Queries a wot.tmap.TransportMapServer
+
+    Parameters
+    ----------
+    host : str, optional
+        Server host
+    port : int, optional
+        Server port
+    path : str, optional
+        Unix socket of the server, instead of host and port
+    timeout : float, optional
+        Seconds to wait for a response
+    """
+
+    def __init__(self, host='127.0.0.1', port=8000, path=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+
+    def _request(self, method, name, params=None):
+        if self.path is not None:
+            connection = _UnixHTTPConnection(self.path, timeout=self.timeout)
+        else:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            body = json.dumps(params).encode('utf-8') if params is not None else None
+            connection.request(method, '/' + name, body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            result = json.loads(response.read().decode('utf-8'))
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise ValueError(result.get('error', response.reason))
+        return result
+
+    @staticmethod
+    def _get_cell_set_params(cell_sets):
+        return {'cell_set': cell_sets} if isinstance(cell_sets, str) else {
+            'cell_sets': {name: list(ids) for name, ids in cell_sets.items()}}
+
+    def status(self):
+        """
+        Returns the timepoints of the server and its query counts
+        """
+        return self._request('GET', 'status')
+
+    def trajectories(self, cell_sets, day):
+        """
+        Computes the trajectories of cell sets
+
+        Parameters
+        ----------
+        cell_sets : str or dict of str: list of str
+            Path of a cell set file on the server, or cell ids by set name
+        day : float
+            Day of the cell sets
+
+        Returns
+        -------
+        trajectories : anndata.AnnData
+            Cells on rows and cell sets on columns, as returned by TransportMapModel.trajectories
+        """
+        return _decode_dataset(self._request('POST', 'trajectories', dict(day=day, **self._get_cell_set_params(
+            cell_sets))))
+
+    def fates(self, cell_sets, day):
+        """
+        Computes the fates of cell sets, see trajectories
+        """
+        return _decode_dataset(self._request('POST', 'fates', dict(day=day, **self._get_cell_set_params(cell_sets))))
+
+    def transition_table(self, cell_sets, start_time, end_time):
+        """
+        Computes the transition table between the cell sets at start_time and end_time
+
+        Returns
+        -------
+        transition_table : anndata.AnnData
+            As returned by TransportMapModel.transition_table
+        """
+        return _decode_dataset(self._request('POST', 'transition_table', dict(
+            start_time=start_time, end_time=end_time, **self._get_cell_set_params(cell_sets))))
+
+    def census(self, cell_sets, day):
+        """
+        Computes the ancestor and descendant census of cell sets
+
+        Returns
+        -------
+        census : dict of str: anndata.AnnData
+            Timepoints by cell sets census of each cell set present at day
+        """
+        result = self._request('POST', 'census', dict(day=day, **self._get_cell_set_params(cell_sets)))
+        return {name: _decode_dataset(d) for name, d in result.items()}
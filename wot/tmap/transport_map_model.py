@@ -1,3 +1,5 @@
+import contextlib
+import logging
 import os
 
 import anndata
@@ -8,6 +10,8 @@ import wot.io
 import wot.tmap
 from wot.population import Population
 
+logger = logging.getLogger('wot')
+
 
 class TransportMapModel:
     """
@@ -23,12 +27,39 @@ class TransportMapModel:
            Sorted list of cell timepoints
         day_pairs : list
             List of (t1,t2)
+       cache : bool or wot.tmap.TransportMapCache, optional
+           Cache of loaded transport maps. True keeps every loaded transport map in memory, False disables caching.
+       chunk_size : int, optional
+           Stream h5ad and loom transport maps through push_forward and pull_back in blocks of chunk_size rows,
+           instead of loading them in memory
+       chain_cache : wot.tmap.TransportMapCache, optional
+           Cache of the products computed by get_coupling for non-adjacent timepoints, reused by later
+           overlapping queries
+       prefetch_depth : int, optional
+           Number of transport maps loaded ahead in a background thread by fates, trajectories, transition_table
+           and ancestor_census, while the current transport map is applied. No prefetching if 0.
+       prefetch_max_bytes : int, optional
+           Stop loading ahead once the transport maps loaded ahead use this many bytes
+       support_fraction : float, optional
+           push_forward reads only the rows of a transport map where the populations are nonzero when they are
+           nonzero on at most this fraction of the cells, for instance after population_from_ids
        """
 
-    def __init__(self, tmaps, meta, timepoints=None, day_pairs=None, cache=False):
+    def __init__(self, tmaps, meta, timepoints=None, day_pairs=None, cache=False, chunk_size=None,
+                 chain_cache=None, prefetch_depth=0, prefetch_max_bytes=None, support_fraction=0.1):
         self.tmaps = tmaps
         self.meta = meta
+        if cache is True:
+            cache = wot.tmap.TransportMapCache()
+        elif cache is False:
+            cache = None
         self.cache = cache
+        self.chunk_size = chunk_size
+        self.chain_cache = chain_cache
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_max_bytes = prefetch_max_bytes
+        self.support_fraction = support_fraction
+        self._prefetcher = None
         if timepoints is None:
             timepoints = sorted(meta['day'].unique())
         self.timepoints = timepoints
@@ -37,7 +68,7 @@ class TransportMapModel:
             day_pairs = [(timepoints[i], timepoints[i + 1]) for i in range(len(timepoints) - 1)]
         self.day_pairs = day_pairs
 
-    def fates(self, populations):
+    def fates(self, populations, out=None):
         """
         Computes fates for each population
 
@@ -47,26 +78,76 @@ class TransportMapModel:
             The TransportMapModel used to find fates
         populations : list of wot.Population
             The target populations such as ones from self.population_from_cell_sets. The populations must be from the same time.
+        out : str, optional
+            Write the fates to this h5ad file as they are computed, instead of holding them in memory
         Returns
         -------
         fates : anndata.AnnData
             Rows : all cells, Columns : populations index. At point (i, j) : the probability that cell i belongs to population j
+            Backed by out if given.
         """
         start_day = wot.tmap.unique_timepoint(*populations)  # check for unique timepoint
         populations = Population.copy(*populations, normalize=False, add_missing=True)
-        pop_names = [pop.name for pop in populations]
-        results = []
+        offsets = self._get_timepoint_offsets()
+        i = self.timepoints.index(start_day)
+        obs = self.meta.iloc[:offsets[i + 1]].copy()
+        var = pd.DataFrame(index=[pop.name for pop in populations])
+
+        def update(X, populations):
+            i = self.timepoints.index(wot.tmap.unique_timepoint(*populations))
+            block = np.array([pop.p for pop in populations]).T
+            block /= block.sum(axis=1, keepdims=1)
+            X[offsets[i]:offsets[i + 1]] = block
+
+        with self._output_matrix(obs, var, out) as X:
+            update(X, populations)
+            with self._prefetching(start_day, pull_back=True):
+                while self.can_pull_back(*populations):
+                    populations = self.pull_back(*populations, as_list=True, normalize=False)
+                    update(X, populations)
+        return self._output_dataset(X, obs, var, out)
+
+    def one_vs_rest_fates(self, populations):
+        """
+        Computes the fates of each population against all other cells, pulling back all populations at once
 
-        results.insert(0, np.array([pop.p for pop in populations]).T)
-        while self.can_pull_back(*populations):
-            populations = self.pull_back(*populations, as_list=True, normalize=False)
-            results.insert(0, np.array([pop.p for pop in populations]).T)
+        Parameters
+        ----------
+        populations : list of wot.Population
+            The target populations. The populations must be from the same time.
 
-        X = np.concatenate(results)
-        X /= X.sum(axis=1, keepdims=1)
-        obs = self.meta.copy()
-        obs = obs[obs['day'] <= start_day]
-        return anndata.AnnData(X=X, obs=obs, var=pd.DataFrame(index=pop_names))
+        Returns
+        -------
+        fates : list of anndata.AnnData
+            For each population, the same result as self.fates([population]): fates of the population and, if the
+            population does not contain all cells, of the 'Other' cells
+        """
+        start_day = wot.tmap.unique_timepoint(*populations)
+        populations = Population.copy(*populations, normalize=False)
+        pop_names = [pop.name for pop in populations]
+        # pulling back all cells gives the sum of the pull backs of a population and of the other cells
+        populations.append(Population(start_day, np.ones_like(populations[0].p)))
+        offsets = self._get_timepoint_offsets()
+        i = self.timepoints.index(start_day)
+        X = np.empty((offsets[i + 1], len(populations)))
+        X[offsets[i]:offsets[i + 1]] = np.array([pop.p for pop in populations]).T
+        no_other = X[offsets[i]:offsets[i + 1]].min(axis=0) > 0
+        with self._prefetching(start_day, pull_back=True):
+            while self.can_pull_back(*populations):
+                populations = self.pull_back(*populations, as_list=True, normalize=False)
+                i -= 1
+                X[offsets[i]:offsets[i + 1]] = np.array([pop.p for pop in populations]).T
+        total = X[:, -1:]
+        obs = self.meta.iloc[:X.shape[0]]
+        fates = []
+        for j in range(X.shape[1] - 1):
+            name = pop_names[j]
+            if no_other[j]:
+                fate_X, names = X[:, [j]] / X[:, [j]], [name]
+            else:
+                fate_X, names = np.hstack((X[:, [j]], total - X[:, [j]])) / total, [name, 'Other']
+            fates.append(anndata.AnnData(X=fate_X, obs=obs.copy(), var=pd.DataFrame(index=names)))
+        return fates
 
     def transition_table(self, start_populations, end_populations):
         """
@@ -92,8 +173,9 @@ class TransportMapModel:
         populations = end_populations
         results = []
         results.insert(0, np.array([pop.p for pop in populations]).T)
-        while self.can_pull_back(*populations) and wot.tmap.unique_timepoint(*populations) > start_time:
-            populations = self.pull_back(*populations, as_list=True, normalize=False)
+        with self._prefetching(wot.tmap.unique_timepoint(*populations), pull_back=True, end_time=start_time):
+            while self.can_pull_back(*populations) and wot.tmap.unique_timepoint(*populations) > start_time:
+                populations = self.pull_back(*populations, as_list=True, normalize=False)
 
         end_p = np.vstack([pop.p for pop in populations])
         start_p = np.vstack([pop.p for pop in start_populations])
@@ -102,7 +184,7 @@ class TransportMapModel:
         return anndata.AnnData(X=p, obs=pd.DataFrame(index=[p.name for p in start_populations]),
                                var=pd.DataFrame(index=[p.name for p in end_populations]))
 
-    def trajectories(self, populations):
+    def trajectories(self, populations, out=None):
         """
         Computes a trajectory for each population
 
@@ -112,35 +194,57 @@ class TransportMapModel:
             The TransportMapModel used to find ancestors and descendants of the population
         populations : list of wot.Population
             The target populations such as ones from self.population_from_cell_sets. THe populations must be from the same time.
+        out : str, optional
+            Write the trajectories to this h5ad file as they are computed, instead of holding them in memory
 
         Returns
         -------
         trajectories : anndata.AnnData
             Rows : all cells, Columns : populations index. At point (i, j) : the probability that cell i is an
-            ancestor/descendant of population j
+            ancestor/descendant of population j. Backed by out if given.
         """
         wot.tmap.unique_timepoint(*populations)  # check for unique timepoint
-        trajectories = []
-
         populations = Population.copy(*populations, normalize=True, add_missing=False)
-        population_names = [p.name for p in populations]
+        offsets = self._get_timepoint_offsets()
+        obs = self.meta.copy()
+        var = pd.DataFrame(index=[p.name for p in populations])
         initial_populations = populations
 
-        def update(head, populations_to_update):
-            idx = 0 if head else len(trajectories)
-            trajectories.insert(idx, np.array([pop.p for pop in populations_to_update]).T)
-
-        update(True, populations)
-        while self.can_pull_back(*populations):
-            populations = self.pull_back(*populations, as_list=True)
-            update(True, populations)
-        populations = initial_populations
-        while self.can_push_forward(*populations):
-            populations = self.push_forward(*populations, as_list=True)
-            update(False, populations)
+        def update(X, populations):
+            i = self.timepoints.index(wot.tmap.unique_timepoint(*populations))
+            X[offsets[i]:offsets[i + 1]] = np.array([pop.p for pop in populations]).T
+
+        with self._output_matrix(obs, var, out) as X:
+            update(X, populations)
+            with self._prefetching(wot.tmap.unique_timepoint(*populations), pull_back=True, push_forward=True):
+                while self.can_pull_back(*populations):
+                    populations = self.pull_back(*populations, as_list=True)
+                    update(X, populations)
+                populations = initial_populations
+                while self.can_push_forward(*populations):
+                    populations = self.push_forward(*populations, as_list=True)
+                    update(X, populations)
+        return self._output_dataset(X, obs, var, out)
+
+    def _get_timepoint_offsets(self):
+        # rows of timepoint i in meta are offsets[i]:offsets[i + 1]
+        counts = self.meta['day'].value_counts()
+        return np.concatenate(([0], np.cumsum([counts.get(t, 0) for t in self.timepoints]))).astype(int)
+
+    @contextlib.contextmanager
+    def _output_matrix(self, obs, var, out):
+        # preallocated result of fates and trajectories, filled one timepoint at a time
+        if out is None:
+            yield np.zeros((obs.shape[0], var.shape[0]))
+        else:
+            with wot.io.h5ad_array_writer(out, obs, var) as X:
+                yield X
 
-        return anndata.AnnData(X=np.concatenate(trajectories), obs=self.meta.copy(),
-                               var=pd.DataFrame(index=population_names))
+    @staticmethod
+    def _output_dataset(X, obs, var, out):
+        if out is None:
+            return anndata.AnnData(X=X, obs=obs, var=var)
+        return anndata.read_h5ad(wot.io.check_file_extension(str(out), 'h5ad'), backed='r')
 
     def get_coupling(self, t0, t1, covariate=None):
         """
@@ -175,20 +279,151 @@ class TransportMapModel:
             else:
                 cv0, cv1 = covariate
                 key = (t0, t1, str(cv0), str(cv1))
-            ds_or_path = self.tmaps.get(key)
-            if ds_or_path is None:
-                raise ValueError('No transport map found for {}', key)
-            if type(ds_or_path) is anndata.AnnData:
-                return ds_or_path
-            ds = wot.io.read_dataset(ds_or_path)
-            if self.cache:
-                self.tmaps[key] = ds
-            return ds
+            if self._prefetcher is not None:
+                ds = self._prefetcher.get(key)
+                if ds is not None:
+                    return ds
+            return self._load_coupling(key)
 
         else:
             path = wot.tmap.find_path(t0, t1, self.day_pairs, self.timepoints)
             return wot.tmap.chain_transport_maps(self, path)
 
+    def _load_coupling(self, key):
+        ds_or_path = self.tmaps.get(key)
+        if ds_or_path is None:
+            raise ValueError('No transport map found for {}', key)
+        if type(ds_or_path) is anndata.AnnData:
+            return ds_or_path
+        if self.cache is not None:
+            ds = self.cache.get(key)
+            if ds is not None:
+                return ds
+        ds = wot.io.read_dataset(ds_or_path)
+        if self.cache is not None:
+            self.cache.put(key, ds)
+        return ds
+
+    @contextlib.contextmanager
+    def _prefetching(self, start_time, pull_back=False, push_forward=False, end_time=None):
+        # prefetch the transport maps of a sweep from start_time: pull back to end_time (or the first timepoint),
+        # then push forward to the last timepoint
+        i = self.timepoints.index(start_time)
+        keys = []
+        if pull_back:
+            stop = 0 if end_time is None else self.timepoints.index(end_time)
+            keys += [(self.timepoints[k - 1], self.timepoints[k]) for k in range(i, stop, -1)]
+        if push_forward:
+            keys += [(self.timepoints[k], self.timepoints[k + 1]) for k in range(i, len(self.timepoints) - 1)]
+        keys = [key for key in keys if
+                isinstance(self.tmaps.get(key), str) and self._get_streamed_path(*key) is None]
+        if self.prefetch_depth <= 0 or len(keys) < 2 or self._prefetcher is not None:
+            yield
+            return
+        self._prefetcher = wot.tmap.TransportMapPrefetcher(self._load_coupling, keys, depth=self.prefetch_depth,
+                                                           max_bytes=self.prefetch_max_bytes)
+        try:
+            yield
+        finally:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+    def _get_streamed_path(self, t0, t1, chunk_size=None):
+        # path of a transport map to read in blocks of rows, or None to load it with get_coupling
+        if (chunk_size or self.chunk_size) is None or (self.cache is not None and (t0, t1) in self.cache):
+            return None
+        path = self.tmaps.get((t0, t1))
+        if not isinstance(path, str) or not os.path.exists(path) or wot.io.DatasetReader.get_format(path) not in (
+                'h5ad', 'loom'):
+            return None
+        return path
+
+    def iter_coupling_row_blocks(self, t0, t1, chunk_size):
+        """
+        Iterates over an atomic transport map in blocks of rows, reading only one block at a time from h5ad
+        and loom files that are not cached.
+
+        Parameters
+        ----------
+        t0 : int or float
+            Source timepoint of the transport map.
+        t1 : int of float
+            Destination timepoint of the transport map.
+        chunk_size : int
+            Number of rows in each block
+
+        Yields
+        ------
+        start : int
+            Index of the first row of the block
+        X : ndarray or scipy.sparse.csr_matrix
+            The block
+        """
+        path = self._get_streamed_path(t0, t1, chunk_size=chunk_size)
+        if path is not None:
+            with wot.io.DatasetReader(path, chunk_size=chunk_size) as reader:
+                for start, X in reader.iter_row_blocks():
+                    yield start, X
+        else:
+            X = self.get_coupling(t0, t1).X
+            for start in range(0, X.shape[0], chunk_size):
+                yield start, X[start:start + chunk_size]
+
+    def _get_coupling_rows(self, t0, t1, rows):
+        # rows of an atomic transport map, read from the file if the transport map is not in memory.
+        # None if the rows can not be read separately.
+        key = (t0, t1)
+        ds_or_path = self.tmaps.get(key)
+        if type(ds_or_path) is anndata.AnnData:
+            return ds_or_path.X[rows]
+        if self.cache is not None and key in self.cache:
+            ds = self.cache.get(key)
+            if ds is not None:
+                return ds.X[rows]
+        if self._prefetcher is not None:
+            # use the prefetched map if it is ready, otherwise reading the rows is faster than waiting for it
+            ds = self._prefetcher.get(key, wait=False)
+            if ds is not None:
+                return ds.X[rows]
+        if not isinstance(ds_or_path, str) or not os.path.exists(ds_or_path) \
+                or wot.io.DatasetReader.get_format(ds_or_path) not in ('h5ad', 'loom'):
+            return None
+        with wot.io.DatasetReader(ds_or_path) as reader:
+            return reader.read(rows).X
+
+    def _push_forward_step(self, p, t0, t1, chunk_size=None):
+        if self.support_fraction is not None and self.support_fraction > 0:
+            # populations from a few cells only need the rows of those cells
+            support = np.flatnonzero(np.any(p != 0, axis=0))
+            if len(support) <= self.support_fraction * p.shape[1]:
+                X = self._get_coupling_rows(t0, t1, support)
+                if X is not None:
+                    return np.asarray(p[:, support] @ X)
+        path = self._get_streamed_path(t0, t1, chunk_size=chunk_size)
+        if path is None:
+            return p @ self.get_coupling(t0, t1).X
+        result = None
+        with wot.io.DatasetReader(path, chunk_size=chunk_size or self.chunk_size) as reader:
+            for start, X in reader.iter_row_blocks():
+                block_result = p[:, start:start + X.shape[0]] @ X
+                if result is None:
+                    result = block_result
+                else:
+                    result += block_result
+            if result is None:
+                result = np.zeros((p.shape[0], reader.shape[1]))
+        return np.asarray(result)
+
+    def _pull_back_step(self, p, t0, t1):
+        path = self._get_streamed_path(t0, t1)
+        if path is None:
+            return (self.get_coupling(t0, t1).X @ p.T).T
+        with wot.io.DatasetReader(path, chunk_size=self.chunk_size) as reader:
+            result = np.zeros((p.shape[0], reader.shape[0]))
+            for start, X in reader.iter_row_blocks():
+                result[:, start:start + X.shape[0]] = np.asarray(X @ p.T).T
+        return result
+
     def can_push_forward(self, *populations):
         """
         Checks if the populations can be pushed forward.
@@ -286,8 +521,7 @@ class TransportMapModel:
         while i < j:
             t0 = self.timepoints[i]
             t1 = self.timepoints[i + 1]
-            tmap = self.get_coupling(t0, t1)
-            p = p @ tmap.X
+            p = self._push_forward_step(p, t0, t1)
             if normalize:
                 p = (p.T / np.sum(p, axis=1)).T
             i += 1
@@ -352,8 +586,7 @@ class TransportMapModel:
         while i > j:
             t1 = self.timepoints[i]
             t0 = self.timepoints[i - 1]
-            tmap = self.get_coupling(t0, t1)
-            p = (tmap.X @ p.T).T
+            p = self._pull_back_step(p, t0, t1)
             if normalize:
                 p = (p.T / np.sum(p, axis=1)).T
             i -= 1
@@ -560,13 +793,14 @@ class TransportMapModel:
             census.insert(x, self.population_census(cset_matrix, *populations))
 
         update(True, populations)
-        while self.can_pull_back(*populations):
-            populations = self.pull_back(*populations, as_list=True)
-            update(True, populations)
-        populations = initial_populations
-        while self.can_push_forward(*populations):
-            populations = self.push_forward(*populations, as_list=True)
-            update(False, populations)
+        with self._prefetching(wot.tmap.unique_timepoint(*populations), pull_back=True, push_forward=True):
+            while self.can_pull_back(*populations):
+                populations = self.pull_back(*populations, as_list=True)
+                update(True, populations)
+            populations = initial_populations
+            while self.can_push_forward(*populations):
+                populations = self.push_forward(*populations, as_list=True)
+                update(False, populations)
         census = np.asarray(census)
         if census.ndim == 3:
             # rearrange dimensions when more than one population is passed
@@ -606,7 +840,8 @@ class TransportMapModel:
             csm_indexer = cell_set_matrix.obs.index.get_indexer_for(inter_ids)
 
             def get_census(p):
-                return np.dot(p[pop_indexer], cell_set_matrix.X[csm_indexer, :])
+                # p @ X also works when X is a sparse membership matrix
+                return np.asarray(p[pop_indexer] @ cell_set_matrix.X[csm_indexer, :]).flatten()
 
             norm = lambda p: p if np.isclose(np.sum(p), 0) else p / np.sum(p)
             census = np.asarray([get_census(norm(pop.p)) for pop in populations],
@@ -628,7 +863,7 @@ class TransportMapModel:
             json.dump(d, f, ensure_ascii=False)
 
     @staticmethod
-    def from_json(index_path):
+    def from_json(index_path, cache=False, chunk_size=None):
         import json
         delete_index = False
         if index_path.startswith('gs://'):
@@ -646,19 +881,26 @@ class TransportMapModel:
         tmaps = {}
         for i in range(len(day_pairs)):
             tmaps[tuple(day_pairs[i])] = paths[i]
-        return TransportMapModel(tmaps=tmaps, meta=meta, timepoints=timepoints, day_pairs=day_pairs)
+        return TransportMapModel(tmaps=tmaps, meta=meta, timepoints=timepoints, day_pairs=day_pairs, cache=cache,
+                                 chunk_size=chunk_size)
 
     @staticmethod
-    def from_directory(tmap_out, with_covariates=False, cache=False):
+    def from_directory(tmap_out, with_covariates=False, cache=False, chunk_size=None, catalog=True):
         """
         Creates a wot.TransportMapModel from an output directory.
 
         Parameters
         ----------
-        :param tmap_out:
+        :param tmap_out: Path and prefix of the transport maps, or a json index as written by to_json
         :param with_covariates:
+        :param cache: Cache of loaded transport maps, see TransportMapModel
+        :param chunk_size: Number of transport map rows held in memory by push_forward and pull_back
+        :param catalog: Read cell ids from the catalog of the transport maps (see wot.tmap.write_catalog) if it is
+            up to date, otherwise read them from the transport maps and rewrite the catalog
         :return: TransportMapModel instance
         """
+        if tmap_out.lower().endswith('.json'):
+            return TransportMapModel.from_json(tmap_out, cache=cache, chunk_size=chunk_size)
         tmap_dir, tmap_prefix = os.path.split(tmap_out)
         tmap_dir = tmap_dir or '.'
         tmap_prefix = tmap_prefix or "tmaps"
@@ -692,11 +934,49 @@ class TransportMapModel:
 
         if len(tmaps) is 0:
             raise ValueError('No transport maps found in ' + tmap_dir + ' with prefix ' + tmap_prefix)
+        if with_covariates or not catalog:
+            return TransportMapModel.from_paths(tmaps, with_covariates=with_covariates, cache=cache,
+                                                chunk_size=chunk_size)
+        catalog_path = wot.tmap.get_catalog_path(tmap_out)
+        meta = wot.tmap.read_catalog(catalog_path, tmaps)
+        if meta is not None:
+            return TransportMapModel(tmaps=tmaps, meta=meta, timepoints=sorted(set(t for key in tmaps for t in key)),
+                                     day_pairs=set(tmaps.keys()), cache=cache, chunk_size=chunk_size)
+        tmap_model = TransportMapModel.from_paths(tmaps, cache=cache, chunk_size=chunk_size)
+        try:
+            wot.tmap.write_catalog(catalog_path, tmaps, tmap_model.meta)
+        except (OSError, ValueError) as e:
+            logger.warning('Unable to write {}: {}'.format(catalog_path, e))
+        return tmap_model
+
+    @staticmethod
+    def from_paths(tmaps, with_covariates=False, cache=False, chunk_size=None):
+        """
+        Creates a wot.TransportMapModel from transport map paths, reading cell ids from the files.
+
+        Parameters
+        ----------
+        tmaps : dict
+            Maps day pairs, or (t0, t1, cv0, cv1) if with_covariates, to transport map paths
+        with_covariates : bool, optional
+            Whether the transport maps are covariate-restricted
+        cache : bool or wot.tmap.TransportMapCache, optional
+            Cache of loaded transport maps, see TransportMapModel
+        chunk_size : int, optional
+            Number of transport map rows held in memory by push_forward and pull_back.
+            Transport maps are loaded in full if None.
+
+        Returns
+        -------
+        tmap_model : wot.TransportMapModel
+        """
         day_pairs = set()
         timepoints = set()
         tmap_keys = list(tmaps.keys())
         tmap_keys.sort(key=lambda x: x[0])
         meta = None
+        ids = []
+        days = []
         for i in range(len(tmap_keys)):
             key = tmap_keys[i]
             t0 = key[0]
@@ -719,14 +999,14 @@ class TransportMapModel:
                     var_key = var.attrs.get('_index', 'index')
                     rids = obs[obs_key][()].astype(str)
                     cids = var[var_key][()].astype(str) if i == len(tmap_keys) - 1 else None
-                rdf = pd.DataFrame(index=rids, data={'day': t0})
-                cdf = pd.DataFrame(index=cids, data={'day': t1}) if cids is not None else None
-                if meta is None:
-                    meta = rdf if cdf is None else pd.concat((rdf, cdf), copy=False)
-                else:
-                    meta = pd.concat((meta, rdf), copy=False) if cdf is None else pd.concat((meta, rdf, cdf),
-                                                                                            copy=False)
-
+                ids.append(rids)
+                days.append(np.full(len(rids), t0))
+                if cids is not None:
+                    ids.append(cids)
+                    days.append(np.full(len(cids), t1))
                 f.close()
+        if not with_covariates:
+            meta = pd.DataFrame(index=np.concatenate(ids).astype(object), data={'day': np.concatenate(days)})
         timepoints = sorted(timepoints)
-        return TransportMapModel(tmaps=tmaps, meta=meta, timepoints=timepoints, day_pairs=day_pairs, cache=cache)
+        return TransportMapModel(tmaps=tmaps, meta=meta, timepoints=timepoints, day_pairs=day_pairs, cache=cache,
+                                 chunk_size=chunk_size)